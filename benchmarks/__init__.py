@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Benchmarks of the party pipeline
+
+- synthetic.py : synthetic parts library templates of arbitrary size
+- stubs : stand-ins for ccad, aocxchange, pythonocc and sphinx-build so
+  that the pipeline runs without OpenCascade
+- run.py : runs the pipeline phases and reports their wall time and
+  peak memory as JSON
+
+"""
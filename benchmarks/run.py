@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2018-2019 Guillaume Florent, Thomas Paviot, Bernard Uguen
+
+# This file is part of cadracks-party.
+#
+# cadracks-party is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# cadracks-party is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cadracks-party.  If not, see <https://www.gnu.org/licenses/>.
+
+r"""Benchmark of the party pipeline on a synthetic parts library
+
+Usage (from the repository root) :
+
+    python -m benchmarks.run --parts 10000 --output results.json
+
+The phases (autocreate_library, check_all, generate,
+create_libraries_sphinx_sources) run one after the other on the same
+library, each one in a fresh process so that its peak memory is measured
+on its own. The results are written as JSON.
+
+Unless --real-cad is used, ccad, aocxchange, pythonocc and sphinx-build are
+replaced by the stand-ins of benchmarks/stubs
+
+"""
+
+import sys
+import json
+import time
+import shutil
+import logging
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from os import environ, pathsep
+from os.path import join, dirname, abspath
+from argparse import ArgumentParser
+
+from benchmarks.synthetic import create_synthetic_library
+
+logger = logging.getLogger(__name__)
+
+STUBS_FOLDER = join(dirname(abspath(__file__)), "stubs")
+
+PHASES = ["autocreate_library",
+          "check_all",
+          "generate",
+          "create_libraries_sphinx_sources"]
+
+
+def _use_stubs():
+    sys.path.insert(0, STUBS_FOLDER)
+    environ["PATH"] = join(STUBS_FOLDER, "bin") + pathsep + environ["PATH"]
+
+
+def _run_phase(phase, library_folder, options):
+    r"""Run a phase of the pipeline in the current process"""
+    if phase == "autocreate_library":
+        from cadracks_party.library_creation import autocreate_library
+        autocreate_library(join(library_folder, "library_template.json"),
+                           library_file_name=join(library_folder,
+                                                  "library.json"))
+    elif phase == "check_all":
+        from cadracks_party.library_checking import check_all
+        check_all(join(library_folder, "library.json"))
+    elif phase == "generate":
+        from cadracks_party.library_use import generate
+        generate(join(library_folder, "library.json"),
+                 generate_steps=options["steps"],
+                 generate_stls=options["stls"],
+                 workers=options["workers"])
+    elif phase == "create_libraries_sphinx_sources":
+        from cadracks_party.library_documentation import \
+            create_libraries_sphinx_sources
+        from cadracks_party.commons import create_folder
+        create_folder(join(library_folder, "doc"))
+        create_libraries_sphinx_sources(library_folder,
+                                        join(library_folder, "doc"))
+    else:
+        raise ValueError("Unknown phase %s" % phase)
+
+
+def _measure_phase(phase, library_folder, options, queue):
+    r"""Target of the process running a phase"""
+    if options["stubs"]:
+        _use_stubs()
+    start = time.time()
+    _run_phase(phase, library_folder, options)
+    wall_time = time.time() - start
+    # ru_maxrss is in kB on Linux
+    queue.put({
+        "wall_time": wall_time,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_rss_children_kb":
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss})
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=dirname(dirname(abspath(__file__)))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(parts=1000,
+        generators=2,
+        alias_fanout=10,
+        drawing_lines=1000,
+        phases=None,
+        options=None):
+    r"""Run the benchmark
+
+    Parameters
+    ----------
+    parts, generators, alias_fanout, drawing_lines : int
+        Parameters of the synthetic library (see create_synthetic_library())
+    phases : list[str], optional
+        Phases to run, all phases by default. A phase needs the output of
+        the previous ones
+    options : dict, optional
+        stubs (bool), steps (bool), stls (bool), workers (int)
+
+    Returns
+    -------
+    dict : the benchmark results
+
+    """
+    phases = PHASES if phases is None else phases
+    run_options = {"stubs": True, "steps": True, "stls": True, "workers": 1}
+    run_options.update(options or dict())
+
+    results = {"commit": _git_commit(),
+               "python": sys.version.split()[0],
+               "parameters": {"parts": parts,
+                              "generators": generators,
+                              "alias_fanout": alias_fanout,
+                              "drawing_lines": drawing_lines},
+               "options": run_options,
+               "phases": dict()}
+
+    # spawn : each phase starts from a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+
+    library_folder = tempfile.mkdtemp(prefix="party_benchmark_")
+    try:
+        start = time.time()
+        create_synthetic_library(join(library_folder, "synthetic"),
+                                 parts=parts,
+                                 generators=generators,
+                                 alias_fanout=alias_fanout,
+                                 drawing_lines=drawing_lines)
+        results["synthetic_library_time"] = time.time() - start
+
+        for phase in phases:
+            logger.info("Running %s ..." % phase)
+            queue = context.Queue()
+            process = context.Process(
+                target=_measure_phase,
+                args=(phase, join(library_folder, "synthetic"),
+                      run_options, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError("Phase %s failed (exit code %s)" %
+                                   (phase, process.exitcode))
+            results["phases"][phase] = queue.get()
+            logger.info("... done in %.3f s" %
+                        results["phases"][phase]["wall_time"])
+    finally:
+        shutil.rmtree(library_folder)
+
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the party pipeline on a "
+                                        "synthetic parts library")
+    parser.add_argument('--parts', type=int, default=1000)
+    parser.add_argument('--generators', type=int, default=2)
+    parser.add_argument('--alias-fanout', type=int, default=10)
+    parser.add_argument('--drawing-lines', type=int, default=1000)
+    parser.add_argument('--phases', nargs='+', choices=PHASES,
+                        default=PHASES)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of processes used by generate")
+    parser.add_argument('--no-steps', action='store_true')
+    parser.add_argument('--no-stls', action='store_true')
+    parser.add_argument('--real-cad', action='store_true',
+                        help="Use the installed CAD kernel instead of "
+                             "the stand-ins")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="JSON results file (default: stdout)")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING,
+                        format='%(asctime)s :: %(levelname)6s :: '
+                               '%(module)20s :: %(lineno)3d :: %(message)s')
+
+    results = run(parts=args.parts,
+                  generators=args.generators,
+                  alias_fanout=args.alias_fanout,
+                  drawing_lines=args.drawing_lines,
+                  phases=args.phases,
+                  options={"stubs": not args.real_cad,
+                           "steps": not args.no_steps,
+                           "stls": not args.no_stls,
+                           "workers": args.jobs})
+
+    if args.output is None:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+# coding: utf-8
+
+r"""Stand-in for OCC.Core.IFSelect"""
+
+IFSelect_RetDone = 1
@@ -0,0 +1,10 @@
+# coding: utf-8
+
+r"""Stand-in for OCC.Core.Interface"""
+
+_static = dict()
+
+
+def Interface_Static_SetCVal(name, value):
+    _static[name] = value
+    return True
@@ -0,0 +1,24 @@
+# coding: utf-8
+
+r"""Stand-in for OCC.Core.STEPControl"""
+
+from OCC.Core.Interface import _static
+from OCC.Core.IFSelect import IFSelect_RetDone
+
+STEPControl_AsIs = 0
+
+
+class STEPControl_Writer(object):
+    def __init__(self):
+        self._products = list()
+
+    def Transfer(self, shape, mode):
+        self._products.append((_static.get("write.step.product.name"),
+                               shape.description))
+        return IFSelect_RetDone
+
+    def Write(self, filename):
+        with open(filename, 'w') as f:
+            for name, description in self._products:
+                f.write("%s %s\n" % (name, str(description)))
+        return IFSelect_RetDone
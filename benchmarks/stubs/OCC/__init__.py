@@ -0,0 +1,3 @@
+# coding: utf-8
+
+r"""Stand-in for pythonocc, used by the benchmarks (see benchmarks/stubs)"""
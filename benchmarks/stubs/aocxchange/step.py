@@ -0,0 +1,17 @@
+# coding: utf-8
+
+r"""Stand-in for aocxchange.step"""
+
+
+class StepExporter(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self._shapes = list()
+
+    def add_shape(self, shape):
+        self._shapes.append(shape)
+
+    def write_file(self):
+        with open(self.filename, 'w') as f:
+            for shape in self._shapes:
+                f.write("%s\n" % str(shape.description))
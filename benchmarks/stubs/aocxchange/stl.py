@@ -0,0 +1,16 @@
+# coding: utf-8
+
+r"""Stand-in for aocxchange.stl"""
+
+
+class StlExporter(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self._shape = None
+
+    def set_shape(self, shape):
+        self._shape = shape
+
+    def write_file(self):
+        with open(self.filename, 'w') as f:
+            f.write("%s\n" % str(self._shape.description))
@@ -0,0 +1,58 @@
+# coding: utf-8
+
+r"""Stand-in for ccad.model
+
+The solids only record the calls that built them : the cost of the
+geometry construction is left out of the benchmarks, which measure party
+
+"""
+
+
+class _Shape(object):
+    def __init__(self, description):
+        self.description = description
+
+    def IsNull(self):
+        return False
+
+
+class Solid(object):
+    def __init__(self, description):
+        self.shape = _Shape(description)
+
+    def _combine(self, other, operator):
+        return Solid((self.shape.description, operator,
+                      other.shape.description))
+
+    def __add__(self, other):
+        return self._combine(other, "+")
+
+    def __sub__(self, other):
+        return self._combine(other, "-")
+
+    def __mul__(self, other):
+        return self._combine(other, "*")
+
+
+def cylinder(radius, length):
+    return Solid(("cylinder", radius, length))
+
+
+def box(dx, dy, dz):
+    return Solid(("box", dx, dy, dz))
+
+
+def ngon(radius, sides):
+    return Solid(("ngon", radius, sides))
+
+
+def filling(wire):
+    return Solid(("filling", wire.shape.description))
+
+
+def prism(face, vector):
+    return Solid(("prism", face.shape.description, vector))
+
+
+def translated(solid, vector):
+    return Solid(("translated", solid.shape.description, vector))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2018-2019 Guillaume Florent, Thomas Paviot, Bernard Uguen
+
+# This file is part of cadracks-party.
+#
+# cadracks-party is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# cadracks-party is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cadracks-party.  If not, see <https://www.gnu.org/licenses/>.
+
+r"""Synthetic parts library templates of arbitrary size
+
+The template, its generators and its drawings are laid out like a real
+parts library (see create_skeleton()) so that autocreate_library() can
+build the library.json file from them
+
+"""
+
+import json
+from os.path import join
+
+from cadracks_party.commons import create_folder
+
+GENERATOR = ['r"""Synthetic generator %(index)i"""',
+             '',
+             'from ccad.model import cylinder',
+             '',
+             'radius = {{ radius }}',
+             'length = {{ length }}',
+             'head_radius = {{ head_radius }}',
+             '',
+             'part = cylinder(radius, length) + cylinder(head_radius, radius)',
+             '__shape__ = part.shape',
+             '__anchors__ = {"head": {"p": (0., 0., 0.),',
+             '                        "u": (0., 0., -1.),',
+             '                        "v": (1., 0., 0.),',
+             '                        "dimension": radius,',
+             '                        "description": "head on plane"}}',
+             'anchors = __anchors__',
+             '']
+
+RULES = ["radius > 0", "length > radius", "head_radius > radius"]
+
+
+def _svg_drawing(lines):
+    r"""SVG drawing of about the requested number of lines"""
+    svg = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+           '<svg xmlns="http://www.w3.org/2000/svg" '
+           'width="210mm" height="297mm">']
+    for i in range(max(lines - 3, 0)):
+        svg.append('  <path d="M %i,%i L %i,%i" '
+                   'style="stroke:#000000;stroke-width:0.5" '
+                   'id="path%i" />' % (i, i, i + 10, i + 20, i))
+    svg.append('</svg>')
+    return "\n".join(svg) + "\n"
+
+
+def create_synthetic_library(folder,
+                             parts=1000,
+                             generators=2,
+                             alias_fanout=10,
+                             drawing_lines=1000):
+    r"""Create a synthetic parts library template
+
+    Parameters
+    ----------
+    folder : str
+        Folder of the library. It is created if it does not exist
+    parts : int, optional (default is 1000)
+        Number of parts in the 'data' section
+    generators : int, optional (default is 2)
+        Number of generators, used in turn by the parts
+    alias_fanout : int, optional (default is 10)
+        Number of parts referring to the same size alias
+    drawing_lines : int, optional (default is 1000)
+        Number of lines of the SVG drawing embedded in the library
+
+    Returns
+    -------
+    str : path to the library template
+
+    """
+    create_folder(folder)
+    generators_folder = join(folder, "generators")
+    drawings_folder = join(folder, "drawings")
+    create_folder(generators_folder)
+    create_folder(drawings_folder)
+
+    for index in range(generators):
+        with open(join(generators_folder,
+                       "synthetic_%i.py" % index), 'w') as generator_file:
+            generator_file.write("\n".join(GENERATOR) % {"index": index})
+
+    with open(join(drawings_folder, "synthetic.svg"), 'w') as drawing_file:
+        drawing_file.write(_svg_drawing(drawing_lines))
+
+    # Each size alias refers to a nested alias, like the threading and grade
+    # aliases of the fasteners libraries
+    sizes = (parts + alias_fanout - 1) // alias_fanout
+    aliases = dict()
+    for size in range(sizes):
+        aliases["S%i" % size] = {"generics": "__alias__S%i_generics" % size,
+                                 "radius": 1. + size}
+        aliases["S%i_generics" % size] = {"head_radius": 2. + size}
+
+    data = dict()
+    for index in range(parts):
+        size = index // alias_fanout
+        data["template_part_%i" % index] = {
+            "description": "Synthetic part %i" % index,
+            "generator": "synthetic_%i" % (index % generators),
+            "size": "__alias__S%i" % size,
+            "length": 10. + size + index % alias_fanout}
+
+    metadata = {"name": "synthetic-library-%i" % parts,
+                "description": "Synthetic parts library",
+                "nomenclature": "'SYN_' + size + 'x' + str(length)",
+                "units": {"length": ["mm", ["radius", "length",
+                                            "head_radius"]],
+                          "dimensionless": ["", ["size", "generics"]]},
+                "authors": ["benchmarks"],
+                "license": "GPL v3"}
+
+    # The template is JSON with Jinja tags : the sections are serialized one
+    # by one around the tags
+    template_path = join(folder, "library_template.json")
+    with open(template_path, 'w') as template:
+        template.write('{\n')
+        template.write('  "metadata": %s,\n' % json.dumps(metadata))
+        template.write('  "generators":\n    { {{ generators }} },\n')
+        template.write('  "rules": %s,\n' % json.dumps(RULES))
+        template.write('  "aliases": %s,\n' % json.dumps(aliases, indent=2))
+        template.write('  "data": %s,\n' % json.dumps(data, indent=2))
+        template.write('  "drawings":\n    { {{ drawings }} }\n')
+        template.write('}\n')
+
+    return template_path
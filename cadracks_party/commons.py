@@ -43,7 +43,7 @@ def mkdir_p(path):
     try:
         makedirs(path)
     except OSError as exc:  # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
+        if exc.errno == errno.EEXIST and isdir(path):
             pass
         else:
             raise
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2018-2019 Guillaume Florent, Thomas Paviot, Bernard Uguen
+
+# This file is part of cadracks-party.
+#
+# cadracks-party is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# cadracks-party is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cadracks-party.  If not, see <https://www.gnu.org/licenses/>.
+
+r"""library_archive.py module
+
+Single file archives of the files generated from a PJSON file
+
+Two archive formats are supported, depending on the archive file name :
+
+- .zip : the artifacts of a part can be read without reading the other ones
+- .tar.zst : better compression, requires the zstandard package. The
+  archive is a stream : reading the artifacts of a part decompresses the
+  archive up to these artifacts, but nothing is written to disk
+
+In both formats, an index.json member lists the artifacts of every part
+(key: part id; value: dict with key: kind ('script', 'step', 'stl' ...),
+value: member name) and of every drawing (key: drawing id, value: member
+name)
+
+"""
+
+import io
+import json
+import tarfile
+import zipfile
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_MEMBER = "index.json"
+
+# tar.zst members carry the part id and the artifact kind in PAX headers so
+# that an artifact can be found without reading the index at the end
+_PAX_PART_ID = "party.part_id"
+_PAX_KIND = "party.kind"
+
+
+def _archive_format(filename):
+    if filename.endswith(".zip"):
+        return "zip"
+    elif filename.endswith(".tar.zst"):
+        if zstandard is None:
+            msg = "The zstandard package is required for .tar.zst archives"
+            logger.error(msg)
+            raise ImportError(msg)
+        return "tar.zst"
+    else:
+        msg = "Unknown archive format for %s (use .zip or .tar.zst)" % \
+              filename
+        logger.error(msg)
+        raise ValueError(msg)
+
+
+class LibraryArchiveWriter(object):
+    r"""Writes generated artifacts to a single archive file
+
+    Parameters
+    ----------
+    filename : str
+        Path to the archive (.zip or .tar.zst)
+
+    Raises
+    ------
+    ValueError if the archive format is unknown
+    ImportError if zstandard is not installed for a .tar.zst archive
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._format = _archive_format(filename)
+        self._index = {"parts": dict(), "drawings": dict()}
+
+        if self._format == "zip":
+            self._zip = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            self._stream = zstandard.ZstdCompressor().\
+                stream_writer(open(filename, 'wb'))
+            self._tar = tarfile.open(fileobj=self._stream, mode='w|',
+                                     format=tarfile.PAX_FORMAT)
+
+    def _add(self, member_name, content, pax_headers=None):
+        if self._format == "zip":
+            self._zip.writestr(member_name, content)
+        else:
+            tar_info = tarfile.TarInfo(member_name)
+            tar_info.size = len(content)
+            if pax_headers is not None:
+                tar_info.pax_headers = pax_headers
+            self._tar.addfile(tar_info, io.BytesIO(content))
+
+    def add_artifact(self, part_id, kind, member_name, content):
+        r"""Add an artifact of a part
+
+        Parameters
+        ----------
+        part_id : str
+        kind : str
+            Kind of artifact (e.g. 'script', 'step', 'stl')
+        member_name : str
+            Name of the artifact in the archive
+        content : bytes
+
+        """
+        member_name = member_name.replace("\\", "/")
+        self._add(member_name, content,
+                  {_PAX_PART_ID: part_id, _PAX_KIND: kind})
+        self._index["parts"].setdefault(part_id, dict())[kind] = member_name
+
+    def add_artifact_file(self, part_id, kind, member_name, path):
+        r"""Add an artifact of a part from a file
+
+        Parameters
+        ----------
+        part_id : str
+        kind : str
+        member_name : str
+        path : str
+            Path to the file to add
+
+        """
+        with open(path, 'rb') as f:
+            self.add_artifact(part_id, kind, member_name, f.read())
+
+    def add_drawing(self, drawing_id, member_name, content):
+        r"""Add a drawing
+
+        Parameters
+        ----------
+        drawing_id : str
+        member_name : str
+        content : bytes
+
+        """
+        member_name = member_name.replace("\\", "/")
+        self._add(member_name, content, {_PAX_KIND: "drawing"})
+        self._index["drawings"][drawing_id] = member_name
+
+    def close(self):
+        r"""Write the index and close the archive"""
+        self._add(INDEX_MEMBER,
+                  json.dumps(self._index, sort_keys=True,
+                             indent=2).encode("utf-8"))
+        if self._format == "zip":
+            self._zip.close()
+        else:
+            self._tar.close()
+            self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _iter_tar_zst(filename):
+    r"""Iterate over the (TarInfo, file object) of a .tar.zst archive"""
+    with open(filename, 'rb') as f:
+        stream = zstandard.ZstdDecompressor().stream_reader(f)
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for tar_info in tar:
+                yield tar_info, tar.extractfile(tar_info)
+
+
+def archive_index(filename):
+    r"""Index of an archive written by LibraryArchiveWriter
+
+    Parameters
+    ----------
+    filename : str
+        Path to the archive (.zip or .tar.zst)
+
+    Returns
+    -------
+    dict : {"parts": {part_id: {kind: member_name}},
+            "drawings": {drawing_id: member_name}}
+
+    """
+    if _archive_format(filename) == "zip":
+        with zipfile.ZipFile(filename) as zip_file:
+            return json.loads(zip_file.read(INDEX_MEMBER).decode("utf-8"))
+    else:
+        for tar_info, member in _iter_tar_zst(filename):
+            if tar_info.name == INDEX_MEMBER:
+                return json.loads(member.read().decode("utf-8"))
+        msg = "No index in %s" % filename
+        logger.error(msg)
+        raise KeyError(msg)
+
+
+def read_artifact(filename, part_id, kind="script"):
+    r"""Read an artifact of a part from an archive, without extracting the
+    other artifacts
+
+    Parameters
+    ----------
+    filename : str
+        Path to the archive (.zip or .tar.zst)
+    part_id : str
+    kind : str, optional (default is 'script')
+        Kind of artifact (e.g. 'script', 'step', 'stl')
+
+    Returns
+    -------
+    bytes : the content of the artifact
+
+    Raises
+    ------
+    KeyError if the archive contains no such artifact
+
+    """
+    if _archive_format(filename) == "zip":
+        with zipfile.ZipFile(filename) as zip_file:
+            index = json.loads(zip_file.read(INDEX_MEMBER).decode("utf-8"))
+            member_name = index["parts"][part_id][kind]
+            return zip_file.read(member_name)
+    else:
+        for tar_info, member in _iter_tar_zst(filename):
+            if tar_info.pax_headers.get(_PAX_PART_ID) == part_id and \
+                    tar_info.pax_headers.get(_PAX_KIND) == kind:
+                return member.read()
+        msg = "No %s for %s in %s" % (kind, part_id, filename)
+        logger.error(msg)
+        raise KeyError(msg)
@@ -20,132 +20,210 @@
 
 r"""Parts library checks"""
 
-import sys
-import json
+import hashlib
 import logging
 
-if sys.version_info[0] < 3:
-    PY2 = True
-else:
-    PY2 = False
+from cadracks_party.library_reader import LibraryReader, LibraryDocument, \
+    as_library, index_units, iter_raw_items
+from cadracks_party.rules import compile_rules, rules_timings, \
+    iter_broken_rules, iter_broken_rules_vectorized, numpy_available, \
+    unknown_rule_names, RuleMemo
+from cadracks_party.validation_cache import validation_key
 
 logger = logging.getLogger(__name__)
 
 
-def check_library_json_rules(json_filename):
+def _error_budget(fail_fast, max_errors):
+    r"""Number of errors after which a check stops, None for no limit"""
+    if max_errors is not None and max_errors < 1:
+        msg = "max_errors should be at least 1"
+        logger.error(msg)
+        raise ValueError(msg)
+    if fail_fast:
+        return 1
+    return max_errors
+
+
+def check_library_json_rules(json_filename,
+                             timings=None,
+                             vectorized=None,
+                             cache=None,
+                             unknown_names=None,
+                             fail_fast=False,
+                             max_errors=None):
     r"""Check that the entries in the 'data' field of a library respect the
     rules defined in the 'rules' field of the library
 
+    Each rule is compiled once and evaluated with the values of each part
+    as its namespace. The result of a rule is memoized on the values of the
+    fields it reads, so it is evaluated once for all the parts sharing these
+    values
+
     Parameters
     ----------
-    json_filename : str
-        Path to the JSON file that describes the parts library
+    json_filename : str or LibraryReader
+        Path to the JSON file that describes the parts library, or the
+        library already opened as a LibraryReader or a LibraryDocument
+    timings : dict, optional
+        If provided, it is filled with the total evaluation time of each rule
+        (key: rule; value: time in seconds)
+    vectorized : bool, optional
+        Evaluate the numeric rules over all parts at once with NumPy (the
+        results are the same). The default is to do so if NumPy is
+        installed, unless the check may stop early (fail_fast or max_errors).
+        The parts are then read and evaluated by blocks of rules.BLOCK_SIZE
+        parts
+    cache : ValidationCache, optional
+        If provided, the memoized results of the rules are also read from and
+        stored to the cache : a rule is evaluated again only for the parts
+        where a field it reads changed. The caller saves the cache
+    unknown_names : dict, optional
+        If provided, it is filled with the names used by the rules that are
+        neither builtins nor fields of the library, i.e. fields defined in
+        the units or fields of the first part (key: rule; value: list of
+        names). These names are reported before any part is evaluated; the
+        parts will break these rules (NameError)
+    fail_fast : bool, optional (default is False)
+        Stop at the first broken rule
+    max_errors : int, optional (default is None)
+        Stop after this number of broken rules. None means no limit
 
     Returns
     -------
     tuple(bool, errors)
         bool : True if the library is OK, False otherwise
-        errors : dict (keys: part_identifier, values: list of broken rules)
+        errors : dict (keys: part_identifier, values: list of broken rules).
+                 Only the errors found before stopping if the check stopped
+                 early
 
     Raises
     ------
-    NameError if the rules definition contain wrong identifiers
     SyntaxError if there is a syntax error in the rules definition
+    ImportError if vectorized is True and NumPy is not installed
 
     """
-    with open(json_filename) as data_file:
-        json_file_content = json.load(data_file)
+    budget = _error_budget(fail_fast, max_errors)
+
+    library = as_library(json_filename)
 
     library_ok = True
     errors = dict()
-
-    string_types = (unicode, str) if PY2 else str
-
-    for part_id, part_values in json_file_content["data"].items():
-        # assign the values to a Python variable with the same name
-        for dict_entry_key, dict_entry_value in part_values.items():
-            # if type(dict_entry_value) not in [unicode, str]:
-            # if not isinstance(dict_entry_value, (unicode, str)):
-
-            if not isinstance(dict_entry_value, string_types):
-                instruction = "%s = %s" % (dict_entry_key, dict_entry_value)
-            else:
-                instruction = "%s = '%s'" % (dict_entry_key, dict_entry_value)
-            exec(instruction)
-
-        for rule in json_file_content["rules"]:
-            # instruction = "bool_ = %s" % rule
-            # logger.info("Checking '%s' for part %s" % (rule, part_id))
-            try:
-                if PY2:
-                    instruction = "bool_ = %s" % rule
-                    exec(instruction)
-                else:
-                    bool_ = eval(rule)
-
-                if bool_ is True:
-                    # logger.info("OK")
-                    pass
-                else:
-                    library_ok = False
-                    if part_id not in errors.keys():
-                        errors[part_id] = list()
-                    errors[part_id].append(rule)
-                    logger.error("Library data definition error")
-            except NameError:
-                library_ok = False
-                if part_id not in errors.keys():
-                    errors[part_id] = list()
-                errors[part_id].append(rule)
-                logger.error("Rules definition error (NameError)")
+    errors_count = 0
+
+    compiled_rules = compile_rules(library.rules)
+
+    # the fields of the first part also count for the libraries whose units
+    # do not list the fields
+    fields = set(library.units_index.keys()) | {"description", "generator"}
+    for _, part_values in library.iter_data():
+        fields |= set(part_values.keys())
+        break
+    unknown = unknown_rule_names(compiled_rules, fields)
+    for rule, names in unknown.items():
+        logger.error("Rule '%s' uses unknown name(s) : %s" %
+                     (rule, ", ".join(names)))
+    if unknown_names is not None:
+        unknown_names.update(unknown)
+
+    memo = RuleMemo(cache)
+
+    if vectorized is None:
+        # the vectorized evaluation goes through a whole block of parts first
+        vectorized = numpy_available() and budget is None
+    if vectorized:
+        broken_rules = iter_broken_rules_vectorized(compiled_rules,
+                                                    library.iter_data(),
+                                                    memo)
+    else:
+        broken_rules = iter_broken_rules(compiled_rules, library.iter_data(),
+                                         memo)
+
+    for part_id, rule, name_error in broken_rules:
+        library_ok = False
+        errors.setdefault(part_id, list()).append(rule)
+        if name_error:
+            logger.error("Rules definition error (NameError)")
+        else:
+            logger.error("Library data definition error")
+        errors_count += 1
+        if budget is not None and errors_count >= budget:
+            logger.info("Rules check stopped after %i error(s)" %
+                        errors_count)
+            break
+
+    for compiled_rule in compiled_rules:
+        logger.debug("Rule '%s' : %i evaluation(s) in %.6f s" %
+                     (compiled_rule.rule,
+                      compiled_rule.evaluations,
+                      compiled_rule.elapsed))
+    if timings is not None:
+        timings.update(rules_timings(compiled_rules))
 
     return library_ok, errors
 
 
-def check_library_units_definition(json_filename):
+def check_library_units_definition(json_filename,
+                                   fail_fast=False,
+                                   max_errors=None):
     r"""Test that each field of a data entry is referenced in the 'units'
     section of the library.json file
 
     Parameters
     ----------
-    json_filename : str
-        Path to the JSON file that describes the parts library
+    json_filename : str or LibraryReader
+        Path to the JSON file that describes the parts library, or the
+        library already opened as a LibraryReader or a LibraryDocument
+    fail_fast : bool, optional (default is False)
+        Stop at the first error
+    max_errors : int, optional (default is None)
+        Stop after this number of errors. None means no limit
 
     Returns
     -------
     tuple(bool, errors)
         bool : True if the library is OK, False otherwise
-        errors : dict (keys: part_identifier, values: list of broken rules)
+        errors : dict (keys: part_identifier, values: list of broken rules).
+                 Only the errors found before stopping if the check stopped
+                 early
 
     """
+    budget = _error_budget(fail_fast, max_errors)
 
     library_ok = True
     errors = dict()
+    errors_count = 0
 
-    fields = list()
+    fields = set()
 
-    with open(json_filename) as data_file:
-        json_file_content = json.load(data_file)
+    library = as_library(json_filename)
 
-    for unit, definition in json_file_content["metadata"]["units"].items():
+    for unit, definition in library.metadata["units"].items():
         try:
             for field in definition[1]:
                 if field not in fields:
-                    fields.append(field)
+                    fields.add(field)
                 else:
                     library_ok = False
                     if "units definition" not in errors.keys():
                         errors["units definition"] = list()
                     errors["units definition"].append("field '%s' is duplicated" % str(field))
+                    errors_count += 1
+                    if budget is not None and errors_count >= budget:
+                        return library_ok, errors
         except IndexError:
             library_ok = False
             if "units definition" not in errors.keys():
                         errors["units definition"] = list()
             errors["units definition"].append("Improperly defined units : %s " % str(unit))
+            errors_count += 1
+            if budget is not None and errors_count >= budget:
+                return library_ok, errors
 
-    for part_id, part_values in json_file_content["data"].items():
+    units_index = library.units_index
+
+    for part_id, part_values in library.iter_data():
         for dict_entry_key in part_values.keys():
-            if dict_entry_key in fields or \
+            if dict_entry_key in units_index or \
                             dict_entry_key in ["description", "generator"]:
                 pass
             else:
@@ -154,54 +232,56 @@ def check_library_units_definition(json_filename):
                     errors[part_id] = list()
                 errors[part_id].append("field '%s' not defined in units" % dict_entry_key)
                 logger.error("Library data definition error")
+                errors_count += 1
+                if budget is not None and errors_count >= budget:
+                    logger.info("Units check stopped after %i error(s)" %
+                                errors_count)
+                    return library_ok, errors
 
     return library_ok, errors
 
 
-def check_library_fields(json_filename):
+def check_library_fields(json_filename, fail_fast=False, max_errors=None):
     r"""Check that every entry in the 'data' section if the library JSON
     file has the same fields (order does not matter)
 
     Parameters
     ----------
-    json_filename : str
-        Path to the JSON file that describes the parts library
+    json_filename : str or LibraryReader
+        Path to the JSON file that describes the parts library, or the
+        library already opened as a LibraryReader or a LibraryDocument
+    fail_fast : bool, optional (default is False)
+        Stop at the first part whose fields differ from the reference set.
+        The reference set of fields still requires a pass over all the parts
+        (it is cached by LibraryReader and LibraryDocument)
+    max_errors : int, optional (default is None)
+        Stop after this number of parts with different fields.
+        None means no limit
 
     Returns
     -------
     tuple(bool, errors, set_)
         bool : True if the library is OK, False otherwise
-        errors : dict (keys: part_identifier, values: list of broken rules)
+        errors : dict (keys: part_identifier, values: list of broken rules).
+                 Only the errors found before stopping if the check stopped
+                 early
         set_ : reference set of fields
 
     """
+    budget = _error_budget(fail_fast, max_errors)
+
     library_ok = True
     errors = dict()
 
-    reference_set_of_fields = set()
-
-    with open(json_filename) as data_file:
-        json_file_content = json.load(data_file)
+    library = as_library(json_filename)
 
-    # Populate the reference set of fields
-    feed = True  # Hackish way to only consider the first dictionary entry
-
-    # Issue #7
-    # test_missing_field : check_library_fields
-    # finds 8 reference fields (10 expected)
-    # The determination of the set of reference fields must be deterministic
-    # This is why the data items are sorted
-    for part_id, part_values in sorted(json_file_content["data"].items()):
-        if feed is True:
-            for dict_entry_key in part_values.keys():
-                reference_set_of_fields.add(dict_entry_key)
-        feed = False
+    reference_set_of_fields = set(library.reference_fields)
 
     logger.info("Reference set of fields : %s" % str(reference_set_of_fields))
 
     # Check the set of fields in the data section
     # against the reference set of fields
-    for part_id, part_values in json_file_content["data"].items():
+    for part_id, part_values in library.iter_data():
         current_set_of_fields = set()
         for dict_entry_key in part_values.keys():
             current_set_of_fields.add(dict_entry_key)
@@ -213,29 +293,336 @@ def check_library_fields(json_filename):
             current_minus_ref = current_set_of_fields.difference(reference_set_of_fields)
             ref_minus_current = reference_set_of_fields.difference(current_set_of_fields)
             errors[part_id] = current_minus_ref.union(ref_minus_current)
+            if budget is not None and len(errors) >= budget:
+                logger.info("Fields check stopped after %i error(s)" %
+                            len(errors))
+                break
 
     return library_ok, errors, reference_set_of_fields
 
 
-def check_all(json_filename):
-    r"""Perform every possible test on the library
+_DUPLICATE_MESSAGES = {"data": "duplicate part id '%s'",
+                       "aliases": "duplicate alias '%s'",
+                       "generators": "duplicate generator id '%s'"}
+
+
+def _digest(key):
+    return hashlib.sha1(key.encode("utf-8")).digest()
+
+
+def check_library_stream(json_filename, fail_fast=False, max_errors=None):
+    r"""Validate a library in a single pass over the raw file
+
+    The pass finds what json.load() hides (duplicate part ids, alias keys,
+    generator ids and top level sections) and checks the fields of the parts
+    while they are read : every part has the same set of fields (the fields
+    of the first part in part id order, like check_library_fields()) and
+    every field has a unit (like check_library_units_definition()).
+
+    Each part is parsed on its own and dropped once checked : what is kept
+    per part is a digest of its id, and its id in the group of the parts
+    that share its set of fields
 
     Parameters
     ----------
     json_filename : str
         Path to the JSON file that describes the parts library
+    fail_fast : bool, optional (default is False)
+        Stop at the first error
+    max_errors : int, optional (default is None)
+        Stop after this number of errors. None means no limit
 
     Returns
     -------
     tuple(bool, errors)
         bool : True if the library is OK, False otherwise
-        errors : dict (keys: part_identifier, values: list of broken rules)
+        errors : dict (key: 'duplicates' or part_identifier; values: list of
+                 error messages)
+
+    Raises
+    ------
+    ValueError if the file is not valid JSON
 
     """
+    budget = _error_budget(fail_fast, max_errors)
+
+    errors = dict()
+    errors_count = [0]
+
+    def add_error(key, message):
+        r"""Returns True if the error budget is spent"""
+        logger.error("%s : %s" % (key, message))
+        errors.setdefault(key, list()).append(message)
+        errors_count[0] += 1
+        return budget is not None and errors_count[0] >= budget
+
+    seen = dict((section_name, set()) for section_name in
+                ["sections"] + list(_DUPLICATE_MESSAGES.keys()))
+    fields_with_units = None
+
+    # key: digest of a set of fields; value: [set of fields, part ids,
+    # fields without units (None until the units are known)]
+    field_sets = dict()
+    # first part in part id order, and the digest of its set of fields
+    reference_part_id = None
+    reference_digest = None
+    # parts read before the metadata : (part id, digest of its set of fields)
+    parts_before_units = list()
+
+    def add_units_errors(part_id, fields_without_units):
+        for field in fields_without_units:
+            if add_error(part_id, "field '%s' not defined in units" % field):
+                return True
+        return False
+
+    for section_name, key, value in iter_raw_items(json_filename):
+        if key is None:
+            if _digest(section_name) in seen["sections"]:
+                if add_error("duplicates",
+                             "duplicate section '%s'" % section_name):
+                    return False, errors
+            seen["sections"].add(_digest(section_name))
+            if section_name == "metadata" and fields_with_units is None:
+                fields_with_units = set(index_units(value["units"])) | \
+                                    {"description", "generator"}
+            continue
+
+        key_digest = _digest(key)
+        if key_digest in seen[section_name]:
+            if add_error("duplicates",
+                         _DUPLICATE_MESSAGES[section_name] % key):
+                return False, errors
+            continue
+        seen[section_name].add(key_digest)
+
+        if section_name == "data":
+            fields = frozenset(value.keys())
+            fields_digest = _digest("\n".join(sorted(fields)))
+            if fields_digest not in field_sets:
+                field_sets[fields_digest] = [fields, list(), None]
+            field_set = field_sets[fields_digest]
+            field_set[1].append(key)
+            if reference_part_id is None or key < reference_part_id:
+                reference_part_id = key
+                reference_digest = fields_digest
+
+            # the units of a set of fields are checked once. The parts read
+            # before the metadata are checked at the end
+            if fields_with_units is None:
+                parts_before_units.append((key, fields_digest))
+            else:
+                if field_set[2] is None:
+                    field_set[2] = sorted(fields - fields_with_units)
+                if add_units_errors(key, field_set[2]):
+                    return False, errors
+
+    if fields_with_units is None:
+        fields_with_units = set()
+        if add_error("units definition", "no metadata"):
+            return False, errors
+    for part_id, fields_digest in parts_before_units:
+        field_set = field_sets[fields_digest]
+        if field_set[2] is None:
+            field_set[2] = sorted(field_set[0] - fields_with_units)
+        if add_units_errors(part_id, field_set[2]):
+            return False, errors
+
+    for fields_digest, (fields, part_ids, _) in field_sets.items():
+        if fields_digest == reference_digest:
+            continue
+        reference_fields = field_sets[reference_digest][0]
+        message = "fields differ from the reference set of fields : %s" % \
+                  ", ".join(sorted(fields.symmetric_difference(
+                      reference_fields)))
+        for part_id in part_ids:
+            if add_error(part_id, message):
+                return False, errors
+
+    return len(errors) == 0, errors
+
+
+class _PartsSubset(LibraryReader):
+    r"""View of a library restricted to some of its parts
+
+    The reference set of fields is the one of the whole library
+
+    Parameters
+    ----------
+    library : LibraryReader
+    parts : list of tuple(part_id, dict)
+
+    """
+    def __init__(self, library, parts):
+        super(_PartsSubset, self).__init__(library.json_filename)
+        self._library = library
+        self._parts = parts
+
+    def sections(self):
+        return self._library.sections()
+
+    def __contains__(self, section_name):
+        return section_name in self._library
+
+    def section(self, section_name):
+        return self._library.section(section_name)
+
+    def iter_items(self, section_name):
+        if section_name == "data":
+            return iter(self._parts)
+        return self._library.iter_items(section_name)
+
+    @property
+    def reference_fields(self):
+        return self._library.reference_fields
+
+    @property
+    def units_index(self):
+        return self._library.units_index
+
+
+def _check_all_cached(library, cache, budget):
+    r"""Checks of check_all(), the results of the parts being read from the
+    cache or checked and stored in the cache
+
+    The results of the rules are cached per rule, on the values of the fields
+    it reads (see check_library_json_rules()). The results of the units and
+    fields checks are cached per part, on the fields of the part
+
+    The error budget is shared by the checks, like in check_all()
+
+    """
+    ok_rules, errors_rules = check_library_json_rules(library, cache=cache,
+                                                      max_errors=budget)
+    budget = _remaining_budget(budget, errors_rules)
+    if budget == 0:
+        cache.log_counts()
+        return ok_rules, errors_rules, None, dict(), None, dict()
+
+    units = library.metadata["units"]
+    reference_fields = sorted(library.reference_fields)
+
+    keys = list()  # (part_id, key), in part order
+    cached = dict()
+    to_check = list()
+    for part_id, part_values in library.iter_data():
+        key = validation_key("fields", sorted(part_values.keys()), units,
+                             reference_fields)
+        keys.append((part_id, key))
+        result = cache.get(key)
+        if result is None:
+            to_check.append((part_id, part_values))
+        else:
+            cached[part_id] = result
+
+    subset = _PartsSubset(library, to_check)
+    _, errors_units_checked = check_library_units_definition(subset)
+    _, errors_fields_checked, _ = check_library_fields(subset)
+
+    errors_units = dict()
+    errors_fields = dict()
+    errors_count = 0
+    if "units definition" in errors_units_checked:
+        errors_units["units definition"] = \
+            errors_units_checked["units definition"]
+        errors_count += len(errors_units["units definition"])
+
+    for part_id, key in keys:
+        if budget is not None and errors_count >= budget:
+            break
+        if part_id in cached:
+            result = cached[part_id]
+        else:
+            result = {"units": errors_units_checked.get(part_id, list()),
+                      "fields": sorted(errors_fields_checked.get(part_id,
+                                                                 set()))}
+            cache.set(key, result)
+        if len(result["units"]) > 0:
+            errors_units[part_id] = list(result["units"])
+            errors_count += len(result["units"])
+        if len(result["fields"]) > 0:
+            errors_fields[part_id] = set(result["fields"])
+            errors_count += 1
+
+    cache.log_counts()
+
+    return (ok_rules, errors_rules,
+            len(errors_units) == 0, errors_units,
+            len(errors_fields) == 0, errors_fields)
+
+
+def _remaining_budget(budget, errors):
+    r"""Error budget left after a check that found errors (a dict whose values
+    are lists of errors, or sets of fields for check_library_fields())"""
+    if budget is None:
+        return None
+    if any(isinstance(value, set) for value in errors.values()):
+        spent = len(errors)
+    else:
+        spent = sum(len(value) for value in errors.values())
+    return max(budget - spent, 0)
+
+
+def check_all(json_filename, cache=None, fail_fast=False, max_errors=None):
+    r"""Perform every possible test on the library
+
+    Parameters
+    ----------
+    json_filename : str or LibraryReader
+        Path to the JSON file that describes the parts library, or the
+        library already opened as a LibraryReader or a LibraryDocument
+    cache : ValidationCache, optional
+        If provided, the checks whose inputs did not change since their
+        results were stored in the cache are not run again : a rule for the
+        values of the fields it reads, the units and fields checks for the
+        fields of a part, given the units and the reference set of fields.
+        The results of the other checks are stored in the cache. The caller
+        saves the cache
+    fail_fast : bool, optional (default is False)
+        Stop at the first error
+    max_errors : int, optional (default is None)
+        Stop after this number of errors, counted over all the checks.
+        None means no limit. When the checks may stop early, a library given
+        by its file name is read incrementally instead of being parsed
+        first, so that a broken library is rejected without a full pass
+
+    Returns
+    -------
+    tuple(list, list)
+        list : [rules ok, units ok, fields ok], each one True if the check
+               passed, False if it did not and None if it was not run
+               because the error budget was spent by the previous checks
+        list : errors of the rules, units and fields checks (see
+               check_library_json_rules(), check_library_units_definition()
+               and check_library_fields())
+
+    """
+    budget = _error_budget(fail_fast, max_errors)
+
+    library = json_filename
+    if budget is None and not isinstance(library, LibraryDocument):
+        # The file is parsed once for all the checks
+        library = LibraryDocument(as_library(library).json_filename)
+    else:
+        library = as_library(library)
+    json_filename = library.json_filename
+
     logger.info("Checking the library %s  ..." % json_filename)
-    ok_rules, errors_rules = check_library_json_rules(json_filename)
-    ok_units, errors_units = check_library_units_definition(json_filename)
-    ok_fields, errors_fields, _ = check_library_fields(json_filename)
+    if cache is None:
+        ok_units, errors_units = None, dict()
+        ok_fields, errors_fields = None, dict()
+        ok_rules, errors_rules = check_library_json_rules(library,
+                                                          max_errors=budget)
+        budget = _remaining_budget(budget, errors_rules)
+        if budget != 0:
+            ok_units, errors_units = check_library_units_definition(
+                library, max_errors=budget)
+            budget = _remaining_budget(budget, errors_units)
+        if budget != 0:
+            ok_fields, errors_fields, _ = check_library_fields(
+                library, max_errors=budget)
+    else:
+        ok_rules, errors_rules, ok_units, errors_units, ok_fields, \
+            errors_fields = _check_all_cached(library, cache, budget)
 
     ok = all(list_element is True for list_element in [ok_rules, ok_units, ok_fields])
 
@@ -24,23 +24,27 @@ library.json file from standard templates
 Currently implemented:
 
 - alias mechanism : replace aliases by the values they refer to
+- include mechanism : the aliases defined in shared files (e.g. the thread
+tables of several standards) are added to the aliases of the template
 - generator code : replace the {{ generators }} tag in the template by the code
 found in the generators subdirectory
 - drawings : the {{ drawings }} tag is replaced by the content of svg files
 in the drawings subdirectory
 
-Every function has a file_in and a file_out parameter that can be used by
-the specific library.json creation routines as required
+Each mechanism is a transformation of the library content in memory
+(handle_tags(), handle_aliases(), handle_nomenclature()) : autocreate_library()
+chains them and only writes the final library.json. The template_handle_*
+functions have a file_in and a file_out parameter that can be used by the
+specific library.json creation routines as required
 
 """
 
 import sys
 import json
 import codecs
-from os import remove, listdir
-from os.path import join, dirname, basename, splitext
+from os import listdir, stat
+from os.path import join, dirname, basename, splitext, abspath
 import logging
-import copy
 # from ast import literal_eval
 
 from collections import OrderedDict
@@ -56,6 +60,13 @@ else:
 
 logger = logging.getLogger(__name__)
 
+# Prefix of the values that refer to an alias
+_ALIAS_PREFIX = "__alias__"
+
+# Parsed include files, shared by all the libraries created by the process
+# key: absolute path; value: ((modification time in ns, size), aliases)
+_includes_cache = dict()
+
 
 def create_skeleton(base_folder):
     r"""Create a skeleton for a parts library project
@@ -250,7 +261,8 @@ def autocreate_library(template_file,
     library_file_name : str, optional (default is 'library.json')
         Name of the final library file
     delete_intermediate : bool, optional (default is True)
-        Should the intermediate files for library creation be deleted
+        Ignored, kept for compatibility : the template is processed in
+        memory and no intermediate file is written
 
     """
     logger.info("Creating the library %s from its template ..." %
@@ -266,46 +278,117 @@ def autocreate_library(template_file,
                 str(info["drawings"]))
     logger.info("template file has aliases : %s" % str(info["aliases"]))
 
-    template_folder = dirname(template_file)
-
-    # funcs pipeline contains the functions that should be called to create
-    # the PJSON file from its template
-    funcs_pipeline = list()
     if info["generators"] is True or info["drawings"] is True:
-        funcs_pipeline.append(template_handle_tags)
-    if info["aliases"]:
-        funcs_pipeline.append(template_handle_aliases)
-
-    for i, func in enumerate(funcs_pipeline):
-        # last operation
-        # can also be the first of there is only one
-        if i == len(funcs_pipeline) - 1:
-            if i == 0:
-                input_ = template_file
-            else:
-                input_ = join(template_folder, "tmp_%i.json" % (i-1))
-            func(input_, library_file_name)
-            if delete_intermediate is True and i != 0:
-                remove(join(template_folder, "tmp_%i.json" % (i-1)))
-        # first operation
-        # ignored if there is only one, it is handle in the first condition
-        elif i == 0:
-            func(template_file, join(template_folder, "tmp_0.json"))
-        # any operation in between the first and the last
-        else:
-            func(join(template_folder, "tmp_%i.json" % (i - 1)),
-                 join(template_folder, "tmp_%i.json" % i))
-            if delete_intermediate is True:
-                remove(join(template_folder, "tmp_%i.json" % (i - 1)))
+        json_content = handle_tags(template_file)
+    else:
+        with open(template_file) as fi:
+            json_content = json.load(fi, object_pairs_hook=OrderedDict)
+    logger.info("template file has includes : %s" %
+                str("includes" in json_content))
+    if "includes" in json_content:
+        json_content = handle_includes(json_content, dirname(template_file))
+        json_content = handle_aliases(json_content)
+    elif info["aliases"]:
+        json_content = handle_aliases(json_content)
 
     # Do in any case ...
-    template_handle_nomenclature(library_file_name, library_file_name)
+    json_content = handle_nomenclature(json_content)
+
+    _write_library(json_content, library_file_name)
 
     logger.info("...done")
 
 
+def _read_include(include_file):
+    r"""Aliases defined in an include file
+
+    The file is only read and parsed again if its modification time (in ns)
+    or its size changed since it was last read by the process
+
+    Parameters
+    ----------
+    include_file : str
+        Path to a JSON file defining aliases (key: alias name; value: dict)
+
+    Returns
+    -------
+    OrderedDict, shared by the callers : it must not be modified
+
+    Raises
+    ------
+    ValueError if the file does not define aliases
+
+    """
+    path = abspath(include_file)
+    stat_result = stat(path)
+    # the size catches the rewrites within the resolution of the clock
+    signature = (stat_result.st_mtime_ns, stat_result.st_size)
+    cached = _includes_cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    logger.debug("Reading the include file %s" % path)
+    with open(path) as fi:
+        aliases = json.load(fi, object_pairs_hook=OrderedDict)
+    if not isinstance(aliases, dict) or \
+            not all(isinstance(value, dict) for value in aliases.values()):
+        msg = "The include file %s does not define aliases" % path
+        logger.error(msg)
+        raise ValueError(msg)
+    _includes_cache[path] = (signature, aliases)
+    return aliases
+
+
+def clear_includes_cache():
+    r"""Forget the include files read by the process"""
+    _includes_cache.clear()
+
+
+def handle_includes(json_content, template_folder):
+    r"""Add the aliases defined in the include files of a library content to
+    its aliases
+
+    The 'includes' section is a list of paths (relative to the template
+    folder) to JSON files defining aliases, e.g.
+    {"M1.6_generics": {"p": 0.35, ...}, ...}. An alias defined in the
+    template overrides an included alias with the same name, and an alias
+    of an include file overrides the aliases with the same name in the
+    include files listed before it
+
+    Each include file is read and parsed once per process, whatever the
+    number of templates including it (unless it is modified)
+
+    Parameters
+    ----------
+    json_content : OrderedDict
+        Content of a template using includes. It is modified in place
+    template_folder : str
+        Folder of the template
+
+    Returns
+    -------
+    OrderedDict : json_content, without its includes section
+
+    Raises
+    ------
+    IOError if an include file does not exist
+    ValueError if an include file does not define aliases
+
+    """
+    aliases = OrderedDict()
+    for include_file in json_content["includes"]:
+        aliases.update(_read_include(join(template_folder, include_file)))
+    aliases.update(json_content.get("aliases", dict()))
+
+    json_content["aliases"] = aliases
+    del json_content["includes"]
+
+    return json_content
+
+
 def template_handle_includes(file_in, file_out):
     r"""Replace includes found in a template file by the values they refer to
+    (see handle_includes())
 
     Parameters
     ----------
@@ -316,65 +399,192 @@ def template_handle_includes(file_in, file_out):
         (i.e. a template with replaced includes or the final file)
 
     """
-    # TODO : complete the include functionality
+    _write_library(handle_includes(_read_library(file_in), dirname(file_in)),
+                   file_out)
+
+
+def _read_library(file_in):
     with open(file_in) as fi:
-        json_content = json.load(fi, object_pairs_hook=OrderedDict)
+        return json.load(fi, object_pairs_hook=OrderedDict)
 
-    json_includes = json_content["includes"]
 
-    print(json_includes)  # just so that json_includes is used somewhere
+def _write_library(json_content, file_out):
+    with open(file_out, 'w') as fp:
+        json.dump(json_content, fp, sort_keys=False, indent=2)
 
-    # Read the files declared in the includes
 
-    # Create aliases from these files
+def _alias_name(value):
+    r"""Name of the alias a value refers to, None if the value is not an alias
+    reference (e.g. '__alias__M1.6' refers to the alias 'M1.6')"""
+    string_types = (unicode, str) if PY2 else str
+    if isinstance(value, string_types) and _ALIAS_PREFIX in value:
+        return value.replace(_ALIAS_PREFIX, "")
+    return None
 
-    # Write the output file
 
-    # with open(file_out, 'w') as fp:
-    #     json.dump(json_content, fp, sort_keys=False, indent=2)
+def _alias_references(alias_values):
+    return [_alias_name(value) for value in alias_values.values()
+            if _alias_name(value) is not None]
 
 
-def template_handle_aliases(file_in, file_out):
-    r"""Replace aliases found in a template file by the values they refer to
+def sort_aliases(json_aliases):
+    r"""Sort the aliases so that each alias comes after the aliases it refers
+    to
 
     Parameters
     ----------
-    file_in : str
-        Path to the input file (i.e. a template using aliases)
-    file_out : str
-        The output file
-        (i.e. a template with replaced aliases or the final file)
+    json_aliases : dict
+        The aliases section of a template
+
+    Returns
+    -------
+    list : the alias names
+
+    Raises
+    ------
+    KeyError if an alias refers to an alias that does not exist
+    ValueError if aliases refer to each other in a cycle
 
     """
-    with open(file_in) as fi:
-        json_content = json.load(fi, object_pairs_hook=OrderedDict)
+    order = list()
+    visiting, visited = 1, 2
+    states = dict()
+
+    for alias in json_aliases:
+        if alias in states:
+            continue
+        states[alias] = visiting
+        # depth first search, with an explicit stack of
+        # (alias, iterator over the aliases it refers to)
+        stack = [(alias, iter(_alias_references(json_aliases[alias])))]
+        while len(stack) > 0:
+            name, references = stack[-1]
+            for reference in references:
+                if reference not in json_aliases:
+                    msg = "Alias %s refers to the unknown alias %s" % \
+                          (name, reference)
+                    logger.error(msg)
+                    raise KeyError(msg)
+                if states.get(reference) == visiting:
+                    cycle = [stacked for stacked, _ in stack]
+                    cycle = cycle[cycle.index(reference):] + [reference]
+                    msg = "Cyclic aliases : %s" % " -> ".join(cycle)
+                    logger.error(msg)
+                    raise ValueError(msg)
+                if reference not in states:
+                    states[reference] = visiting
+                    stack.append((reference, iter(_alias_references(
+                        json_aliases[reference]))))
+                    break
+            else:
+                stack.pop()
+                states[name] = visited
+                order.append(name)
+    return order
+
+
+def resolve_aliases(json_aliases):
+    r"""Fully expanded values of each alias
+
+    An alias reference (e.g. "generics": "__alias__M1.6_generics") is
+    replaced by the alias name ("generics": "M1.6_generics") and the expanded
+    values of the referred alias are merged in. Each alias is expanded once,
+    after the aliases it refers to (see sort_aliases())
+
+    Parameters
+    ----------
+    json_aliases : dict
+        The aliases section of a template
+
+    Returns
+    -------
+    dict : key: alias name; value: OrderedDict of the expanded values
+
+    Raises
+    ------
+    KeyError if an alias refers to an alias that does not exist
+    ValueError if aliases refer to each other in a cycle
+
+    """
+    expanded = dict()
+    for alias in sort_aliases(json_aliases):
+        values = OrderedDict()
+        references = list()
+        for key, value in json_aliases[alias].items():
+            reference = _alias_name(value)
+            if reference is None:
+                values[key] = value
+            else:
+                values[key] = reference
+                references.append(reference)
+        for reference in references:
+            values.update(expanded[reference])
+        expanded[alias] = values
+    return expanded
+
+
+def handle_aliases(json_content):
+    r"""Replace the aliases found in the data of a library content by the
+    values they refer to
+
+    The aliases are expanded once (see resolve_aliases()), then each alias
+    reference of a part is replaced by the alias name, and the expanded
+    values of the alias are merged in the part values
+
+    Parameters
+    ----------
+    json_content : OrderedDict
+        Content of a template using aliases. It is modified in place
+
+    Returns
+    -------
+    OrderedDict : json_content, without its aliases section
 
-    json_aliases = json_content["aliases"]
+    Raises
+    ------
+    KeyError if a part or an alias refers to an alias that does not exist
+    ValueError if aliases refer to each other in a cycle
+
+    """
+    expanded = resolve_aliases(json_content["aliases"])
 
-    # Deal with the aliases
     # name is a string (the part identifier)
     # context_ is a dict
-    for _, context_ in json_content["data"].items():
-        # modify context with the alias mechanism
-        while has_aliases(context_):
-            # for k, v in context_.items():
-            # PY3
-            for k, v in list(context_.items()):
-                if "__alias__" in str(v):
-                    key_in_aliases = str(v).replace("__alias__", "")
-                    for alias_key, alias_value in \
-                            json_aliases[key_in_aliases].items():
-                        context_[alias_key] = alias_value
-                    # del context_[k]  # do not keep the alias link
-                    context_[k] = context_[k].replace("__alias__", "")
+    for part_id, context_ in json_content["data"].items():
+        for k, v in list(context_.items()):
+            reference = _alias_name(v)
+            if reference is None:
+                continue
+            if reference not in expanded:
+                msg = "Part %s refers to the unknown alias %s" % \
+                      (part_id, reference)
+                logger.error(msg)
+                raise KeyError(msg)
+            context_[k] = reference  # keep the alias link
+            context_.update(expanded[reference])
 
     del json_content["aliases"]
 
-    with open(file_out, 'w') as fp:
-        json.dump(json_content, fp, sort_keys=False, indent=2)
+    return json_content
 
 
-def template_handle_tags(file_in, file_out):
+def template_handle_aliases(file_in, file_out):
+    r"""Replace aliases found in a template file by the values they refer to
+    (see handle_aliases())
+
+    Parameters
+    ----------
+    file_in : str
+        Path to the input file (i.e. a template using aliases)
+    file_out : str
+        The output file
+        (i.e. a template with replaced aliases or the final file)
+
+    """
+    _write_library(handle_aliases(_read_library(file_in)), file_out)
+
+
+def _render_tags(file_in):
     r"""Replace the {{ <tag> }} tag:
     - by geometry generation code using Python generator files in the
       generators subdirectory for the {{ generators }} tag
@@ -385,9 +595,10 @@ def template_handle_tags(file_in, file_out):
     file_in : str
         Path to the input file
         (i.e. a template containing a {{ <tag> )} tag(s))
-    file_out : str
-        The output file
-        (i.e. a template with replaced {{ <tag> }} tags or the final file)
+
+    Returns
+    -------
+    str : the rendered template
 
     """
     context = dict()
@@ -425,8 +636,45 @@ def template_handle_tags(file_in, file_out):
 
     context["drawings"] = svg_to_json_string(drawings)
 
+    return render(file_in, context)
+
+
+def handle_tags(template_file):
+    r"""Library content of a template whose {{ <tag> }} tags are replaced
+    (see template_handle_tags())
+
+    Parameters
+    ----------
+    template_file : str
+        Path to the template file
+
+    Returns
+    -------
+    OrderedDict : the library content
+
+    """
+    return json.loads(_render_tags(template_file),
+                      object_pairs_hook=OrderedDict)
+
+
+def template_handle_tags(file_in, file_out):
+    r"""Replace the {{ <tag> }} tag:
+    - by geometry generation code using Python generator files in the
+      generators subdirectory for the {{ generators }} tag
+    - by svg content in the drawings subfolder for the {{ drawings }} tag
+
+    Parameters
+    ----------
+    file_in : str
+        Path to the input file
+        (i.e. a template containing a {{ <tag> )} tag(s))
+    file_out : str
+        The output file
+        (i.e. a template with replaced {{ <tag> }} tags or the final file)
+
+    """
     with codecs.open(file_out, 'w', 'utf-8') as fo:
-        fo.write(render(file_in, context))
+        fo.write(_render_tags(file_in))
 
 
 def has_aliases(d):
@@ -448,8 +696,53 @@ def has_aliases(d):
     return has_alias
 
 
+def handle_nomenclature(json_content):
+    r"""Replaces the part_ids by the nomenclature computed id
+
+    The nomenclature is compiled once and evaluated for each part with the
+    part values as its namespace. Only the data section is rebuilt, in the
+    same order. The template id of each renamed part is kept in a
+    'template_ids' section (key: template id; value: part id, see
+    LibraryReader.part_id())
+
+    Parameters
+    ----------
+    json_content : OrderedDict
+        Content of a library. It is modified in place
+
+    Returns
+    -------
+    OrderedDict : json_content
+
+    """
+    try:
+        nomenclature_string = json_content["metadata"]["nomenclature"]
+    except KeyError:
+        logger.warning("No nomenclature specified, using user input")
+        return json_content
+
+    nomenclature = compile(nomenclature_string, "<nomenclature>", "eval")
+
+    data = OrderedDict()
+    template_ids = OrderedDict()
+    for part_id, part_values in json_content["data"].items():
+        new_part_id = eval(nomenclature, dict(part_values))
+        if new_part_id in data:
+            logger.warning("Several parts have the nomenclature id %s, "
+                           "keeping %s" % (new_part_id, part_id))
+        data[new_part_id] = part_values
+        if new_part_id != part_id:
+            template_ids[part_id] = new_part_id
+
+    json_content["data"] = data
+    if len(template_ids) > 0:
+        json_content["template_ids"] = template_ids
+    return json_content
+
+
 def template_handle_nomenclature(file_in, file_out):
     r"""Replaces the part_ids by the nomenclature computed id
+    (see handle_nomenclature())
 
     Parameters
     ----------
@@ -461,35 +754,9 @@ def template_handle_nomenclature(file_in, file_out):
         (i.e. a template with replaced {{ generators }} tag or the final file)
 
     """
-    with open(file_in) as fi:
-        json_content = json.load(fi, object_pairs_hook=OrderedDict)
-
-    string_types = (unicode, str) if PY2 else str
-
-    # Avoid RuntimeError in Python3 by modifying a copy
-    # of the iterated OrderedDict
-    json_content_copy = copy.deepcopy(json_content)
-
-    try:
-        nomenclature_string = json_content["metadata"]["nomenclature"]
-
-        for part_id, part_values in json_content["data"].items():
-            for var, value in part_values.items():
-                if not isinstance(value, string_types):
-                    exec("%s = %s" % (var, value))
-                else:
-                    exec("%s = '%s'" % (var, value))
-
-            if part_id != eval(nomenclature_string):
-                # json_content["data"][eval(nomenclature_string)] = part_values
-                # del json_content["data"][part_id]
-                json_content_copy["data"][eval(nomenclature_string)] = part_values
-                del json_content_copy["data"][part_id]
-            else:
-                pass  # do nothing, everything is fine
-
-        with open(file_out, 'w') as fp:
-            # json.dump(json_content, fp, sort_keys=False, indent=2)
-            json.dump(json_content_copy, fp, sort_keys=False, indent=2)
-    except KeyError:
+    json_content = _read_library(file_in)
+    # without a nomenclature, the output file is not written
+    if "nomenclature" in json_content.get("metadata", {}):
+        _write_library(handle_nomenclature(json_content), file_out)
+    else:
         logger.warning("No nomenclature specified, using user input")
@@ -25,7 +25,6 @@ Generate the documentation for a parts library JSON file
 
 """
 
-import json
 import shutil
 from os import getcwd, chdir, walk, listdir
 # from os import mkdir
@@ -36,6 +35,7 @@ import logging
 from subprocess import call
 
 from cadracks_party.library_checking import check_library_fields
+from cadracks_party.library_reader import LibraryDocument, as_library
 from cadracks_party.library_use import generate
 from cadracks_party.commons import create_folder
 
@@ -47,8 +47,9 @@ def _library_rst(library_json_filepath):
 
     Parameters
     ----------
-    library_json_filepath : str
-        The path to the parts library
+    library_json_filepath : str or LibraryReader
+        The path to the parts library, or the library already opened as a
+        LibraryReader or a LibraryDocument
 
     Returns
     -------
@@ -58,8 +59,9 @@ def _library_rst(library_json_filepath):
 
     rst_lines = list()
 
-    ok, errors, reference_set_of_fields = \
-        check_library_fields(library_json_filepath)
+    library = as_library(library_json_filepath)
+
+    ok, errors, reference_set_of_fields = check_library_fields(library)
 
     # assert ok is True
     if ok is not True:
@@ -75,32 +77,32 @@ def _library_rst(library_json_filepath):
 
     logger.debug("fields are : %s" % str(reference_set_of_fields))
 
-    with open(library_json_filepath) as data_file:
-        json_file_content = json.load(data_file)
-
-    rst_lines.append(json_file_content["metadata"]["name"])
-    rst_lines.append("="*len(json_file_content["metadata"]["name"]))
+    rst_lines.append(library.metadata["name"])
+    rst_lines.append("="*len(library.metadata["name"]))
     rst_lines.append("")
 
     # Are some svgs in the library?
-    if len(json_file_content["drawings"].keys()) > 0:
+    if len(library.drawings.keys()) > 0:
         # create a svg subdir with the svg files
         # generate(library_json_filepath, generate_svgs=True)
 
-        for file_ in listdir(join(dirname(library_json_filepath), "svgs")):
+        for file_ in listdir(join(dirname(library.json_filename), "svgs")):
             rst_lines.append(".. image:: _static/%s" % file_)
             # rst_lines.append("   :target: _static/%s" % file)
             rst_lines.append("")
 
+    # The parts are read one at a time, in 2 passes : the columns widths
+    # have to be known before writing the table lines
     max_lengths = dict()
-    max_lengths['part_id'] = \
-        max([len(part_id) for part_id in json_file_content["data"].keys()])
-
+    max_lengths['part_id'] = 0
     for field_name in reference_set_of_fields:
-        lengths_list = [len(str(value[field_name]))
-                        for value in json_file_content["data"].values()]
-        lengths_list.append(len(field_name))
-        max_lengths[field_name] = max(lengths_list)
+        max_lengths[field_name] = len(field_name)
+
+    for part_id, part_values in library.iter_data():
+        max_lengths['part_id'] = max(max_lengths['part_id'], len(part_id))
+        for field_name in reference_set_of_fields:
+            max_lengths[field_name] = max(max_lengths[field_name],
+                                          len(str(part_values[field_name])))
 
     header_fields = list(reference_set_of_fields)[:]
     header_fields.insert(0, "part_id")
@@ -117,7 +119,7 @@ def _library_rst(library_json_filepath):
 
     # # Iterate on the parts found in the library JSON file
     # # to fill the table
-    for part_id, part_values in json_file_content["data"].items():
+    for part_id, part_values in library.iter_data():
         line = part_id.ljust(max_lengths["part_id"]) + " "
         for field in reference_set_of_fields:
             line += str(part_values[field]).ljust(max_lengths[field])
@@ -175,13 +177,13 @@ def create_libraries_sphinx_sources(libraries_root_folder, doc_folder):
                 # read the library JSON file
                 json_filename = join(root, libraries[0])
 
-                with open(json_filename) as data_file:
-                    json_file_content = json.load(data_file)
+                # parsed once for the svgs generation and the rst
+                library = LibraryDocument(json_filename)
 
                 # Are some svgs in the library?
-                if len(json_file_content["drawings"].keys()) > 0:
+                if len(library.drawings.keys()) > 0:
                     # create a svg subdir with the svg files
-                    generate(json_filename, generate_svgs=True)
+                    generate(library, generate_svgs=True)
 
                     for file_ in listdir(join(dirname(json_filename), "svgs")):
                         shutil.copy(
@@ -190,11 +192,11 @@ def create_libraries_sphinx_sources(libraries_root_folder, doc_folder):
                 #
                 #     # write to library rst file
                 with open(join(folders["source"],
-                               json_file_content["metadata"]["name"] +
+                               library.metadata["name"] +
                                        '.rst'), 'w') as library_rst_file:
-                    library_rst_file.write(_library_rst(json_filename))
+                    library_rst_file.write(_library_rst(library))
 
-                    index.write("   " + json_file_content["metadata"]["name"] +
+                    index.write("   " + library.metadata["name"] +
                                 "\n")
 
         index.write(INDEX_FOOTER)
@@ -203,7 +205,7 @@ def create_libraries_sphinx_sources(libraries_root_folder, doc_folder):
     cwd = getcwd()
     chdir(folders["source"])
 #     call(["ls", "-l"])
-    call("sphinx-build -b html %s %s" % (folders["source"], folders["build"]))
+    call(["sphinx-build", "-b", "html", folders["source"], folders["build"]])
     chdir(cwd)
 
 CONF_PY = "#!/usr/bin/env python3\n" \
@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2018-2019 Guillaume Florent, Thomas Paviot, Bernard Uguen
+
+# This file is part of cadracks-party.
+#
+# cadracks-party is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# cadracks-party is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cadracks-party.  If not, see <https://www.gnu.org/licenses/>.
+
+r"""library_reader.py module
+
+Incremental reading of PJSON files
+
+The 'data' section is read one part at a time and the other sections
+('metadata', 'generators', 'rules' ...) are only parsed when they are used,
+so that the memory used to go through a library does not depend on its
+number of parts
+
+LibraryDocument parses the whole file once instead, for the callers that go
+through the library several times (e.g. checking then generating)
+
+"""
+
+import re
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+
+_NON_WHITESPACE = re.compile(br'[^ \t\n\r]')
+_STRUCTURE = re.compile(br'["{}\[\]]')
+_STRING_END = re.compile(br'["\\]')
+_SCALAR_END = re.compile(br'[ \t\n\r,}\]]')
+
+
+def index_units(units):
+    r"""Unit of each field
+
+    Parameters
+    ----------
+    units : dict
+        'units' of the metadata of a library
+        (e.g. {"length": ["mm", ["radius", "length"]]})
+
+    Returns
+    -------
+    dict : key: field name; value: unit (e.g. 'mm'). A field defined for
+           several units gets the first one
+
+    """
+    units_index = dict()
+    for definition in units.values():
+        # old libraries only give the unit (e.g. "length": "mm")
+        if not isinstance(definition, list) or len(definition) < 2:
+            continue
+        for field in definition[1]:
+            units_index.setdefault(field, definition[0])
+    return units_index
+
+
+class _Scanner(object):
+    r"""Minimal JSON scanner working on a binary file, one chunk at a time
+
+    The scanner only finds the boundaries of the JSON values, the values
+    themselves are parsed by the json module. The structural characters of
+    JSON are ASCII characters, which never appear inside the UTF-8 encoding
+    of other characters : the scanner can safely work on bytes.
+
+    Parameters
+    ----------
+    file_ : file
+        File opened in binary mode, positioned at the beginning of a value
+    chunk_size : int
+        Number of bytes read at once
+
+    """
+    def __init__(self, file_, chunk_size=CHUNK_SIZE):
+        self._file = file_
+        self._chunk_size = chunk_size
+        self._buffer = b""
+        self._start = file_.tell()  # file offset of self._buffer[0]
+        self._pos = 0  # current position in self._buffer
+        self._mark = None  # position in self._buffer that must be kept
+
+    @property
+    def offset(self):
+        r"""Current position in the file"""
+        return self._start + self._pos
+
+    def _fill(self):
+        r"""Read the next chunk of the file, dropping the consumed bytes
+
+        Returns
+        -------
+        bool : False if the end of the file is reached
+
+        """
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            return False
+        keep = min(self._pos, len(self._buffer))
+        if self._mark is not None:
+            keep = min(keep, self._mark)
+            self._mark -= keep
+        self._buffer = self._buffer[keep:] + chunk
+        self._start += keep
+        self._pos -= keep
+        return True
+
+    def _fill_or_fail(self):
+        if not self._fill():
+            msg = "Unexpected end of JSON file at offset %i" % self.offset
+            logger.error(msg)
+            raise ValueError(msg)
+
+    def next_char(self):
+        r"""Skip the whitespace and return the next character, without
+        consuming it. Returns b"" at the end of the file"""
+        while True:
+            match = _NON_WHITESPACE.search(self._buffer, self._pos)
+            if match is not None:
+                self._pos = match.start()
+                return self._buffer[self._pos:self._pos + 1]
+            self._pos = len(self._buffer)
+            if not self._fill():
+                return b""
+
+    def consume(self, expected):
+        r"""Consume the next character, that must be the expected one
+
+        Raises
+        ------
+        ValueError if the next character is not the expected one
+
+        """
+        char = self.next_char()
+        if char != expected:
+            msg = "Expected %s at offset %i, found %s" % \
+                  (expected.decode(), self.offset, char.decode() or "EOF")
+            logger.error(msg)
+            raise ValueError(msg)
+        self._pos += 1
+
+    def _skip_string(self):
+        self._pos += 1  # opening quote
+        while True:
+            match = _STRING_END.search(self._buffer, self._pos)
+            if match is None:
+                self._pos = len(self._buffer)
+                self._fill_or_fail()
+            elif match.group() == b'"':
+                self._pos = match.end()
+                return
+            else:
+                # backslash : the escaped character cannot end the string
+                self._pos = match.end() + 1
+                while self._pos > len(self._buffer):
+                    self._fill_or_fail()
+
+    def _skip_container(self):
+        depth = 0
+        while True:
+            match = _STRUCTURE.search(self._buffer, self._pos)
+            if match is None:
+                self._pos = len(self._buffer)
+                self._fill_or_fail()
+                continue
+            char = match.group()
+            self._pos = match.start()
+            if char == b'"':
+                self._skip_string()
+                continue
+            self._pos += 1
+            if char in (b"{", b"["):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def _skip_scalar(self):
+        while True:
+            match = _SCALAR_END.search(self._buffer, self._pos)
+            if match is not None:
+                self._pos = match.start()
+                return
+            self._pos = len(self._buffer)
+            if not self._fill():
+                return
+
+    def skip_value(self):
+        r"""Skip the next value
+
+        Returns
+        -------
+        tuple(int, int) : file offsets of the beginning and of the end of
+                          the value
+
+        """
+        char = self.next_char()
+        start = self.offset
+        if char == b'"':
+            self._skip_string()
+        elif char in (b"{", b"["):
+            self._skip_container()
+        elif char in (b"", b",", b"}", b"]", b":"):
+            msg = "Expected a value at offset %i" % start
+            logger.error(msg)
+            raise ValueError(msg)
+        else:
+            self._skip_scalar()
+        return start, self.offset
+
+    def read_raw_value(self):
+        r"""Read the bytes of the next value"""
+        self.next_char()
+        self._mark = self._pos
+        try:
+            self.skip_value()
+            return self._buffer[self._mark:self._pos]
+        finally:
+            self._mark = None
+
+    def read_value(self):
+        r"""Read and parse the next value"""
+        return json.loads(self.read_raw_value().decode("utf-8"))
+
+    def iter_keys(self):
+        r"""Iterate over the keys of the object starting at the current
+        position
+
+        The caller has to consume the value of a key (read_value() or
+        skip_value()) before asking for the next key
+
+        """
+        self.consume(b"{")
+        if self.next_char() == b"}":
+            self._pos += 1
+            return
+        while True:
+            if self.next_char() != b'"':
+                self.consume(b'"')  # raises a meaningful error
+            key = self.read_value()
+            self.consume(b":")
+            yield key
+            char = self.next_char()
+            if char == b",":
+                self._pos += 1
+            elif char == b"}":
+                self._pos += 1
+                return
+            else:
+                self.consume(b"}")  # raises a meaningful error
+
+
+class LibraryReader(object):
+    r"""Incremental reader of a PJSON file
+
+    The file is scanned to locate its top level sections, only as far as
+    the requested section : the parts of the 'data' section are not scanned
+    to read the sections before it, or to start iterating over it. The
+    sections are parsed when they are first used, except the 'data' section
+    whose parts are parsed one at a time by iter_data()
+
+    Parameters
+    ----------
+    json_filename : str
+        Path to the JSON file that describes the parts library
+    chunk_size : int, optional
+        Number of bytes read at once
+
+    """
+    def __init__(self, json_filename, chunk_size=CHUNK_SIZE):
+        self.json_filename = json_filename
+        self._chunk_size = chunk_size
+        self._starts = dict()  # start offsets of the values of the sections
+        self._spans = dict()  # (start, end) offsets of the values
+        self._index_complete = False
+        self._sections = dict()
+        self._reference_fields = None
+        self._units_index = None
+
+    def _scan(self, section_name=None, start_only=False):
+        r"""Scan the top level sections up to section_name (all the sections
+        if None), recording the offsets of their values
+
+        Parameters
+        ----------
+        section_name : str or None
+        start_only : bool
+            If True, stop at the start of the value of section_name, without
+            scanning the value
+
+        """
+        with open(self.json_filename, 'rb') as f:
+            scanner = _Scanner(f, self._chunk_size)
+            for key in scanner.iter_keys():
+                scanner.next_char()
+                self._starts.setdefault(key, scanner.offset)
+                if key == section_name and start_only:
+                    return
+                span = scanner.skip_value()
+                self._spans.setdefault(key, span)
+                if key == section_name:
+                    return
+        self._index_complete = True
+
+    def _index(self):
+        r"""Offsets of the top level sections values (key: section name;
+        value: (start offset, end offset))"""
+        if not self._index_complete:
+            self._scan()
+        return self._spans
+
+    def _value_start(self, section_name):
+        r"""Start offset of the value of a section
+
+        Raises
+        ------
+        KeyError if the library has no such section
+
+        """
+        if section_name not in self._starts and not self._index_complete:
+            self._scan(section_name, start_only=True)
+        return self._starts[section_name]
+
+    def _value_span(self, section_name):
+        r"""(start offset, end offset) of the value of a section
+
+        Raises
+        ------
+        KeyError if the library has no such section
+
+        """
+        if section_name not in self._spans and not self._index_complete:
+            self._scan(section_name)
+        return self._spans[section_name]
+
+    def sections(self):
+        r"""Names of the top level sections of the library"""
+        return list(self._index().keys())
+
+    def __contains__(self, section_name):
+        return section_name in self._index()
+
+    def section(self, section_name):
+        r"""Parsed content of a top level section of the library
+
+        Parameters
+        ----------
+        section_name : str
+
+        Raises
+        ------
+        KeyError if the library has no such section
+
+        """
+        if section_name not in self._sections:
+            start, end = self._value_span(section_name)
+            with open(self.json_filename, 'rb') as f:
+                f.seek(start)
+                raw = f.read(end - start)
+            self._sections[section_name] = json.loads(raw.decode("utf-8"))
+        return self._sections[section_name]
+
+    @property
+    def metadata(self):
+        return self.section("metadata")
+
+    @property
+    def generators(self):
+        return self.section("generators")
+
+    @property
+    def rules(self):
+        return self.section("rules")
+
+    @property
+    def drawings(self):
+        return self.section("drawings")
+
+    def part_id(self, template_id):
+        r"""Id of a part from its id in the library template
+
+        Parameters
+        ----------
+        template_id : str
+            Id of the part in the data section of the library template
+
+        Returns
+        -------
+        str : the part id, template_id itself if the nomenclature of the
+              library did not rename the part
+
+        """
+        if "template_ids" not in self:
+            return template_id
+        return self.section("template_ids").get(template_id, template_id)
+
+    def iter_items(self, section_name):
+        r"""Iterate over the (key, value) pairs of a top level section that is
+        an object, parsing one value at a time
+
+        Parameters
+        ----------
+        section_name : str
+
+        Raises
+        ------
+        KeyError if the library has no such section
+
+        """
+        start = self._value_start(section_name)
+        with open(self.json_filename, 'rb') as f:
+            f.seek(start)
+            scanner = _Scanner(f, self._chunk_size)
+            for key in scanner.iter_keys():
+                yield key, scanner.read_value()
+
+    def iter_data(self):
+        r"""Iterate over the (part_id, context) pairs of the 'data' section"""
+        return self.iter_items("data")
+
+    @property
+    def reference_fields(self):
+        r"""Reference set of fields of the parts : the fields of the first part
+        in part id order (cached)"""
+        # Issue #7
+        # test_missing_field : check_library_fields
+        # finds 8 reference fields (10 expected)
+        # The determination of the set of reference fields must be
+        # deterministic. This is why the fields of the first part in sorted
+        # order are used
+        if self._reference_fields is None:
+            reference_part_id = None
+            reference_fields = set()
+            for part_id, part_values in self.iter_data():
+                if reference_part_id is None or part_id < reference_part_id:
+                    reference_part_id = part_id
+                    reference_fields = set(part_values.keys())
+            self._reference_fields = reference_fields
+        return self._reference_fields
+
+    @property
+    def units_index(self):
+        r"""Unit of each field, from the 'units' of the metadata (cached)
+
+        Returns
+        -------
+        dict : key: field name; value: unit (e.g. 'mm'). A field defined for
+               several units gets the first one
+
+        """
+        if self._units_index is None:
+            self._units_index = index_units(self.metadata["units"])
+        return self._units_index
+
+
+class LibraryDocument(LibraryReader):
+    r"""PJSON file parsed once and kept in memory
+
+    It has the interface of LibraryReader, so the checks, the documentation
+    and the generation accept either of them, and caches the same derived
+    structures. Use it to go through a library several times without reading
+    and parsing the file again
+
+    Parameters
+    ----------
+    json_filename : str
+        Path to the JSON file that describes the parts library
+
+    """
+    def __init__(self, json_filename):
+        super(LibraryDocument, self).__init__(json_filename)
+        with open(json_filename, 'rb') as f:
+            self._sections = json.loads(f.read().decode("utf-8"))
+
+    def sections(self):
+        return list(self._sections.keys())
+
+    def __contains__(self, section_name):
+        return section_name in self._sections
+
+    def section(self, section_name):
+        return self._sections[section_name]
+
+    def iter_items(self, section_name):
+        return iter(self._sections[section_name].items())
+
+
+def iter_raw_items(json_filename,
+                   itemized=("generators", "aliases", "data"),
+                   parsed=("metadata", "data"),
+                   chunk_size=CHUNK_SIZE):
+    r"""Single pass over a PJSON file, keeping the duplicate keys that
+    json.load() silently drops
+
+    Parameters
+    ----------
+    json_filename : str
+        Path to the JSON file that describes the parts library
+    itemized : iterable of str
+        Sections that are iterated key by key (if they are objects)
+    parsed : iterable of str
+        Sections whose values are parsed, the other ones are only scanned
+
+    Yields
+    ------
+    tuple(section_name, key, value)
+        For an itemized section, one tuple per key of the section, in the
+        order of the file and including the duplicate keys. For the other
+        sections, one tuple with key None.
+        value is None if the section is not in parsed
+
+    Raises
+    ------
+    ValueError if the file is not valid JSON
+
+    """
+    with open(json_filename, 'rb') as f:
+        scanner = _Scanner(f, chunk_size)
+        for section_name in scanner.iter_keys():
+            parse = section_name in parsed
+            if section_name in itemized and scanner.next_char() == b"{":
+                for key in scanner.iter_keys():
+                    if parse:
+                        yield section_name, key, scanner.read_value()
+                    else:
+                        scanner.skip_value()
+                        yield section_name, key, None
+            elif parse:
+                yield section_name, None, scanner.read_value()
+            else:
+                scanner.skip_value()
+                yield section_name, None, None
+
+
+def as_library(library):
+    r"""The library reader of a library
+
+    Parameters
+    ----------
+    library : str or LibraryReader
+        Path to the JSON file that describes the parts library, or an
+        already opened library (LibraryReader or LibraryDocument)
+
+    Returns
+    -------
+    LibraryReader : library itself if it is a LibraryReader (or a
+                    LibraryDocument), a new LibraryReader of the file otherwise
+
+    """
+    if isinstance(library, LibraryReader):
+        return library
+    return LibraryReader(library)
@@ -23,17 +23,25 @@ r"""Unique geometry script generation logic from a JSON parts library file"""
 # import imp
 import importlib.util
 import logging
-import json
 import codecs
-from os import remove, walk
-from os.path import join, splitext, dirname, basename
+import shutil
+from collections import OrderedDict
+from multiprocessing import Pool
+from os import walk, remove
+from tempfile import mkdtemp
+from os.path import join, splitext, dirname, basename, abspath
 
 from aocxchange.step import StepExporter
 from aocxchange.stl import StlExporter
 
-from cadracks_party.templating import reconstruct_script_code_template, render
+from cadracks_party.templating import GeneratorTemplates, GeneratorCodes, \
+    drawing_source
 from cadracks_party.library_checking import check_library_json_rules
 from cadracks_party.commons import create_folder
+from cadracks_party.manifest import Manifest, part_hash
+from cadracks_party.library_reader import LibraryDocument, as_library
+from cadracks_party.step_catalog import StepCatalogExporter
+from cadracks_party.library_archive import LibraryArchiveWriter
 
 
 logger = logging.getLogger(__name__)
@@ -59,13 +67,26 @@ def _svgs_folder(folder_path):
     return join(folder_path, "svgs")
 
 
-def _generate_script(json_generators, scripts_folder, part_id, context_):
+def _part_outputs(part_id, output_formats, script=True):
+    r"""Paths, relative to the library folder, of the files generated for
+    a part (key: 'script' or output format; value: path)"""
+    outputs = OrderedDict()
+    if script:
+        outputs["script"] = join(_scripts_folder(""), "%s.py" % part_id)
+    for output_format in output_formats:
+        folder_func, extension, _ = _EXPORTERS[output_format]
+        outputs[output_format] = join(folder_func(""),
+                                      "%s.%s" % (part_id, extension))
+    return outputs
+
+
+def _generate_script(templates, scripts_folder, part_id, context_):
     r"""Generate the Python geometry script for a given part_id
 
     Parameters
     ----------
-    json_generators : dict
-        Geometry generation code (key: generator id; value: lines of code)
+    templates : GeneratorTemplates
+        Compiled templates of the library generators
     scripts_folder : str
         The folder where the script should be written
     part_id : str
@@ -78,122 +99,539 @@ def _generate_script(json_generators, scripts_folder, part_id, context_):
     str : the path to the created Python geometry file
 
     """
-    with open("tmp.py", "w") as tmp_file:
-        tmp_file.write(reconstruct_script_code_template(
-            json_generators[context_["generator"]]))
-
-    # Use tmp.py as a template for context_ and write the results to the
-    # part script
+    # Use the generator as a template for context_ and write the results
+    # to the part script
     py_geometry_file = join(scripts_folder, "%s.py" % part_id)
     with open(py_geometry_file, 'w') as f:
-        f.write(render("tmp.py", context_))
-    remove("tmp.py")
+        f.write(templates.render(context_["generator"], context_))
 
     return py_geometry_file
 
 
-def _generate_cad(output_folder, py_geometry_file, output_format):
-    if output_format not in ["step", "stl", "html"]:
-        raise ValueError
+def _build_shape(py_geometry_file):
+    r"""Execute a geometry script and return the shape it builds
+
+    Parameters
+    ----------
+    py_geometry_file : str
+        Path to the Python geometry file
+
+    Returns
+    -------
+    The __shape__ of the geometry script
+
+    """
     spec = importlib.util.spec_from_file_location(py_geometry_file, py_geometry_file)
     py_geometry_module = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(py_geometry_module)
     # py_geometry_module = imp.load_source(py_geometry_file, py_geometry_file)
-    shape = py_geometry_module.__shape__
-    part_id = splitext(basename(py_geometry_file))[0]
+    return py_geometry_module.__shape__
+
+
+def _export_step(shape, filename):
+    # part.to_step(filename)
+    exporter = StepExporter(filename=filename)
+    exporter.add_shape(shape)
+    exporter.write_file()
+
+
+def _export_stl(shape, filename):
+    # part.to_stl(filename)
+    exporter = StlExporter(filename=filename)
+    exporter.set_shape(shape)
+    exporter.write_file()
+
+
+# Export formats
+# key: output format
+# value: (output folder function, file extension, export function)
+_EXPORTERS = {"step": (_steps_folder, "stp", _export_step),
+              "stl": (_stls_folder, "stl", _export_stl)}
+# "html": (_htmls_folder, "html", ...)
+
+
+def _export_shape(output_folders, part_id, shape):
+    r"""Export a shape to every requested format
+
+    Parameters
+    ----------
+    output_folders : dict
+        key: output format (see _EXPORTERS); value: folder where the file
+        in that format should be written
+    part_id : str
+        part id, used to name the files
+    shape : TopoDS_Shape
+
+    Raises
+    ------
+    ValueError if an output format is unknown
+
+    """
     part_id = str(part_id)  # Keeps the OCC STEP Writer happy !
 
-    if output_format == "step":
-        # part.to_step(join(output_folder, "%s.stp" % part_id))
-        exporter = StepExporter(filename=join(output_folder, "%s.stp" % part_id))
-        exporter.add_shape(shape)
-        exporter.write_file()
-    elif output_format == "stl":
-        # part.to_stl(join(output_folder, "%s.stl" % part_id))
-        exporter = StlExporter(filename=join(output_folder, "%s.stl" % part_id))
-        exporter.set_shape(shape)
-        exporter.write_file()
-    # elif output_format == "html":
-    #     part.to_html(join(output_folder, "%s.html" % part_id))
+    for output_format, output_folder in output_folders.items():
+        if output_format not in _EXPORTERS:
+            msg = "Unknown export format : %s" % output_format
+            logger.error(msg)
+            raise ValueError(msg)
+        _, extension, export = _EXPORTERS[output_format]
+        export(shape, join(output_folder, "%s.%s" % (part_id, extension)))
+
+
+def _generate_cad(output_folders, py_geometry_file):
+    r"""Build the shape of a geometry script and export it to every
+    requested format
+
+    The geometry script is executed once, whatever the number of formats
+
+    Parameters
+    ----------
+    output_folders : dict
+        key: output format (see _EXPORTERS); value: folder where the file
+        in that format should be written
+    py_geometry_file : str
+        Path to the Python geometry file
+
+    Raises
+    ------
+    ValueError if an output format is unknown
+
+    """
+    if len(output_folders) == 0:
+        return
+
+    part_id = splitext(basename(py_geometry_file))[0]
+    _export_shape(output_folders, part_id, _build_shape(py_geometry_file))
+
+
+def _execute_code(code, context_):
+    r"""Execute the code object of a generator with the part values as its
+    namespace and return the shape it builds
+
+    Parameters
+    ----------
+    code : code object
+        Compiled generator (see GeneratorCodes)
+    context_ : dict
+        Values linked to the part_id
+
+    Returns
+    -------
+    The __shape__ built by the generator
+
+    """
+    namespace = dict(context_)
+    exec(code, namespace)
+    return namespace["__shape__"]
+
+
+def _generate_part(templates,
+                   codes,
+                   write_scripts,
+                   scripts_folder,
+                   output_folders,
+                   part_id,
+                   context_):
+    r"""Generate the geometry script and the requested CAD files for a part
+
+    Parameters
+    ----------
+    templates : GeneratorTemplates
+        Compiled templates of the library generators
+    codes : GeneratorCodes or None
+        Compiled generators for the template-free execution. If None, or if
+        the generator of the part cannot be executed without being rendered,
+        the shape is built by importing the rendered geometry script
+    write_scripts : bool
+        Should the geometry script be written when the shape is built by
+        a compiled generator
+    scripts_folder : str
+        The folder where the script should be written
+    output_folders : dict
+        key: requested output format; value: folder where the file in that
+        format should be written
+    part_id : str
+        part id
+    context_ : dict
+        Values linked to the part_id
+
+    """
+    code = None if codes is None else codes.get_code(context_["generator"])
+
+    if code is None:
+        py_geometry_file = _generate_script(templates, scripts_folder,
+                                            part_id, context_)
+        _generate_cad(output_folders, py_geometry_file)
     else:
-        msg = "Unknown export format"
-        logger.error(msg)
-        raise ValueError(msg)
+        if write_scripts:
+            _generate_script(templates, scripts_folder, part_id, context_)
+        if len(output_folders) > 0:
+            _export_shape(output_folders, part_id,
+                          _execute_code(code, context_))
+
+
+# State shared by all the parts handled by a worker process of generate().
+# It is set once per worker by _init_worker() so that the generators and
+# the folders are not pickled along with every part, and so that each
+# generator template is compiled once per worker.
+_worker_state = dict()
+
+
+def _init_worker(json_generators, bytecode_cache_folder, library_id,
+                 parametric, write_scripts, scripts_folder, output_folders):
+    r"""Initializer of the generate() worker processes"""
+    _worker_state["templates"] = GeneratorTemplates(
+        json_generators,
+        bytecode_cache_folder=bytecode_cache_folder,
+        library_id=library_id)
+    _worker_state["codes"] = GeneratorCodes(json_generators, library_id) \
+        if parametric else None
+    _worker_state["write_scripts"] = write_scripts
+    _worker_state["scripts_folder"] = scripts_folder
+    _worker_state["output_folders"] = output_folders
+
+
+def _generate_part_in_worker(item):
+    r"""Generate a part in a generate() worker process
+
+    Parameters
+    ----------
+    item : tuple(str, dict)
+        part id and values linked to the part_id
+
+    Returns
+    -------
+    str : the part id
+
+    """
+    part_id, context_ = item
+    _generate_part(_worker_state["templates"],
+                   _worker_state["codes"],
+                   _worker_state["write_scripts"],
+                   _worker_state["scripts_folder"],
+                   _worker_state["output_folders"],
+                   part_id,
+                   context_)
+    return part_id
 
 
 def generate(json_library_filepath,
              generate_steps=False,
              generate_stls=False,
              # generate_htmls=False,
-             generate_svgs=False):
+             generate_svgs=False,
+             workers=1,
+             parts_per_worker=None,
+             bytecode_cache_folder=None,
+             incremental=False,
+             archive=None,
+             parametric=False,
+             write_scripts=True):
     r"""Create a geometry generation script for each part defined
     in the PJSON file passed as a parameter
 
     Parameters
     ----------
-    json_library_filepath : str
-        The path to the PJSON file describing the parts library
+    json_library_filepath : str or LibraryReader
+        The path to the PJSON file describing the parts library, or the
+        library already opened as a LibraryReader or a LibraryDocument
     generate_steps : bool
     generate_stls : bool
 
     generate_svgs : bool
         Should the SVG drawings embedded in the PJSON file be extracted
+    workers : int, optional (default is 1)
+        Number of processes used to generate the parts.
+        If 1, the parts are generated in the calling process
+    parts_per_worker : int, optional (default is None)
+        Number of parts a worker process generates before being replaced by
+        a fresh one, to bound the memory growth of the CAD kernel.
+        None means that the worker processes live as long as the pool.
+        Ignored if workers is 1
+    bytecode_cache_folder : str, optional (default is None)
+        Folder where the compiled generator templates are cached across
+        runs. If None, the generator templates are compiled once per run
+    incremental : bool, optional (default is False)
+        If True, only generate the parts whose definition (generator code,
+        values, export options) changed since the previous generation or
+        whose files are missing. If False, generate every part.
+        In both cases, the files of the parts that are not in the PJSON file
+        anymore are deleted (the generated files are recorded in a manifest
+        next to the PJSON file)
+    archive : str, optional (default is None)
+        Path to a single archive file (.zip or .tar.zst) where all the
+        generated files are written, along with an index of the part ids
+        (see library_archive). If None, the files are written to the
+        scripts, steps, stls and svgs folders next to the PJSON file.
+        An archive is always written from scratch (incremental is ignored)
+    parametric : bool, optional (default is False)
+        If True, each generator is compiled once to a code object that is
+        executed for each part with the part values as its namespace, instead
+        of rendering, writing and importing a geometry script per part.
+        Generators using Jinja features other than {{ name }} placeholders
+        are still rendered
+    write_scripts : bool, optional (default is True)
+        Should the geometry scripts be written in the parametric mode
+        (the scripts are always written otherwise)
 
     Raises
     ------
     KeyError
 
     """
+    if workers < 1:
+        msg = "workers should be at least 1"
+        logger.error(msg)
+        raise ValueError(msg)
+
+    library = as_library(json_library_filepath)
+
     # Get the path of the JSON file passed as a parameter
-    base_folder = dirname(json_library_filepath)
-    scripts_folder = _scripts_folder(folder_path=base_folder)
+    base_folder = dirname(library.json_filename)
+
+    # With an archive, the files are generated in a local scratch folder and
+    # moved to the archive as soon as a part is generated
+    if archive is None:
+        work_folder = base_folder
+        archive_writer = None
+    else:
+        work_folder = mkdtemp(prefix="party_")
+        archive_writer = LibraryArchiveWriter(archive)
+
+    try:
+        _generate(library, work_folder, archive_writer,
+                  generate_steps, generate_stls, generate_svgs, workers,
+                  parts_per_worker, bytecode_cache_folder, incremental,
+                  parametric, write_scripts)
+    finally:
+        if archive_writer is not None:
+            archive_writer.close()
+            shutil.rmtree(work_folder)
+
+
+def _generate(library,
+              work_folder,
+              archive_writer,
+              generate_steps,
+              generate_stls,
+              generate_svgs,
+              workers,
+              parts_per_worker,
+              bytecode_cache_folder,
+              incremental,
+              parametric,
+              write_scripts):
+    r"""Implementation of generate()
+
+    Parameters
+    ----------
+    library : LibraryReader
+    work_folder : str
+        Folder where the files are generated
+    archive_writer : LibraryArchiveWriter or None
+        If not None, the generated files are moved to the archive and
+        no manifest is used
+
+    Other parameters : see generate()
+
+    """
+    scripts_folder = _scripts_folder(folder_path=work_folder)
 
     create_folder(scripts_folder)
 
     # Deal with folder creation only one (i.e. not in the loop)
+    # The CAD files of a part are exported from a single build of its shape,
+    # whatever the number of requested formats
+    output_formats = list()
     if generate_steps:
-        steps_folder = _steps_folder(base_folder)
-        create_folder(steps_folder)
+        output_formats.append("step")
     if generate_stls:
-        stls_folder = _stls_folder(base_folder)
-        create_folder(stls_folder)
+        output_formats.append("stl")
     # if generate_htmls:
-    #     htmls_folder = _htmls_folder(base_folder)
-    #     create_folder(htmls_folder)
-    if generate_svgs:
-        svgs_folder = _svgs_folder(base_folder)
+    #     output_formats.append("html")
+
+    output_folders = dict()
+    for output_format in output_formats:
+        folder_func, _, _ = _EXPORTERS[output_format]
+        output_folders[output_format] = folder_func(work_folder)
+        create_folder(output_folders[output_format])
+    if generate_svgs and archive_writer is None:
+        svgs_folder = _svgs_folder(work_folder)
         create_folder(svgs_folder)
 
-    with open(json_library_filepath) as data_file:
-        json_file_content = json.load(data_file)
-
     if generate_svgs:
-        for drawing_id, drawing_content in \
-                json_file_content["drawings"].items():
-            with codecs.open(join(svgs_folder, "%s.svg" % drawing_id),
-                             'w',
-                             'utf-8') as svg_file:
-                for line in drawing_content:
-                    svg_file.write("%s\n" % line.replace("'", "\"").replace("@simple_quote@", "'"))
-
-    json_generators = json_file_content["generators"]
-
-    # Check data is not empty
-    for part_id, context_ in json_file_content["data"].items():
-        py_geometry_file = _generate_script(json_generators, scripts_folder,
+        for drawing_id, drawing_content in library.iter_items("drawings"):
+            svg_filename = "%s.svg" % drawing_id
+            if archive_writer is None:
+                with codecs.open(join(svgs_folder, svg_filename),
+                                 'w',
+                                 'utf-8') as svg_file:
+                    svg_file.write(drawing_source(drawing_content))
+            else:
+                archive_writer.add_drawing(
+                    drawing_id,
+                    join(_svgs_folder(""), svg_filename),
+                    drawing_source(drawing_content).encode("utf-8"))
+
+    json_generators = library.generators
+    library_id = abspath(library.json_filename)
+    codes = GeneratorCodes(json_generators, library_id) if parametric \
+        else None
+
+    # Find the parts that need to be (re)generated
+    # The parts are read one at a time : only the ids and hashes are kept
+    manifest = Manifest(work_folder) if archive_writer is None else None
+    export_options = {"formats": output_formats}
+    pending = dict()  # part_id -> (hash, outputs)
+    part_ids = set()
+
+    for part_id, context_ in library.iter_data():
+        part_ids.add(part_id)
+        # The script is always written if the generator has to be rendered
+        script = codes is None or write_scripts or \
+            codes.get_code(context_["generator"]) is None
+        hash_ = part_hash(json_generators[context_["generator"]],
+                          context_,
+                          dict(export_options, script=script))
+        outputs = _part_outputs(part_id, output_formats, script=script)
+        if incremental and manifest is not None and \
+                manifest.is_up_to_date(part_id, hash_, outputs.values()):
+            continue
+        pending[part_id] = (hash_, outputs)
+
+    if manifest is not None:
+        for part_id in manifest.part_ids():
+            if part_id not in part_ids:
+                manifest.remove(part_id)
+
+    logger.info("%i part(s) to generate, %i part(s) up to date" %
+                (len(pending), len(part_ids) - len(pending)))
+
+    parts_to_generate = ((part_id, context_)
+                         for part_id, context_ in library.iter_data()
+                         if part_id in pending)
+
+    def part_generated(part_id_):
+        hash__, outputs_ = pending[part_id_]
+        if archive_writer is None:
+            manifest.update(part_id_, hash__, list(outputs_.values()))
+        else:
+            for kind, output in outputs_.items():
+                path = join(work_folder, output)
+                archive_writer.add_artifact_file(part_id_, kind, output, path)
+                remove(path)
+
+    # The manifest is saved even if the generation fails, so that the parts
+    # generated so far are not generated again by the next run
+    try:
+        if workers == 1:
+            templates = GeneratorTemplates(
+                json_generators,
+                bytecode_cache_folder=bytecode_cache_folder,
+                library_id=library_id)
+            for part_id, context_ in parts_to_generate:
+                _generate_part(templates, codes, write_scripts,
+                               scripts_folder, output_folders,
+                               part_id, context_)
+                part_generated(part_id)
+        else:
+            logger.info("Generating the parts with %i worker processes" %
+                        workers)
+            pool = Pool(processes=workers,
+                        initializer=_init_worker,
+                        initargs=(json_generators, bytecode_cache_folder,
+                                  library_id, parametric, write_scripts,
+                                  scripts_folder, output_folders),
+                        maxtasksperchild=parts_per_worker)
+            try:
+                # Every part writes its own files : the order in which the
+                # parts are completed does not change the output
+                for part_id in pool.imap_unordered(_generate_part_in_worker,
+                                                   parts_to_generate):
+                    logger.debug("Part %s generated" % part_id)
+                    part_generated(part_id)
+                pool.close()
+            except Exception:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+
+def generate_step_catalog(json_library_filepath,
+                          step_filename,
+                          part_ids=None,
+                          bytecode_cache_folder=None):
+    r"""Write the parts defined in a PJSON file to a single STEP file, as
+    separate products named after their part ids
+
+    The geometry scripts of the parts are (re)generated in the scripts folder
+    on the way. The parts are built one at a time and transferred to the
+    STEP model as soon as they are built.
+
+    Parameters
+    ----------
+    json_library_filepath : str or LibraryReader
+        The path to the PJSON file describing the parts library, or the
+        library already opened as a LibraryReader or a LibraryDocument
+    step_filename : str
+        Path to the STEP file to write
+    part_ids : list[str], optional (default is None)
+        Ids of the parts to export. If None, every part of the library is
+        exported
+    bytecode_cache_folder : str, optional (default is None)
+        Folder where the compiled generator templates are cached across runs
+
+    Returns
+    -------
+    list[str] : the ids of the exported parts, in the order of the STEP file
+
+    Raises
+    ------
+    KeyError if a requested part id is not in the library
+
+    """
+    library = as_library(json_library_filepath)
+
+    base_folder = dirname(library.json_filename)
+    scripts_folder = _scripts_folder(folder_path=base_folder)
+    create_folder(scripts_folder)
+
+    templates = GeneratorTemplates(
+        library.generators,
+        bytecode_cache_folder=bytecode_cache_folder,
+        library_id=abspath(library.json_filename))
+
+    requested = None if part_ids is None else set(part_ids)
+
+    exporter = StepCatalogExporter(step_filename)
+    for part_id, context_ in library.iter_data():
+        if requested is not None and part_id not in requested:
+            continue
+        py_geometry_file = _generate_script(templates, scripts_folder,
                                             part_id, context_)
-        if generate_steps:
-            _generate_cad(steps_folder, py_geometry_file, output_format="step")
-        if generate_stls:
-            _generate_cad(stls_folder, py_geometry_file, output_format="stl")
-        # if generate_htmls:
-        #     _generate_cad(htmls_folder, py_geometry_file, output_format="html")
+        exporter.add_shape(part_id, _build_shape(py_geometry_file))
+
+    if requested is not None:
+        missing = requested.difference(exporter.part_ids)
+        if len(missing) > 0:
+            msg = "Unknown part id(s) : %s" % ", ".join(sorted(missing))
+            logger.error(msg)
+            raise KeyError(msg)
+
+    exporter.write_file()
+    return exporter.part_ids
 
 
 def generate_all(base_folder,
                  preview=False,
                  generate_steps=False,
-                 generate_stls=False):
+                 generate_stls=False,
+                 workers=1,
+                 parts_per_worker=None):
     r"""For each folder containing a JSON parts library definition:
     - check the JSON file is OK
     - if so, generate the geometry scripts
@@ -207,6 +645,10 @@ def generate_all(base_folder,
         If False, also generate the geometry scripts
     generate_steps : bool
     generate_stls : bool
+    workers : int, optional (default is 1)
+        Number of processes used to generate the parts of each library
+    parts_per_worker : int, optional (default is None)
+        Number of parts a worker process generates before being replaced
 
     """
     for item in walk(base_folder):
@@ -214,15 +656,19 @@ def generate_all(base_folder,
             json_filename_ = join(item[0], "library.json")
             logger.info("Library filename : %s" % json_filename_)
             logger.info("Checking the rules for the library JSON ...")
-            ok, errors = check_library_json_rules(json_filename=json_filename_)
+            # parsed once for the check and the generation
+            library = LibraryDocument(json_filename_)
+            ok, errors = check_library_json_rules(json_filename=library)
             if ok:
                 logger.info("... done. Rules are OK")
                 logger.info("Creating the Python scripts from the library "
                             "JSON ...")
                 if preview is False:
-                    generate(json_library_filepath=json_filename_,
+                    generate(json_library_filepath=library,
                              generate_steps=generate_steps,
-                             generate_stls=generate_stls)
+                             generate_stls=generate_stls,
+                             workers=workers,
+                             parts_per_worker=parts_per_worker)
                 logger.info("... done")
             else:
                 logger.error("The library contains errors, please "
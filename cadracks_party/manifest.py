@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2018-2019 Guillaume Florent, Thomas Paviot, Bernard Uguen
+
+# This file is part of cadracks-party.
+#
+# cadracks-party is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# cadracks-party is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cadracks-party.  If not, see <https://www.gnu.org/licenses/>.
+
+r"""manifest.py module
+
+Record of the files generated from a PJSON file, used to only regenerate
+the parts whose definition changed since the previous generation
+
+"""
+
+import json
+import hashlib
+import logging
+from os import remove, replace
+from os.path import join, isfile
+
+from cadracks_party import __version__
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "generation_manifest.json"
+
+
+def part_hash(generator_code, context_, export_options):
+    r"""Hash of everything the generated files of a part depend on
+
+    Parameters
+    ----------
+    generator_code : list or str
+        Code of the generator used by the part
+    context_ : dict
+        Values linked to the part_id
+    export_options : dict
+        Options that change the generated files (e.g. the export formats)
+
+    Returns
+    -------
+    str : hexadecimal digest
+
+    """
+    # The party version is part of the hash : a new version may change the
+    # way the files are generated
+    content = json.dumps([__version__, generator_code, context_,
+                          export_options],
+                         sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class Manifest(object):
+    r"""Generated files of a parts library, with the hash of the part
+    definition they were generated from
+
+    The paths of the generated files are relative to the base folder
+
+    Parameters
+    ----------
+    base_folder : str
+        The folder containing the PJSON file and the generated files
+
+    """
+    def __init__(self, base_folder):
+        self.base_folder = base_folder
+        self.filename = join(base_folder, MANIFEST_FILENAME)
+
+        self._parts = dict()
+        if isfile(self.filename):
+            try:
+                with open(self.filename) as manifest_file:
+                    self._parts = json.load(manifest_file)["parts"]
+            except (ValueError, KeyError):
+                logger.warning("Ignoring the invalid manifest %s" %
+                               self.filename)
+
+    def part_ids(self):
+        r"""Ids of the parts recorded in the manifest"""
+        return list(self._parts.keys())
+
+    def is_up_to_date(self, part_id, hash_, outputs):
+        r"""Are the generated files of a part up to date?
+
+        Parameters
+        ----------
+        part_id : str
+        hash_ : str
+            Hash of the current part definition (see part_hash())
+        outputs : list[str]
+            Files the part should generate (relative to the base folder)
+
+        Returns
+        -------
+        bool : True if the part was generated from the same definition and
+               all its output files are still there
+
+        """
+        entry = self._parts.get(part_id)
+        if entry is None or entry["hash"] != hash_:
+            return False
+        return all(isfile(join(self.base_folder, output))
+                   for output in outputs)
+
+    def update(self, part_id, hash_, outputs):
+        r"""Record the generation of a part, deleting its files that are
+        not generated anymore (e.g. after an export format was dropped)
+
+        Parameters
+        ----------
+        part_id : str
+        hash_ : str
+        outputs : list[str]
+
+        """
+        previous = self._parts.get(part_id)
+        if previous is not None:
+            self._remove_files(set(previous["outputs"]) - set(outputs))
+        self._parts[part_id] = {"hash": hash_, "outputs": list(outputs)}
+
+    def remove(self, part_id):
+        r"""Forget a part and delete its generated files
+
+        Parameters
+        ----------
+        part_id : str
+
+        """
+        logger.info("Removing the generated files of %s" % part_id)
+        self._remove_files(self._parts.pop(part_id)["outputs"])
+
+    def _remove_files(self, outputs):
+        for output in outputs:
+            path = join(self.base_folder, output)
+            if isfile(path):
+                remove(path)
+
+    def save(self):
+        r"""Write the manifest next to the generated files"""
+        tmp_filename = "%s.tmp" % self.filename
+        with open(tmp_filename, 'w') as manifest_file:
+            json.dump({"parts": self._parts}, manifest_file,
+                      sort_keys=True, indent=2)
+        # replace in one step : an interrupted run never leaves a
+        # truncated manifest behind
+        replace(tmp_filename, self.filename)
@@ -0,0 +1,613 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2018-2019 Guillaume Florent, Thomas Paviot, Bernard Uguen
+
+# This file is part of cadracks-party.
+#
+# cadracks-party is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# cadracks-party is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cadracks-party.  If not, see <https://www.gnu.org/licenses/>.
+
+r"""rules.py module
+
+Compilation and evaluation of the rules of a parts library
+
+A rule is a Python expression using the fields of the parts as variables
+(e.g. 'outer_diameter > inner_diameter'). It is compiled once and evaluated
+for each part with the part values as its namespace
+
+The names a rule reads are found from its syntax tree, so that the rules
+using unknown names are reported before any evaluation, and the result of a
+rule is memoized on the values of the fields it reads (see RuleMemo)
+
+When NumPy is installed, the rules that only use arithmetic and comparisons
+are evaluated once per block of parts over columns holding the numeric
+values of the parts of the block (see iter_broken_rules_vectorized())
+
+"""
+
+import ast
+import logging
+import operator
+from collections import OrderedDict
+from itertools import islice
+from timeit import default_timer
+
+try:
+    import builtins
+except ImportError:  # Python 2
+    import __builtin__ as builtins
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from cadracks_party.validation_cache import validation_key
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of the evaluation of a rule for a part
+OK = 0
+BROKEN = 1  # the rule does not evaluate to True
+NAME_ERROR = 2  # the rule uses a name that the part does not define
+
+# Number of outcomes kept in memory by a RuleMemo
+MEMO_MAXSIZE = 10000
+
+# Number of parts whose columns are built and evaluated at once by
+# iter_broken_rules_vectorized()
+BLOCK_SIZE = 10000
+
+# Memo key value of a field that a part does not define
+_UNDEFINED = "__undefined__"
+
+# Integers beyond this magnitude cannot be represented exactly as float64
+_MAX_EXACT_INTEGER = 2 ** 53
+
+_BINARY_OPERATORS = {ast.Add: operator.add,
+                     ast.Sub: operator.sub,
+                     ast.Mult: operator.mul,
+                     ast.Div: operator.truediv,
+                     ast.FloorDiv: operator.floordiv,
+                     ast.Mod: operator.mod,
+                     ast.Pow: operator.pow}
+
+_COMPARISON_OPERATORS = {ast.Eq: operator.eq,
+                         ast.NotEq: operator.ne,
+                         ast.Lt: operator.lt,
+                         ast.LtE: operator.le,
+                         ast.Gt: operator.gt,
+                         ast.GtE: operator.ge}
+
+# ast.Num is the node of numeric literals before Python 3.8
+_CONSTANT_NODES = tuple(getattr(ast, name) for name in ("Constant", "Num")
+                        if hasattr(ast, name))
+
+
+class _NotVectorizable(Exception):
+    r"""The rule (or its evaluation on some values) cannot be vectorized"""
+    pass
+
+
+def _is_number(value):
+    r"""Is value a number that a float64 column holds exactly ?"""
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, float):
+        return True
+    if isinstance(value, int):
+        return abs(value) <= _MAX_EXACT_INTEGER
+    return False
+
+
+def _constant_value(node):
+    return node.value if hasattr(node, "value") else node.n
+
+
+def _vectorize_operand(node):
+    r"""Function of the columns computing an arithmetic expression"""
+    if isinstance(node, ast.Name):
+        return lambda columns: columns[node.id]
+    elif isinstance(node, _CONSTANT_NODES):
+        value = _constant_value(node)
+        if not _is_number(value):
+            raise _NotVectorizable()
+        return lambda columns: value
+    elif isinstance(node, ast.BinOp) and \
+            type(node.op) in _BINARY_OPERATORS:
+        binary_operator = _BINARY_OPERATORS[type(node.op)]
+        left = _vectorize_operand(node.left)
+        right = _vectorize_operand(node.right)
+
+        def binary_operation(columns):
+            result = binary_operator(left(columns), right(columns))
+            # Python integers do not lose precision, float64 does
+            if np.any(np.abs(result) > _MAX_EXACT_INTEGER):
+                raise _NotVectorizable()
+            return result
+        return binary_operation
+    elif isinstance(node, ast.UnaryOp) and \
+            isinstance(node.op, (ast.USub, ast.UAdd)):
+        unary_operator = operator.neg if isinstance(node.op, ast.USub) \
+            else operator.pos
+        operand = _vectorize_operand(node.operand)
+        return lambda columns: unary_operator(operand(columns))
+    raise _NotVectorizable()
+
+
+def _vectorize_test(node):
+    r"""Function of the columns computing a boolean expression, i.e. an
+    expression whose Python value is always True or False"""
+    if isinstance(node, ast.Compare):
+        operands = [_vectorize_operand(operand)
+                    for operand in [node.left] + node.comparators]
+        comparisons = list()
+        for op in node.ops:
+            if type(op) not in _COMPARISON_OPERATORS:
+                raise _NotVectorizable()
+            comparisons.append(_COMPARISON_OPERATORS[type(op)])
+
+        def compare(columns):
+            # a < b < c is (a < b) and (b < c)
+            values = [operand(columns) for operand in operands]
+            return np.logical_and.reduce(
+                [comparison(values[i], values[i + 1])
+                 for i, comparison in enumerate(comparisons)])
+        return compare
+    elif isinstance(node, ast.BoolOp):
+        values = [_vectorize_test(value) for value in node.values]
+        is_and = isinstance(node.op, ast.And)
+
+        def boolean_operation(columns):
+            logical = np.logical_and if is_and else np.logical_or
+            return logical.reduce([value(columns) for value in values])
+        return boolean_operation
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        try:
+            operand = _vectorize_test(node.operand)
+        except _NotVectorizable:
+            operand = _vectorize_operand(node.operand)
+        return lambda columns: np.logical_not(operand(columns))
+    raise _NotVectorizable()
+
+
+def _vectorize(tree):
+    r"""Vectorized version of a rule
+
+    Parameters
+    ----------
+    tree : ast.Expression
+        Syntax tree of the rule
+
+    Returns
+    -------
+    function computing the rule from a dict of NumPy columns (key: field
+    name), or None if the rule uses strings, calls or other constructs that
+    are not supported
+
+    """
+    try:
+        return _vectorize_test(tree.body)
+    except _NotVectorizable:
+        return None
+
+
+def _read_names(tree):
+    r"""Names read by a rule
+
+    Parameters
+    ----------
+    tree : ast.Expression
+        Syntax tree of the rule
+
+    Returns
+    -------
+    tuple(set, bool)
+        set : the names the rule reads and does not bind itself
+        bool : False if the rule binds names (comprehensions, lambdas ...) :
+               a bound name may hide a field with the same name
+
+    """
+    loaded = set()
+    bound = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            else:
+                bound.add(node.id)
+        elif node.__class__.__name__ == "arg":
+            bound.add(node.arg)
+    return loaded - bound, len(bound) == 0
+
+
+class CompiledRule(object):
+    r"""A rule of a parts library, compiled once
+
+    Parameters
+    ----------
+    rule : str
+        The rule, as written in the 'rules' section of the library
+
+    Raises
+    ------
+    SyntaxError if there is a syntax error in the rule
+
+    """
+    def __init__(self, rule):
+        self.rule = rule
+        self.code = compile(rule, "<rule: %s>" % rule, "eval")
+        tree = ast.parse(rule, mode="eval")
+        self.names, self._memoizable = _read_names(tree)
+        self._sorted_names = sorted(self.names)
+        self.vectorized = _vectorize(tree)
+        self.elapsed = 0.
+        self.evaluations = 0
+
+    def memo_key(self, namespace):
+        r"""Key of the result of the rule for the values of a part
+
+        The key holds the values (and their types : 1, 1. and True are
+        different values for a rule) of the names the rule reads
+
+        Parameters
+        ----------
+        namespace : dict
+            Values of a part
+
+        Returns
+        -------
+        tuple, or None if the result of the rule cannot be memoized (the
+        values are not hashable or the rule binds names)
+
+        """
+        if not self._memoizable:
+            return None
+        values = list()
+        for name in self._sorted_names:
+            if name in namespace:
+                value = namespace[name]
+                values.append((name, value.__class__.__name__, value))
+            else:
+                values.append((name, _UNDEFINED))
+        key = (self.rule, tuple(values))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def evaluate(self, namespace):
+        r"""Evaluate the rule
+
+        Parameters
+        ----------
+        namespace : dict
+            Values of a part (key: field name; value: field value).
+            The evaluation adds the __builtins__ key
+
+        Returns
+        -------
+        The value of the rule expression
+
+        Raises
+        ------
+        NameError if the rule uses a field that is not in the namespace
+
+        """
+        start = default_timer()
+        try:
+            return eval(self.code, namespace)
+        finally:
+            self.elapsed += default_timer() - start
+            self.evaluations += 1
+
+
+def compile_rules(rules):
+    r"""Compile the rules of a parts library
+
+    Parameters
+    ----------
+    rules : list[str]
+
+    Returns
+    -------
+    list[CompiledRule]
+
+    Raises
+    ------
+    SyntaxError if there is a syntax error in a rule
+
+    """
+    return [CompiledRule(rule) for rule in rules]
+
+
+def unknown_rule_names(compiled_rules, fields):
+    r"""Names used by the rules that are neither fields nor builtins
+
+    Parameters
+    ----------
+    compiled_rules : list[CompiledRule]
+    fields : iterable of str
+        Names of the fields of the parts
+
+    Returns
+    -------
+    dict : key: rule; value: sorted list of unknown names.
+           Only the rules using unknown names are in the dict
+
+    """
+    known = set(fields) | set(dir(builtins))
+    unknown = dict()
+    for compiled_rule in compiled_rules:
+        names = compiled_rule.names - known
+        if len(names) > 0:
+            unknown[compiled_rule.rule] = sorted(names)
+    return unknown
+
+
+class RuleMemo(object):
+    r"""Outcomes (OK, BROKEN or NAME_ERROR) of rules, memoized on the values
+    of the names they read (see CompiledRule.memo_key())
+
+    Only the maxsize most recently used outcomes are kept, so that the memory
+    used does not grow with the number of parts : the values shared by many
+    parts (e.g. the values of the aliases) stay in the memo
+
+    Parameters
+    ----------
+    cache : ValidationCache, optional
+        If provided, the outcomes are also looked up in and stored to the
+        cache, so that they survive the run
+    maxsize : int, optional (default is MEMO_MAXSIZE)
+        Maximum number of outcomes kept in memory
+
+    """
+    def __init__(self, cache=None, maxsize=MEMO_MAXSIZE):
+        self._outcomes = OrderedDict()
+        self._cache = cache
+        self.maxsize = maxsize
+
+    def __len__(self):
+        return len(self._outcomes)
+
+    def get(self, key):
+        r"""Memoized outcome, or None"""
+        outcome = self._outcomes.get(key)
+        if outcome is not None:
+            self._outcomes.move_to_end(key)
+        elif self._cache is not None:
+            outcome = self._cache.get(validation_key("rule", key))
+            if outcome is not None:
+                self._remember(key, outcome)
+        return outcome
+
+    def set(self, key, outcome):
+        self._remember(key, outcome)
+        if self._cache is not None:
+            self._cache.set(validation_key("rule", key), outcome)
+
+    def _remember(self, key, outcome):
+        self._outcomes[key] = outcome
+        self._outcomes.move_to_end(key)
+        if len(self._outcomes) > self.maxsize:
+            self._outcomes.popitem(last=False)
+
+
+def _outcome(compiled_rule, namespace, memo):
+    r"""Outcome of a rule for a part (OK, BROKEN or NAME_ERROR)"""
+    key = None
+    if memo is not None:
+        key = compiled_rule.memo_key(namespace)
+        if key is not None:
+            outcome = memo.get(key)
+            if outcome is not None:
+                return outcome
+    try:
+        outcome = OK if compiled_rule.evaluate(namespace) is True else BROKEN
+    except NameError:
+        outcome = NAME_ERROR
+    if key is not None:
+        memo.set(key, outcome)
+    return outcome
+
+
+def rules_timings(compiled_rules):
+    r"""Time spent evaluating each rule
+
+    Parameters
+    ----------
+    compiled_rules : list[CompiledRule]
+
+    Returns
+    -------
+    dict : key: rule; value: total evaluation time in seconds
+
+    """
+    return dict((compiled_rule.rule, compiled_rule.elapsed)
+                for compiled_rule in compiled_rules)
+
+
+def numpy_available():
+    r"""Can the rules be evaluated with NumPy ?"""
+    return np is not None
+
+
+def iter_broken_rules(compiled_rules, parts, memo=None):
+    r"""Evaluate the rules for each part
+
+    Parameters
+    ----------
+    compiled_rules : list[CompiledRule]
+    parts : iterable of tuple(part_id, dict)
+        The parts, as (part_id, part values) pairs
+    memo : RuleMemo, optional
+        If provided, a rule is only evaluated for the values it reads that
+        are not in the memo
+
+    Yields
+    ------
+    tuple(part_id, rule, bool) for each rule that does not evaluate to True,
+    the bool being True if the evaluation raised a NameError.
+    The parts come in order and the rules of a part in the order of
+    compiled_rules
+
+    """
+    for part_id, part_values in parts:
+        # a copy, as eval() adds the __builtins__ key to the namespace
+        namespace = dict(part_values)
+        for compiled_rule in compiled_rules:
+            outcome = _outcome(compiled_rule, namespace, memo)
+            if outcome != OK:
+                yield part_id, compiled_rule.rule, outcome == NAME_ERROR
+
+
+def _columns(parts, names):
+    r"""float64 columns of the values of the fields in names
+
+    Returns
+    -------
+    tuple(dict, dict)
+        key: field name; value: column (0. where the value is not a number)
+        key: field name; value: mask of the parts where the value is a number
+
+    """
+    columns = dict()
+    numeric = dict()
+    for name in names:
+        values = [part_values.get(name) for _, part_values in parts]
+        numeric[name] = np.fromiter((_is_number(value) for value in values),
+                                    dtype=bool, count=len(values))
+        columns[name] = np.fromiter(
+            (value if _is_number(value) else 0. for value in values),
+            dtype=np.float64, count=len(values))
+    return columns, numeric
+
+
+def iter_broken_rules_vectorized(compiled_rules, parts, memo=None,
+                                 block_size=BLOCK_SIZE):
+    r"""Evaluate the rules for blocks of parts at once, using NumPy
+
+    Each rule that only uses numbers, arithmetic, comparisons and boolean
+    operators is evaluated once per block over the columns of the numeric
+    values of the fields it uses. It is evaluated part by part, like in
+    iter_broken_rules(), for the parts where one of these fields is missing
+    or is not a number, or if its vectorized evaluation raises a floating
+    point error or leaves the range where float64 is exact. The other rules
+    are evaluated part by part.
+
+    Only one block of parts is kept in memory at a time. The results, and
+    the exception raised if any, are the same as with iter_broken_rules()
+
+    Parameters
+    ----------
+    compiled_rules : list[CompiledRule]
+    parts : iterable of tuple(part_id, dict)
+        The parts, as (part_id, part values) pairs
+        (e.g. LibraryReader.iter_data())
+    memo : RuleMemo, optional
+        Used for the rules evaluated part by part
+    block_size : int, optional (default is BLOCK_SIZE)
+        Number of parts evaluated at once
+
+    Yields
+    ------
+    tuple(part_id, rule, bool), like iter_broken_rules()
+
+    Raises
+    ------
+    ImportError if NumPy is not installed
+
+    """
+    if np is None:
+        msg = "NumPy is required for the vectorized evaluation of rules"
+        logger.error(msg)
+        raise ImportError(msg)
+
+    parts = iter(parts)
+    while True:
+        block = list(islice(parts, block_size))
+        if len(block) == 0:
+            break
+        for broken_rule in _iter_broken_rules_block(compiled_rules, block,
+                                                    memo):
+            yield broken_rule
+
+
+def _iter_broken_rules_block(compiled_rules, parts, memo):
+    r"""Evaluate the rules for a block of parts at once
+    (see iter_broken_rules_vectorized())
+
+    Parameters
+    ----------
+    compiled_rules : list[CompiledRule]
+    parts : list of tuple(part_id, dict)
+    memo : RuleMemo or None
+
+    Yields
+    ------
+    tuple(part_id, rule, bool), like iter_broken_rules()
+
+    """
+    count = len(parts)
+    names = set()
+    for compiled_rule in compiled_rules:
+        if compiled_rule.vectorized is not None:
+            names |= compiled_rule.names
+    columns, numeric = _columns(parts, names)
+
+    # per rule : the parts for which the rule is broken and the parts that
+    # have to be evaluated one by one
+    broken = list()
+    per_part = list()
+    for compiled_rule in compiled_rules:
+        rule_broken = np.zeros(count, dtype=bool)
+        rule_per_part = np.ones(count, dtype=bool)
+        if compiled_rule.vectorized is not None:
+            rows = np.logical_and.reduce(
+                [numeric[name] for name in compiled_rule.names] +
+                [np.ones(count, dtype=bool)])
+            start = default_timer()
+            try:
+                with np.errstate(all="raise"):
+                    valid = np.broadcast_to(compiled_rule.vectorized(
+                        dict((name, columns[name][rows])
+                             for name in compiled_rule.names)),
+                        (int(rows.sum()),))
+            except (_NotVectorizable, ArithmeticError):
+                logger.debug("Rule '%s' evaluated part by part" %
+                             compiled_rule.rule)
+            else:
+                rule_broken[rows] = ~valid
+                rule_per_part = ~rows
+            compiled_rule.elapsed += default_timer() - start
+        broken.append(rule_broken)
+        per_part.append(rule_per_part)
+
+    # Report in the order of iter_broken_rules() so that an exception raised
+    # part by part is the one iter_broken_rules() would raise
+    to_report = np.logical_or.reduce(broken + per_part +
+                                     [np.zeros(count, dtype=bool)])
+    for row in np.flatnonzero(to_report):
+        part_id, part_values = parts[row]
+        namespace = None
+        for i, compiled_rule in enumerate(compiled_rules):
+            if broken[i][row]:
+                yield part_id, compiled_rule.rule, False
+            elif per_part[i][row]:
+                if namespace is None:
+                    namespace = dict(part_values)
+                outcome = _outcome(compiled_rule, namespace, memo)
+                if outcome != OK:
+                    yield part_id, compiled_rule.rule, outcome == NAME_ERROR
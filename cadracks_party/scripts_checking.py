@@ -18,14 +18,51 @@
 # You should have received a copy of the GNU General Public License
 # along with cadracks-party.  If not, see <https://www.gnu.org/licenses/>.
 
-r"""Checks for scripts generated from a library.json"""
+r"""Checks for scripts generated from a library.json
+
+check_all_scripts_from_library_jsons() checks the scripts in worker
+processes, so that a script that crashes the CAD kernel, loops forever or
+uses too much memory only fails its own check
+
+The static checks (check_script_static(), check_generator_static()) only
+parse the scripts : they need neither the CAD kernel nor the execution of
+the scripts, and check a whole tree in a fraction of a second
+
+"""
 
 # import imp
+import ast
 import importlib.util
 import os
-import json
+import time
+import hashlib
+import logging
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import builtins
+except ImportError:  # Python 2
+    import __builtin__ as builtins
 
-from ccad.model import Solid
+from cadracks_party.library_reader import LibraryReader, as_library
+from cadracks_party.templating import parametric_source
+from cadracks_party.validation_cache import validation_key
+
+logger = logging.getLogger(__name__)
+
+# Status of a script that did not pass check_all_scripts_from_library_jsons()
+STATUS_FAILED = "failed"  # the script ran but did not pass the checks
+STATUS_MISSING = "missing"  # no script for the part
+STATUS_ERROR = "error"  # the script raised an exception
+STATUS_TIMEOUT = "timeout"  # the script did not complete in time
+STATUS_CRASH = "crash"  # the checking process died or ran out of memory
 
 
 def check_script(script_path):
@@ -50,6 +87,8 @@ def check_script(script_path):
     IOError : if script_path points to a nonexistent file
 
     """
+    # the CAD kernel is only needed when scripts are executed
+    from ccad.model import Solid
 
     script_ok = True
     errors = list()
@@ -91,37 +130,565 @@ def check_script(script_path):
     return script_ok, errors
 
 
-def check_all_scripts_from_library_jsons(folder_path):
+# Names that a module defines without binding them
+_MODULE_NAMES = frozenset(["__name__", "__file__", "__doc__", "__builtins__",
+                           "__spec__", "__loader__", "__package__"])
+
+# Statements whose bodies run when the script is executed
+_BLOCKS = tuple(getattr(ast, name)
+                for name in ("If", "For", "While", "With", "Try",
+                             "TryExcept", "TryFinally")
+                if hasattr(ast, name))
+
+# Keys of each anchor, for each name of the anchors variable
+_ANCHOR_KEYS = {"anchors": ("position", "direction"),
+                "__anchors__": ("p", "u", "v")}
+
+
+def _top_level_assignments(statements, assignments):
+    r"""Fill assignments (key: name; value: list of the nodes assigned to
+    the name, None when the value is not a plain assignment) with the names
+    bound by the statements executed at the top level of a script"""
+    for statement in statements:
+        if isinstance(statement, ast.Assign):
+            for target in statement.targets:
+                if isinstance(target, ast.Name):
+                    assignments.setdefault(target.id, list()).append(
+                        statement.value)
+                else:
+                    for node in ast.walk(target):
+                        if isinstance(node, ast.Name):
+                            assignments.setdefault(node.id, list()).append(
+                                None)
+        elif isinstance(statement, (ast.Import, ast.ImportFrom)):
+            for alias in statement.names:
+                name = alias.asname or alias.name.split(".")[0]
+                assignments.setdefault(name, list()).append(None)
+        elif isinstance(statement, _BLOCKS):
+            for field in ("body", "orelse", "finalbody"):
+                _top_level_assignments(getattr(statement, field, []),
+                                       assignments)
+            for handler in getattr(statement, "handlers", []):
+                _top_level_assignments(handler.body, assignments)
+        else:
+            for node in ast.walk(statement):
+                if isinstance(node, ast.Name) and \
+                        not isinstance(node.ctx, ast.Load):
+                    assignments.setdefault(node.id, list()).append(None)
+
+
+def _is_none(node):
+    return node.__class__.__name__ in ("Constant", "NameConstant") and \
+        node.value is None or \
+        isinstance(node, ast.Name) and node.id == "None"
+
+
+def _literal_string(node):
+    r"""Value of a string literal node, None if node is not a string
+    literal"""
+    if node.__class__.__name__ == "Str":
+        return node.s
+    if node.__class__.__name__ == "Constant" and isinstance(node.value, str):
+        return node.value
+    return None
+
+
+def _is_not_a_dict(node):
+    r"""Is node an expression that cannot build a dict ?"""
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set, ast.ListComp,
+                         ast.SetComp, ast.GeneratorExp)):
+        return True
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and \
+            node.func.id in ("list", "tuple", "set"):
+        return True
+    return node.__class__.__name__ in ("Constant", "Num", "Str") and \
+        not _is_none(node)
+
+
+def _check_anchors_literal(node, anchor_keys):
+    r"""Errors in the structure of the anchors, when they are a dict
+    literal"""
+    errors = list()
+    if not isinstance(node, ast.Dict):
+        return errors
+    for anchor in node.values:
+        if not isinstance(anchor, ast.Dict):
+            if _is_not_a_dict(anchor) or _is_none(anchor):
+                errors.append("anchor at line %i is not a dict" %
+                              anchor.lineno)
+            continue
+        values = dict((_literal_string(key), value)
+                      for key, value in zip(anchor.keys, anchor.values)
+                      if key is not None)
+        for anchor_key in anchor_keys:
+            if anchor_key not in values:
+                errors.append("anchor at line %i has no '%s'" %
+                              (anchor.lineno, anchor_key))
+            elif isinstance(values[anchor_key], (ast.Tuple, ast.List)) and \
+                    len(values[anchor_key].elts) != 3:
+                errors.append("'%s' of the anchor at line %i does not have "
+                              "3 coordinates" % (anchor_key, anchor.lineno))
+    return errors
+
+
+def _undefined_names(tree, defined_names):
+    r"""Names read by a script that it neither binds, imports nor receives
+    in defined_names"""
+    bound = set()
+    loaded = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            else:
+                bound.add(node.id)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    # the names imported by a star import are not known
+                    return []
+                bound.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif node.__class__.__name__ == "arg":
+            bound.add(node.arg)
+        elif isinstance(node, ast.ExceptHandler) and \
+                isinstance(node.name, str):
+            bound.add(node.name)
+    return sorted(name for name in loaded - bound - set(defined_names)
+                  - _MODULE_NAMES if not hasattr(builtins, name))
+
+
+def check_source_static(source, filename="<script>", defined_names=()):
+    r"""Check the source of a geometry script without executing it
+
+    The script must assign 'part' (or '__shape__') and 'anchors'
+    (or '__anchors__') at its top level. A 'part' that is None and 'anchors'
+    that are None or obviously not a dict are reported, as well as the
+    anchors, written as a dict literal, that miss a key ('position' and
+    'direction' in 'anchors', 'p', 'u' and 'v' in '__anchors__') or whose
+    literal coordinates are not 3, and the names that the script uses but
+    neither defines nor imports
+
+    Parameters
+    ----------
+    source : str
+        Python source of the script
+    filename : str, optional
+        Name of the script in the error messages
+    defined_names : iterable of str, optional
+        Names defined before the script is executed (e.g. the part values
+        of a generator)
+
+    Returns
+    -------
+    tuple(bool, errors)
+        bool : True if the script is OK, False otherwise
+        errors : list of str
+
+    """
+    try:
+        tree = ast.parse(source, filename)
+    except SyntaxError as e:
+        return False, ["SyntaxError: %s" % e]
+
+    errors = list()
+    assignments = dict()
+    _top_level_assignments(tree.body, assignments)
+
+    for names, variable, kind_errors in \
+            ((("part", "__shape__"), "part",
+              ((_is_none, "part variable is None"),)),
+             (("anchors", "__anchors__"), "anchors",
+              ((_is_none, "anchors variable is None"),
+               (_is_not_a_dict, "anchors variable is not a dict")))):
+        values = [(name, value) for name in names
+                  for value in assignments.get(name, [])]
+        if len(values) == 0:
+            errors.append("geometry script has no '%s' attribute" % variable)
+            continue
+        # the kind can only be known when the variable is assigned once
+        name, value = values[0]
+        if len(values) > 1 or value is None:
+            continue
+        for is_wrong_kind, message in kind_errors:
+            if is_wrong_kind(value):
+                errors.append(message)
+                break
+        if variable == "anchors":
+            errors.extend(_check_anchors_literal(value, _ANCHOR_KEYS[name]))
+
+    for name in _undefined_names(tree, defined_names):
+        errors.append("name '%s' is not defined" % name)
+
+    return len(errors) == 0, errors
+
+
+def check_script_static(script_path):
+    r"""Check a geometry script without executing it
+    (see check_source_static())
+
+    Parameters
+    ----------
+    script_path : str
+        Path to the Python geometry script
+
+    Returns
+    -------
+    tuple(bool, errors)
+        bool : True if the script is OK, False otherwise
+        errors : list of str
+
+    Raises
+    ------
+    IOError : if script_path points to a nonexistent file
+
+    """
+    with open(script_path) as script_file:
+        return check_source_static(script_file.read(), script_path)
+
+
+def check_generator_static(generator_code, fields):
+    r"""Check a generator of a library without rendering or executing it
+    (see check_source_static())
+
+    Parameters
+    ----------
+    generator_code : str or list
+        ccad python instructions (containing Jinja placeholders), see
+        generator_source()
+    fields : iterable of str
+        Fields of the parts built by the generator
+
+    Returns
+    -------
+    tuple(bool, errors)
+        bool : True if the generator is OK, False otherwise. A generator
+               using Jinja features other than simple placeholders cannot be
+               checked without being rendered, and is considered OK
+        errors : list of str
+
+    """
+    source = parametric_source(generator_code)
+    if source is None:
+        logger.debug("Generator not checked : it has to be rendered")
+        return True, []
+    return check_source_static(source, "<generator>", fields)
+
+
+def check_library_generators_static(json_filename):
+    r"""Check the generators of a library without rendering or executing
+    them (see check_generator_static())
+
+    Parameters
+    ----------
+    json_filename : str or LibraryReader
+        Path to the JSON file that describes the parts library, or an
+        already opened library
+
+    Returns
+    -------
+    tuple(bool, errors)
+        bool : True if every generator is OK, False otherwise
+        errors : dict (key: generator id, values: list of errors)
+
+    """
+    library = as_library(json_filename)
+
+    # the fields of the parts built by each generator
+    fields = dict()
+    for _, part_values in library.iter_data():
+        fields.setdefault(part_values.get("generator"), set()).update(
+            part_values.keys())
+
+    errors = dict()
+    for generator_id, generator_code in library.generators.items():
+        generator_ok, generator_errors = check_generator_static(
+            generator_code, fields.get(generator_id, set()))
+        if not generator_ok:
+            logger.error("Generator %s : %s" % (generator_id,
+                                                ", ".join(generator_errors)))
+            errors[generator_id] = generator_errors
+    return len(errors) == 0, errors
+
+
+def _check_scripts_worker(memory_limit, connection):
+    r"""Target of a process checking scripts : receives the script paths
+    through connection, one at a time, and sends back (status, errors) for
+    each of them, status being None if the script is OK. Stops when it
+    receives None, or after a script ran out of memory"""
+    if memory_limit is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    while True:
+        try:
+            script_path = connection.recv()
+        except EOFError:
+            break
+        if script_path is None:
+            break
+        try:
+            script_ok, errors = check_script(script_path)
+            result = (None if script_ok else STATUS_FAILED, errors)
+        except MemoryError:
+            # the process may be left unusable : it is replaced
+            connection.send((STATUS_CRASH, ["memory limit exceeded"]))
+            break
+        except Exception as e:
+            result = (STATUS_ERROR, ["%s: %s" % (e.__class__.__name__, e)])
+        connection.send(result)
+    connection.close()
+
+
+class _CheckingProcess(object):
+    r"""A process checking scripts, one at a time
+
+    Parameters
+    ----------
+    memory_limit : int or None
+        Address space limit (bytes) of the process
+
+    """
+    def __init__(self, memory_limit):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_check_scripts_worker,
+            args=(memory_limit, child_connection))
+        self.process.start()
+        child_connection.close()
+        self.scripts_count = 0
+
+    def check(self, script_path):
+        r"""Start the check of a script"""
+        self.connection.send(script_path)
+        self.scripts_count += 1
+
+    def stop(self):
+        r"""Let the process end once its current check is done"""
+        try:
+            self.connection.send(None)
+        except (IOError, OSError):
+            pass  # the process is already dead
+        self.process.join()
+        self.connection.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+def _check_scripts_in_processes(jobs, workers, timeout, memory_limit,
+                                scripts_per_worker=None):
+    r"""Check scripts in worker processes
+
+    A worker process checks scripts one after the other : the CAD kernel is
+    imported once per process instead of once per script. Each script is
+    still executed as its own module, and a worker is replaced by a fresh
+    one when a script kills it, exceeds the timeout or runs out of memory,
+    so that such a script only fails its own check
+
+    Parameters
+    ----------
+    jobs : list of tuple(key, script_path)
+    workers : int
+        Maximum number of processes running at the same time
+    timeout : float or None
+        Time (s) after which the process checking a script is killed
+    memory_limit : int or None
+        Address space limit (bytes) of the processes
+    scripts_per_worker : int, optional (default is None)
+        Number of scripts a worker process checks before being replaced.
+        None means that the worker processes live until all the scripts
+        are checked
+
+    Yields
+    ------
+    tuple(key, status, errors), in completion order. status is None if the
+    script is OK
+
+    """
+    pending = deque(jobs)
+    idle = list()  # _CheckingProcess instances waiting for a script
+    running = dict()  # key: connection; value: (key, worker, deadline)
+
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < workers:
+                key, script_path = pending.popleft()
+                worker = idle.pop() if len(idle) > 0 \
+                    else _CheckingProcess(memory_limit)
+                worker.check(script_path)
+                deadline = None if timeout is None else time.time() + timeout
+                running[worker.connection] = (key, worker, deadline)
+
+            deadlines = [deadline for _, _, deadline in running.values()
+                         if deadline is not None]
+            wait_time = None if len(deadlines) == 0 \
+                else max(min(deadlines) - time.time(), 0.)
+
+            for connection in wait(list(running.keys()), wait_time):
+                key, worker, _ = running.pop(connection)
+                try:
+                    status, errors = connection.recv()
+                except EOFError:
+                    # the process died without sending its result
+                    worker.process.join()
+                    status = STATUS_CRASH
+                    errors = ["checking process exited with code %s" %
+                              worker.process.exitcode]
+                if status == STATUS_CRASH or \
+                        (scripts_per_worker is not None and
+                         worker.scripts_count >= scripts_per_worker):
+                    worker.stop()
+                else:
+                    idle.append(worker)
+                yield key, status, errors
+
+            now = time.time()
+            for connection, (key, worker, deadline) in list(running.items()):
+                if deadline is not None and now >= deadline:
+                    del running[connection]
+                    worker.kill()
+                    yield key, STATUS_TIMEOUT, ["no result after %s s" %
+                                                timeout]
+    finally:
+        for worker in idle:
+            worker.stop()
+        for _, worker, _ in running.values():
+            worker.kill()
+
+
+def _check_scripts_statically(jobs):
+    r"""Check scripts with check_script_static()
+
+    Parameters
+    ----------
+    jobs : list of tuple(key, script_path)
+
+    Yields
+    ------
+    tuple(key, status, errors). status is None if the script is OK
+
+    """
+    for key, script_path in jobs:
+        script_ok, errors = check_script_static(script_path)
+        yield key, None if script_ok else STATUS_FAILED, errors
+
+
+def check_all_scripts_from_library_jsons(folder_path,
+                                         workers=None,
+                                         timeout=60.,
+                                         memory_limit=None,
+                                         cache=None,
+                                         static=False,
+                                         scripts_per_worker=None):
     r"""Check every geometry script found in a folder
 
+    The scripts are checked by check_script() in at most workers processes
+    running at the same time, or by check_script_static() if static is True.
+    A process checks scripts one after the other, and is replaced when a
+    script kills it, exceeds the timeout or runs out of memory
+
     Parameters
     ----------
     folder_path : str
+    workers : int, optional (default is None)
+        Number of scripts checked at the same time.
+        None means the number of CPUs
+    timeout : float, optional (default is 60.)
+        Time (s) after which the check of a script is abandoned.
+        None means no timeout
+    memory_limit : int, optional (default is None)
+        Address space limit (bytes) of each process checking the scripts.
+        None means no limit. Ignored on Windows
+    cache : ValidationCache, optional
+        If provided, the scripts whose content, part values and generator
+        code did not change since their result was stored in the cache are
+        not checked again, and the results of the other scripts (except
+        timeouts and crashes) are stored in the cache. The caller saves the
+        cache
+    static : bool, optional (default is False)
+        Only parse the scripts (see check_script_static()) instead of
+        executing them. The static checks need neither the CAD kernel nor
+        processes : workers, timeout, memory_limit and scripts_per_worker
+        are ignored
+    scripts_per_worker : int, optional (default is None)
+        Number of scripts a process checks before being replaced by a fresh
+        one, to bound the memory growth of the CAD kernel.
+        None means that the processes are only replaced after a failure
 
     Returns
     -------
-    bool, dict
+    tuple(bool, dict)
+        bool : True if every script is OK, False otherwise
+        dict : errors, key: library.json path; value: dict with
+               key: part id; value: {"status": status, "errors": errors}.
+               status is one of STATUS_FAILED, STATUS_MISSING, STATUS_ERROR,
+               STATUS_TIMEOUT and STATUS_CRASH, errors is a list of str.
+               Every failing part of a library is reported
 
     """
-    scripts_ok = True
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers < 1:
+        msg = "workers should be at least 1"
+        logger.error(msg)
+        raise ValueError(msg)
+
     all_errors = dict()
 
+    def add_error(library_json_, part_id_, status_, errors_):
+        logger.error("Script of %s in %s : %s" % (part_id_,
+                                                  library_json_,
+                                                  status_))
+        all_errors.setdefault(library_json_, dict())[part_id_] = \
+            {"status": status_, "errors": errors_}
+
+    jobs = list()
+    keys = dict()  # key: (library_json, part_id); value: cache key
+
     # TODO : raise an error if no library in subfolders structure
     for item in os.walk(folder_path):
         if "library.json" in item[2]:
-            with open("%s/%s" % (item[0], "library.json")) as data_file:
-                json_file_content = json.load(data_file)
+            library_json = "%s/%s" % (item[0], "library.json")
+            library = LibraryReader(library_json)
 
-            for part_id, _ in json_file_content["data"].items():
-                try:
-                    script_path = os.path.join(item[0], "scripts/%s.py" % part_id)
-                    script_ok, errors = check_script(script_path)
-                    if script_ok is False:
-                        scripts_ok = False
-                        all_errors["%s/%s" % (item[0], "library.json")] = {part_id: errors}
-                except IOError:
-                    scripts_ok = False
-                    all_errors["%s/%s" % (item[0], "library.json")] = \
-                        {part_id: "No script for %s" % part_id}
-
-    return scripts_ok, all_errors
+            for part_id, part_values in library.iter_data():
+                script_path = os.path.join(item[0], "scripts/%s.py" % part_id)
+                if not os.path.isfile(script_path):
+                    add_error(library_json, part_id, STATUS_MISSING,
+                              ["No script for %s" % part_id])
+                    continue
+                if cache is not None:
+                    with open(script_path, 'rb') as script_file:
+                        script_hash = hashlib.sha1(
+                            script_file.read()).hexdigest()
+                    key = validation_key(
+                        "static script" if static else "script",
+                        script_hash, part_values,
+                        library.generators.get(part_values.get("generator")))
+                    result = cache.get(key)
+                    if result is not None:
+                        status, errors = result
+                        if status is not None:
+                            add_error(library_json, part_id, status, errors)
+                        continue
+                    keys[(library_json, part_id)] = key
+                jobs.append(((library_json, part_id), script_path))
+
+    if static:
+        results = _check_scripts_statically(jobs)
+    else:
+        results = _check_scripts_in_processes(jobs, workers, timeout,
+                                              memory_limit, scripts_per_worker)
+
+    for (library_json, part_id), status, errors in results:
+        if status is not None:
+            add_error(library_json, part_id, status, errors)
+        if cache is not None and status not in (STATUS_TIMEOUT, STATUS_CRASH):
+            cache.set(keys[(library_json, part_id)], [status, errors])
+
+    if cache is not None:
+        cache.log_counts()
+
+    return len(all_errors) == 0, all_errors
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2018-2019 Guillaume Florent, Thomas Paviot, Bernard Uguen
+
+# This file is part of cadracks-party.
+#
+# cadracks-party is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# cadracks-party is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cadracks-party.  If not, see <https://www.gnu.org/licenses/>.
+
+r"""step_catalog.py module
+
+Export of many parts to a single STEP file, each part being a separate
+product named after its part id
+
+"""
+
+import logging
+
+try:
+    from OCC.Core.STEPControl import STEPControl_Writer, STEPControl_AsIs
+    from OCC.Core.Interface import Interface_Static_SetCVal
+    from OCC.Core.IFSelect import IFSelect_RetDone
+except ImportError:  # pythonocc < 0.18
+    from OCC.STEPControl import STEPControl_Writer, STEPControl_AsIs
+    from OCC.Interface import Interface_Static_SetCVal
+    from OCC.IFSelect import IFSelect_RetDone
+
+logger = logging.getLogger(__name__)
+
+
+class StepCatalogExporter(object):
+    r"""Writes the shapes of several parts to a single STEP file
+
+    Each shape is transferred to the STEP model as soon as it is added, so
+    that the shapes do not have to be kept alive until the file is written
+
+    Parameters
+    ----------
+    filename : str
+        Path to the STEP file to write
+    schema : str, optional (default is "AP214CD")
+        STEP schema
+
+    """
+    def __init__(self, filename, schema="AP214CD"):
+        self.filename = filename
+        self._writer = STEPControl_Writer()
+        Interface_Static_SetCVal("write.step.schema", schema)
+        self.part_ids = list()
+
+    def add_shape(self, part_id, shape):
+        r"""Add the shape of a part to the catalog
+
+        Parameters
+        ----------
+        part_id : str
+            Name of the STEP product of the part
+        shape : TopoDS_Shape
+
+        Raises
+        ------
+        ValueError if the shape could not be transferred
+
+        """
+        # str() keeps the OCC STEP Writer happy !
+        Interface_Static_SetCVal("write.step.product.name", str(part_id))
+        status = self._writer.Transfer(shape, STEPControl_AsIs)
+        if status != IFSelect_RetDone:
+            msg = "Could not transfer the shape of %s to STEP" % part_id
+            logger.error(msg)
+            raise ValueError(msg)
+        self.part_ids.append(part_id)
+
+    def write_file(self):
+        r"""Write the STEP file
+
+        Raises
+        ------
+        IOError if the file could not be written
+
+        """
+        status = self._writer.Write(self.filename)
+        if status != IFSelect_RetDone:
+            msg = "Could not write the STEP file %s" % self.filename
+            logger.error(msg)
+            raise IOError(msg)
+        logger.info("Wrote %i part(s) to %s" % (len(self.part_ids),
+                                                 self.filename))
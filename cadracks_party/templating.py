@@ -20,8 +20,23 @@
 
 r"""Functions for templates handling"""
 
+import io
+import re
+import json
 import os.path
-from jinja2 import Environment, FileSystemLoader
+import logging
+import tokenize
+from jinja2 import Environment, FileSystemLoader, FunctionLoader, \
+    FileSystemBytecodeCache
+
+from cadracks_party.commons import mkdir_p
+
+logger = logging.getLogger(__name__)
+
+# {{ name }} placeholder, possibly quoted
+_PLACEHOLDER = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}")
+_QUOTED_PLACEHOLDER = re.compile(
+    r"(['\"])\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}\1")
 
 
 def render(template_path, context):
@@ -44,15 +59,228 @@ def render(template_path, context):
         get_template(filename).render(context)
 
 
+class GeneratorTemplates(object):
+    r"""Compiled templates of the generators of a parts library
+
+    Each generator template is parsed and compiled once, the first time it
+    is used, and kept for the subsequent parts using the same generator.
+
+    Parameters
+    ----------
+    json_generators : dict
+        Geometry generation code (key: generator id; value: code, see
+        generator_source())
+    bytecode_cache_folder : str, optional (default is None)
+        Folder where Jinja stores the compiled templates so that they
+        survive across runs. If None, the compiled templates only live
+        as long as the GeneratorTemplates object
+    library_id : str, optional (default is "library")
+        Identifier of the library the generators belong to (e.g. the path
+        to its PJSON file). Several libraries may use the same generator
+        ids with different code : the library id keeps their compiled
+        templates apart in a shared bytecode cache folder
+
+    """
+    def __init__(self,
+                 json_generators,
+                 bytecode_cache_folder=None,
+                 library_id="library"):
+        self._json_generators = json_generators
+        self._library_id = library_id
+        self._templates = dict()
+
+        bytecode_cache = None
+        if bytecode_cache_folder is not None:
+            # mkdir_p: other processes may create the folder concurrently
+            mkdir_p(bytecode_cache_folder)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_folder)
+
+        self._environment = Environment(loader=FunctionLoader(self._source),
+                                        bytecode_cache=bytecode_cache)
+
+    def _source(self, generator_id):
+        r"""Template source of a generator, as seen by the Jinja loader
+
+        The template is rendered from the generator code held in memory :
+        no file is involved. The returned file name only names the template
+        in the bytecode cache and in the tracebacks.
+
+        """
+        source = reconstruct_script_code_template(
+            self._json_generators[generator_id])
+        return (source,
+                "%s:%s" % (self._library_id, generator_id),
+                lambda: True)
+
+    def get_template(self, generator_id):
+        r"""Get the compiled template of a generator
+
+        Parameters
+        ----------
+        generator_id : str
+
+        Returns
+        -------
+        jinja2.Template
+
+        Raises
+        ------
+        KeyError if the generator id is unknown
+
+        """
+        try:
+            return self._templates[generator_id]
+        except KeyError:
+            if generator_id not in self._json_generators:
+                raise KeyError(generator_id)
+            template = self._environment.get_template(generator_id)
+            self._templates[generator_id] = template
+            return template
+
+    def render(self, generator_id, context):
+        r"""Render the template of a generator using a context
+
+        Parameters
+        ----------
+        generator_id : str
+        context : dict
+            Dict used for template rendering
+
+        Returns
+        -------
+        The template rendered with the context
+
+        """
+        return self.get_template(generator_id).render(context)
+
+
+def parametric_source(generator_code):
+    r"""Python source of a generator where the Jinja placeholders are replaced
+    by the names of the part values, so that the generator can be executed
+    with the part values as its namespace instead of being rendered
+
+    {{ name }} becomes name and "{{ name }}" becomes str(name), which is what
+    rendering the template does with the part values
+
+    Parameters
+    ----------
+    generator_code : str or list
+        ccad python instructions (containing Jinja placeholders), see
+        generator_source()
+
+    Returns
+    -------
+    str : the Python source, or None if the generator uses Jinja features
+          other than simple placeholders (tags, filters, placeholders inside
+          longer strings ...) and has to be rendered
+
+    """
+    source = reconstruct_script_code_template(generator_code)
+
+    # A placeholder in a longer string literal (e.g. "M{{ d }}") cannot be
+    # replaced by a name
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(source).readline):
+            if token[0] == tokenize.STRING and "{{" in token[1] and \
+                    _QUOTED_PLACEHOLDER.match(token[1]) is None:
+                return None
+    except (tokenize.TokenError, SyntaxError):
+        return None
+
+    source = _QUOTED_PLACEHOLDER.sub(r"str(\2)", source)
+    source = _PLACEHOLDER.sub(r"\1", source)
+
+    if "{{" in source or "{%" in source or "{#" in source:
+        return None
+    return source
+
+
+class GeneratorCodes(object):
+    r"""Generators of a parts library compiled once to Python code objects
+
+    A code object is executed for each part with the part values as its
+    namespace (see parametric_source()) : there is neither rendering nor
+    compilation per part
+
+    Parameters
+    ----------
+    json_generators : dict
+        Geometry generation code (key: generator id; value: code, see
+        generator_source())
+    library_id : str, optional (default is "library")
+        Identifier of the library the generators belong to, used to name
+        the code objects in the tracebacks
+
+    """
+    def __init__(self, json_generators, library_id="library"):
+        self._json_generators = json_generators
+        self._library_id = library_id
+        self._codes = dict()
+
+    def get_code(self, generator_id):
+        r"""Get the code object of a generator
+
+        Parameters
+        ----------
+        generator_id : str
+
+        Returns
+        -------
+        code object, or None if the generator cannot be executed without
+        being rendered
+
+        Raises
+        ------
+        KeyError if the generator id is unknown
+
+        """
+        try:
+            return self._codes[generator_id]
+        except KeyError:
+            source = parametric_source(self._json_generators[generator_id])
+            if source is None:
+                logger.info("Generator %s has to be rendered" % generator_id)
+                code = None
+            else:
+                code = compile(source,
+                               "%s:%s" % (self._library_id, generator_id),
+                               "exec")
+            self._codes[generator_id] = code
+            return code
+
+
+def _to_json_string(contents):
+    r"""JSON members (without the enclosing braces) mapping each key of
+    contents to its content as a single string
+
+    Parameters
+    ----------
+    contents : dict
+        key: id; value: file content, as a str or as a list of lines
+        (e.g. from readlines())
+
+    """
+    members = list()
+    for content_id, content in contents.items():
+        if isinstance(content, list):
+            content = "".join(content)
+        members.append("%s : %s" % (json.dumps(content_id),
+                                    json.dumps(content, ensure_ascii=False)))
+    return ",\n".join(members) + "\n"
+
+
 def generators_to_json_string(generators_dict):
     r"""Transform a dictionary of generators (key = file name no extension;
     value = file content) to a json string
 
+    Each generator is stored as one JSON string holding the file content
+
     Parameters
     ----------
     generators_dict : dict
         Dictionary of generators. The key is the file name without the
-        extension; the value is the generator file content
+        extension; the value is the generator file content (a str or a list
+        of lines)
 
     Returns
     -------
@@ -60,40 +288,21 @@ def generators_to_json_string(generators_dict):
           library_template.json
 
     """
-    # -> replace the generators_dict parameter name by something more generic
-    json_ = list()
-    length = len(generators_dict.keys())
-    for i, (gen_id, content) in enumerate(generators_dict.items()):
-        json_.append('"%s"' % gen_id)
-        json_.append(' : ')
-        json_.append('[')
-        for k, line in enumerate(content):
-            json_.append('"%s"' % line.replace("\n", "")
-                         .replace("\"\"\"", "'''")
-                         .replace("\\", "\\\\")
-                         .replace("\"", "'"))
-
-            if k != len(content) - 1:  # no comma separation if last line
-                json_.append(",")
-        # s += str(content)
-        json_.append(']')
-
-        if i != length - 1:  # no comma separation of last generator
-            json_.append(",")
-
-        json_.append('\n')
-    return "".join(json_)
+    return _to_json_string(generators_dict)
 
 
 def svg_to_json_string(drawings_dict):
     r"""Transform a dictionary of SVG drawings (key = file name no extension;
     value = file content) to a json string
 
+    Each drawing is stored as one JSON string holding the file content
+
     Parameters
     ----------
     drawings_dict : dict
         Dictionary of SVG drawings. The key is the file name without the
-        extension; the value is the drawing file content
+        extension; the value is the drawing file content (a str or a list
+        of lines)
 
     Returns
     -------
@@ -101,30 +310,50 @@ def svg_to_json_string(drawings_dict):
           library_template.json
 
     """
-    json_ = list()
-    length = len(drawings_dict.keys())
-    for i, (gen_id, content) in enumerate(drawings_dict.items()):
-        json_.append('"%s"' % gen_id)
-        json_.append(' : ')
-        json_.append('[')
-        for k, line in enumerate(content):
-            json_.append('"%s"' % line.replace("\n", "")
-                         # .replace("\"\"\"", "'''")
-                         # .replace("\\", "\\\\")
-                         .replace("'", "@simple_quote@")
-                         .replace("\"", "'")
-                         )
-
-            if k != len(content) - 1:  # no comma separation if last line
-                json_.append(",")
-        # s += str(content)
-        json_.append(']')
-
-        if i != length - 1:  # no comma separation of last drawing
-            json_.append(",")
-
-        json_.append('\n')
-    return "".join(json_)
+    return _to_json_string(drawings_dict)
+
+
+def generator_source(generator_code):
+    r"""Python code of a generator stored in a PJSON file
+
+    Parameters
+    ----------
+    generator_code : str or list
+        The generator code, as stored in the PJSON file : a str, or a list
+        of lines where the double quotes were replaced by single quotes
+        (older libraries)
+
+    Returns
+    -------
+    str
+
+    """
+    if not isinstance(generator_code, list):
+        return generator_code
+    return "\n".join(generator_code).replace("'''", "\"\"\"").\
+        replace("'", "\"")
+
+
+def drawing_source(drawing_content):
+    r"""SVG content of a drawing stored in a PJSON file
+
+    Parameters
+    ----------
+    drawing_content : str or list
+        The drawing, as stored in the PJSON file : a str, or a list of
+        lines where the double quotes were replaced by single quotes and the
+        single quotes by @simple_quote@ (older libraries)
+
+    Returns
+    -------
+    str
+
+    """
+    if not isinstance(drawing_content, list):
+        return drawing_content
+    return "".join("%s\n" % line.replace("'", "\"").
+                   replace("@simple_quote@", "'")
+                   for line in drawing_content)
 
 
 def reconstruct_script_code_template(generator_code):
@@ -133,8 +362,9 @@ def reconstruct_script_code_template(generator_code):
 
     Parameters
     ----------
-    generator_code : list
-        List of ccad python instructions (containing Jinja placeholders)
+    generator_code : str or list
+        ccad python instructions (containing Jinja placeholders), see
+        generator_source()
 
     Returns
     -------
@@ -146,7 +376,7 @@ def reconstruct_script_code_template(generator_code):
     code.append("#!/usr/bin/env python\n")
     code.append("# coding: utf-8\n\n")
     # code.append("from ccad.model import cylinder\n\n")
-    code.append("\n".join(generator_code).replace("'''", "\"\"\"").replace("'", "\""))
+    code.append(generator_source(generator_code))
     # code.append("\n\nif __name__ == '__main__':\n")
     # code.append("    import ccad.display as cd\n")
     # code.append("    v = cd.view()\n")
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2018-2019 Guillaume Florent, Thomas Paviot, Bernard Uguen
+
+# This file is part of cadracks-party.
+#
+# cadracks-party is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# cadracks-party is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cadracks-party.  If not, see <https://www.gnu.org/licenses/>.
+
+r"""units.py module
+
+Units of the fields of a parts library, and conversion of the data of a
+library to other units (e.g. from mm to inches)
+
+The units of a library are defined in the 'units' of its metadata
+(e.g. "length": ["mm", ["radius", "length"]])
+
+"""
+
+import logging
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from cadracks_party.library_reader import as_library
+
+logger = logging.getLogger(__name__)
+
+# key: unit symbol; value: (quantity, value of the unit in SI units)
+UNITS = {"mm": ("length", 1e-3),
+         "cm": ("length", 1e-2),
+         "m": ("length", 1.),
+         "in": ("length", 0.0254),
+         "inch": ("length", 0.0254),
+         "ft": ("length", 0.3048),
+         "g": ("mass", 1e-3),
+         "kg": ("mass", 1.),
+         "lb": ("mass", 0.45359237),
+         "N": ("force", 1.),
+         "kN": ("force", 1e3),
+         "lbf": ("force", 4.4482216152605)}
+
+
+def field_units(library):
+    r"""Unit of each field of a library
+
+    Parameters
+    ----------
+    library : str or LibraryReader
+        Path to the JSON file that describes the parts library, or an
+        already opened library
+
+    Returns
+    -------
+    dict : key: field name; value: unit (e.g. {'d_s_max': 'mm'})
+
+    """
+    return as_library(library).units_index
+
+
+def conversion_factor(from_unit, to_unit):
+    r"""Factor that converts a value in from_unit to a value in to_unit
+
+    Parameters
+    ----------
+    from_unit : str
+        Unit symbol (e.g. 'mm'), a key of UNITS
+    to_unit : str
+        Unit symbol (e.g. 'in'), a key of UNITS
+
+    Returns
+    -------
+    float
+
+    Raises
+    ------
+    ValueError if a unit is unknown or if the units do not measure the same
+    quantity
+
+    """
+    for unit in (from_unit, to_unit):
+        if unit not in UNITS:
+            raise ValueError("Unknown unit : %s" % unit)
+    from_quantity, from_value = UNITS[from_unit]
+    to_quantity, to_value = UNITS[to_unit]
+    if from_quantity != to_quantity:
+        raise ValueError("Cannot convert %s (%s) to %s (%s)" %
+                         (from_unit, from_quantity, to_unit, to_quantity))
+    return from_value / to_value
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _scale(column, factor):
+    r"""Values of column multiplied by factor, as Python floats"""
+    if np is not None and len(column) > 0:
+        return (np.asarray(column, dtype=np.float64) * factor).tolist()
+    return [value * factor for value in column]
+
+
+def convert_data(library, conversions):
+    r"""Copy of the data of a library, converted to other units
+
+    Each converted field is converted in one pass over the column of its
+    values in all parts (using NumPy if it is installed). The values that
+    are not numbers (e.g. strings, lists or None) are copied unchanged
+
+    Parameters
+    ----------
+    library : str or LibraryReader
+        Path to the JSON file that describes the parts library, or an
+        already opened library
+    conversions : dict
+        key: unit symbol of the library; value: unit symbol to convert to
+        (e.g. {"mm": "in"})
+
+    Returns
+    -------
+    tuple(dict, OrderedDict)
+        'units' of the metadata of the converted data
+        key: part id; value: dict of the converted part values,
+        in the order of the library
+
+    Raises
+    ------
+    ValueError if a conversion is impossible (see conversion_factor())
+
+    """
+    library = as_library(library)
+    factors = dict((from_unit, conversion_factor(from_unit, to_unit))
+                   for from_unit, to_unit in conversions.items())
+
+    units = OrderedDict()
+    for quantity, definition in library.metadata["units"].items():
+        if isinstance(definition, list) and len(definition) >= 2:
+            definition = [conversions.get(definition[0], definition[0]),
+                          list(definition[1])] + definition[2:]
+        units[quantity] = definition
+
+    data = OrderedDict((part_id, dict(part_values))
+                       for part_id, part_values in library.iter_data())
+
+    for field, from_unit in sorted(library.units_index.items()):
+        if from_unit not in factors or factors[from_unit] == 1.:
+            continue
+        rows = [part_values for part_values in data.values()
+                if _is_number(part_values.get(field))]
+        column = [part_values[field] for part_values in rows]
+        for part_values, value in zip(rows, _scale(column,
+                                                   factors[from_unit])):
+            part_values[field] = value
+        logger.debug("%s converted from %s to %s in %i part(s)" %
+                     (field, from_unit, conversions[from_unit], len(rows)))
+
+    return units, data
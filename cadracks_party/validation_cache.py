@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Copyright 2018-2019 Guillaume Florent, Thomas Paviot, Bernard Uguen
+
+# This file is part of cadracks-party.
+#
+# cadracks-party is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# cadracks-party is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cadracks-party.  If not, see <https://www.gnu.org/licenses/>.
+
+r"""validation_cache.py module
+
+On disk cache of the results of the checks of the parts, so that only the
+parts whose inputs changed are checked again
+
+The results are stored under a hash of everything they depend on (see
+validation_key()), so a single cache file can be shared by many libraries
+
+"""
+
+import json
+import hashlib
+import logging
+from os import replace
+from os.path import isfile
+
+from cadracks_party import __version__
+
+logger = logging.getLogger(__name__)
+
+# To be incremented when a check changes without a new party version
+CHECKS_VERSION = 1
+
+
+def validation_key(check, *inputs):
+    r"""Hash of the inputs of a check
+
+    Parameters
+    ----------
+    check : str
+        Name of the check (e.g. 'library', 'script')
+    inputs : JSON serializable objects
+        Everything the result of the check depends on
+
+    Returns
+    -------
+    str : hexadecimal digest
+
+    """
+    content = json.dumps([__version__, CHECKS_VERSION, check, inputs],
+                         sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class ValidationCache(object):
+    r"""Results of checks, stored under the hash of their inputs
+
+    The cache is read when created and written by save()
+
+    Parameters
+    ----------
+    filename : str
+        Path to the cache file. It does not have to exist
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+
+        self._results = dict()
+        self._used = set()
+        if isfile(self.filename):
+            try:
+                with open(self.filename) as cache_file:
+                    self._results = json.load(cache_file)["results"]
+            except (ValueError, KeyError):
+                logger.warning("Ignoring the invalid validation cache %s" %
+                               self.filename)
+
+    def get(self, key):
+        r"""Cached result of a check
+
+        Parameters
+        ----------
+        key : str
+            Hash of the inputs of the check (see validation_key())
+
+        Returns
+        -------
+        The result, or None if it is not in the cache
+
+        """
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._used.add(key)
+        return result
+
+    def set(self, key, result):
+        r"""Store the result of a check
+
+        Parameters
+        ----------
+        key : str
+        result : JSON serializable object, not None
+
+        """
+        self._results[key] = result
+        self._used.add(key)
+
+    def prune(self):
+        r"""Forget the results that were neither read nor stored since the
+        cache was created"""
+        self._results = dict((key, result)
+                             for key, result in self._results.items()
+                             if key in self._used)
+
+    def log_counts(self):
+        logger.info("Validation cache : %i hit(s), %i miss(es)" %
+                    (self.hits, self.misses))
+
+    def save(self):
+        r"""Write the cache file"""
+        tmp_filename = "%s.tmp" % self.filename
+        with open(tmp_filename, 'w') as cache_file:
+            json.dump({"results": self._results}, cache_file, sort_keys=True)
+        # replace in one step : an interrupted run never leaves a
+        # truncated cache behind
+        replace(tmp_filename, self.filename)
@@ -60,6 +60,7 @@ setup(
     extras_require={
         'dev': [],
         'test': ['pytest', 'coverage'],
+        'zstd': ['zstandard'],
     },
     package_data={},
     data_files=[],
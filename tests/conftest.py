@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Test configuration
+
+When the CAD kernel (ccad, aocxchange, pythonocc) is not installed, the
+stand-ins of the benchmarks are used, so that the generation and the
+checks of the scripts are tested without it. They build no geometry : the
+tests compare what the scripts and exporters are called with
+
+"""
+
+import sys
+from os.path import join, dirname, abspath
+
+STUBS_FOLDER = abspath(join(dirname(__file__), "..", "benchmarks", "stubs"))
+
+try:
+    import ccad  # noqa: F401
+except ImportError:
+    # appended : the installed packages come first
+    sys.path.append(STUBS_FOLDER)
@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Generation script that kills its process, like a CAD kernel crash"""
+
+import os
+
+from ccad.model import cylinder
+
+os._exit(139)
+
+part = cylinder(10., 100.)
+anchors = {}
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Generation script that never completes"""
+
+from ccad.model import cylinder
+
+while True:
+    pass
+
+part = cylinder(10., 100.)
+anchors = {}
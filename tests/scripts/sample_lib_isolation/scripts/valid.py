@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Generation script"""
+
+from ccad.model import cylinder
+
+part = cylinder(10., 100.)
+anchors = {}
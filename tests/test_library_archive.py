@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Tests for the library_archive module"""
+
+import pytest
+
+from cadracks_party.library_archive import LibraryArchiveWriter, \
+    archive_index, read_artifact
+
+
+def _write_archive(filename):
+    with LibraryArchiveWriter(filename) as writer:
+        writer.add_artifact("M2x16_A", "script", "scripts/M2x16_A.py",
+                            b"part = None\n")
+        writer.add_artifact("M2x16_A", "step", "steps/M2x16_A.stp",
+                            b"ISO-10303-21;")
+        writer.add_artifact("M2x20_A", "script", "scripts/M2x20_A.py",
+                            b"part = 1\n")
+        writer.add_drawing("4014", "svgs/4014.svg", b"<svg/>")
+
+
+def _formats():
+    formats = ["zip"]
+    try:
+        import zstandard  # noqa: F401
+        formats.append("tar.zst")
+    except ImportError:
+        pass
+    return formats
+
+
+@pytest.mark.parametrize("archive_format", _formats())
+def test_archive_index(tmpdir, archive_format):
+    filename = str(tmpdir.join("library.%s" % archive_format))
+    _write_archive(filename)
+    index = archive_index(filename)
+    assert index["parts"]["M2x16_A"] == {"script": "scripts/M2x16_A.py",
+                                         "step": "steps/M2x16_A.stp"}
+    assert index["drawings"] == {"4014": "svgs/4014.svg"}
+
+
+@pytest.mark.parametrize("archive_format", _formats())
+def test_read_artifact(tmpdir, archive_format):
+    filename = str(tmpdir.join("library.%s" % archive_format))
+    _write_archive(filename)
+    assert read_artifact(filename, "M2x20_A") == b"part = 1\n"
+    assert read_artifact(filename, "M2x16_A", "step") == b"ISO-10303-21;"
+    with pytest.raises(KeyError):
+        read_artifact(filename, "M2x20_A", "step")
+
+
+def test_unknown_archive_format(tmpdir):
+    with pytest.raises(ValueError):
+        LibraryArchiveWriter(str(tmpdir.join("library.rar")))
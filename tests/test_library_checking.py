@@ -7,7 +7,9 @@ from os.path import join, dirname
 import pytest
 
 from cadracks_party.library_checking import check_library_json_rules,\
-    check_library_units_definition, check_library_fields
+    check_library_units_definition, check_library_fields, check_all, \
+    check_library_stream
+from cadracks_party.library_reader import LibraryDocument
 
 
 # Rules checking related tests
@@ -86,6 +88,17 @@ def test_rules_checking_rules_syntax_error():
         _, _ = check_library_json_rules(json_file)
 
 
+def test_rules_checking_timings():
+    r"""The evaluation time of each rule is reported"""
+    json_file = join(dirname(__file__), "./json_files/library_many_errors.json")
+    timings = dict()
+    ok, errors = check_library_json_rules(json_file, timings=timings)
+    assert ok is False
+    broken_rules = set(rule for rules in errors.values() for rule in rules)
+    assert broken_rules <= set(timings.keys())
+    assert all(elapsed >= 0. for elapsed in timings.values())
+
+
 # Units related tests
 
 
@@ -146,3 +159,110 @@ def test_missing_field():
     # assert errors["624ZZ"] == set(["flange_diameter", "flange_thickness"])
     # assert errors["608ZZ"] == set(["flange_diameter", "flange_thickness"])
     assert errors["F63800ZZ"] == set(["flange_diameter", "flange_thickness"])
+
+
+def test_check_all_document(tmpdir):
+    r"""check_all() accepts a library parsed once, and does not read the
+    file again"""
+    json_file = join(dirname(__file__), "./json_files/library_many_errors.json")
+    expected = check_all(json_file)
+    copy = tmpdir.join("library.json")
+    copy.write(open(json_file).read())
+    document = LibraryDocument(str(copy))
+    copy.remove()
+    assert check_all(document) == expected
+
+
+# Error budget related tests
+
+
+def test_rules_checking_fail_fast():
+    r"""The check stops at the first broken rule"""
+    json_file = join(dirname(__file__),
+                     "./json_files/library_many_errors.json")
+    ok, errors = check_library_json_rules(json_file, fail_fast=True)
+    assert ok is False
+    assert sum(len(rules) for rules in errors.values()) == 1
+    ok, errors = check_library_json_rules(json_file, max_errors=2)
+    assert sum(len(rules) for rules in errors.values()) == 2
+
+
+def test_units_and_fields_max_errors():
+    json_file = join(dirname(__file__),
+                     "./json_files/library_missing_field.json")
+    ok, errors, _ = check_library_fields(json_file, fail_fast=True)
+    assert ok is False
+    assert len(errors) == 1
+    json_file = join(dirname(__file__),
+                     "./json_files/library_missing_units_definition.json")
+    ok, errors = check_library_units_definition(json_file, max_errors=1)
+    assert ok is False
+    assert sum(len(messages) for messages in errors.values()) == 1
+
+
+def test_check_all_fail_fast():
+    r"""The checks after the first error are not run"""
+    json_file = join(dirname(__file__),
+                     "./json_files/library_many_errors.json")
+    oks, errors = check_all(json_file, fail_fast=True)
+    assert oks == [False, None, None]
+    assert sum(len(rules) for rules in errors[0].values()) == 1
+    with pytest.raises(ValueError):
+        check_all(json_file, max_errors=0)
+
+
+# Streaming validation related tests
+
+
+DUPLICATES_LIBRARY = '''{
+  "metadata": {"name": "duplicates",
+               "units": {"length": ["mm", ["radius"]]}},
+  "generators": {"g": ["part = 1"], "g": ["part = 2"]},
+  "aliases": {"M1": {"radius": 1.0}, "M1": {"radius": 2.0}},
+  "data": {"p1": {"generator": "g", "radius": 1.0},
+           "p2": {"generator": "g", "radius": 2.0},
+           "p1": {"generator": "g", "radius": 3.0}}
+}'''
+
+
+def test_stream_duplicates(tmpdir):
+    r"""Duplicate keys, that json.load() drops, are reported"""
+    json_file = tmpdir.join("library.json")
+    json_file.write(DUPLICATES_LIBRARY)
+    ok, errors = check_library_stream(str(json_file))
+    assert ok is False
+    assert errors == {"duplicates": ["duplicate generator id 'g'",
+                                     "duplicate alias 'M1'",
+                                     "duplicate part id 'p1'"]}
+    ok, errors = check_library_stream(str(json_file), fail_fast=True)
+    assert errors == {"duplicates": ["duplicate generator id 'g'"]}
+
+
+@pytest.mark.parametrize("library", ["library_ok_units.json",
+                                     "library_missing_field.json",
+                                     "library_missing_units_definition.json"])
+def test_stream_same_as_checks(library):
+    r"""The streaming validation finds the fields and units errors of
+    check_library_fields() and check_library_units_definition()"""
+    json_file = join(dirname(__file__), "json_files", library)
+    _, errors = check_library_stream(json_file)
+    _, errors_units = check_library_units_definition(json_file)
+    _, errors_fields, _ = check_library_fields(json_file)
+    # the definition of the units is not checked by the streaming validation
+    errors_units.pop("units definition", None)
+    assert set(errors.keys()) == \
+        set(errors_units.keys()) | set(errors_fields.keys())
+    for part_id, messages in errors_units.items():
+        assert sorted(messages) == \
+            sorted(message for message in errors[part_id]
+                   if message.endswith("not defined in units"))
+
+
+def test_stream_metadata_after_data(tmpdir):
+    r"""The units are checked even if the metadata comes after the data"""
+    json_file = tmpdir.join("library.json")
+    json_file.write('{"data": {"p1": {"radius": 1.0, "length": 2.0}}, '
+                    '"metadata": {"units": {"length": ["mm", ["radius"]]}}}')
+    ok, errors = check_library_stream(str(json_file))
+    assert ok is False
+    assert errors == {"p1": ["field 'length' not defined in units"]}
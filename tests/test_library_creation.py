@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Tests for the library_creation module"""
+
+import json
+import os
+from os import listdir
+import pytest
+
+from cadracks_party.library_creation import create_skeleton, \
+    autocreate_library, template_handle_aliases, \
+    template_handle_nomenclature, handle_aliases, resolve_aliases, \
+    sort_aliases, handle_nomenclature, handle_includes, \
+    clear_includes_cache
+from cadracks_party.library_reader import LibraryReader
+
+
+ALIASES_TEMPLATE = {
+    "metadata": {"name": "aliases",
+                 "nomenclature": "'p_' + str(int(radius))",
+                 "units": {"length": ["mm", ["radius", "length"]]}},
+    "aliases": {"R1": {"radius": 1.0}, "R2": {"radius": 2.0}},
+    "data": {"a": {"size": "__alias__R1", "length": 3.0},
+             "b": {"size": "__alias__R2", "length": 4.0}}}
+
+
+def test_autocreate_skeleton(tmpdir):
+    r"""Only the library file is written"""
+    folder = tmpdir.join("cylinders")
+    create_skeleton(str(folder))
+    library_file = str(tmpdir.join("library.json"))
+    autocreate_library(str(folder.join("library_template.json")),
+                       library_file_name=library_file)
+    assert sorted(listdir(str(folder))) == \
+        ["drawings", "generators", "library_template.json"]
+    with open(library_file) as f:
+        library = json.load(f)
+    assert list(library["generators"].keys()) == ["cylinders"]
+    assert all(part_id.startswith("cylinder_") for part_id in library["data"])
+    assert LibraryReader(library_file).part_id("part_id_2") == \
+        "cylinder_20.0x40"
+
+
+def test_autocreate_same_as_file_functions(tmpdir):
+    r"""The library created in memory is the one created by chaining the file
+    functions"""
+    template_file = str(tmpdir.join("library_template.json"))
+    with open(template_file, 'w') as f:
+        json.dump(ALIASES_TEMPLATE, f)
+    library_file = str(tmpdir.join("library.json"))
+    autocreate_library(template_file, library_file_name=library_file)
+
+    files_library_file = str(tmpdir.join("files_library.json"))
+    template_handle_aliases(template_file, files_library_file)
+    template_handle_nomenclature(files_library_file, files_library_file)
+
+    with open(library_file) as f:
+        library = f.read()
+    with open(files_library_file) as f:
+        assert library == f.read()
+    library = json.loads(library)
+    assert "aliases" not in library
+    assert library["data"] == {"p_1": {"size": "R1", "radius": 1.0,
+                                       "length": 3.0},
+                               "p_2": {"size": "R2", "radius": 2.0,
+                                       "length": 4.0}}
+
+
+# Aliases related tests
+
+
+def test_nested_aliases():
+    r"""The values of a nested alias override the values of the alias that
+    refers to it, which override the part values"""
+    aliases = {"M1": {"d": 1.0, "grade": "__alias__A", "k": 2.0},
+               "A": {"k": 3.0, "tolerance": "__alias__T"},
+               "T": {"t": 0.1}}
+    assert sort_aliases(aliases).index("T") < sort_aliases(aliases).index("A")
+    assert resolve_aliases(aliases)["M1"] == {"d": 1.0, "grade": "A",
+                                              "k": 3.0, "tolerance": "T",
+                                              "t": 0.1}
+    content = handle_aliases({"aliases": aliases,
+                              "data": {"p": {"size": "__alias__M1",
+                                             "d": 5.0, "l": 4.0}}})
+    assert content == {"data": {"p": {"size": "M1", "d": 1.0, "l": 4.0,
+                                      "grade": "A", "k": 3.0,
+                                      "tolerance": "T", "t": 0.1}}}
+
+
+def test_cyclic_aliases():
+    aliases = {"A": {"x": 1.0, "b": "__alias__B"},
+               "B": {"c": "__alias__C"},
+               "C": {"a": "__alias__A"}}
+    with pytest.raises(ValueError) as e:
+        resolve_aliases(aliases)
+    assert "A -> B -> C -> A" in str(e.value)
+    with pytest.raises(ValueError):
+        resolve_aliases({"A": {"a": "__alias__A"}})
+
+
+def test_unknown_alias():
+    with pytest.raises(KeyError):
+        resolve_aliases({"A": {"b": "__alias__B"}})
+    with pytest.raises(KeyError):
+        handle_aliases({"aliases": {},
+                        "data": {"p": {"size": "__alias__M1"}}})
+
+
+# Nomenclature related tests
+
+
+def test_nomenclature():
+    r"""The parts are renamed in place, and their template ids are kept"""
+    content = {"metadata": {"nomenclature": "prefix + str(int(d))"},
+               "data": {"a": {"prefix": "M", "d": 1.0},
+                        "M2": {"prefix": "M", "d": 2.0},
+                        "c": {"prefix": "N", "d": 3.0}},
+               "drawings": {"d": ["<svg/>"]}}
+    drawings = content["drawings"]
+    content = handle_nomenclature(content)
+    assert list(content["data"].keys()) == ["M1", "M2", "N3"]
+    assert content["template_ids"] == {"a": "M1", "c": "N3"}
+    # the other sections are not copied
+    assert content["drawings"] is drawings
+
+
+def test_nomenclature_without_metadata(tmpdir):
+    r"""Without a nomenclature, the part ids are kept and the output file is
+    not written"""
+    content = {"data": {"a": {"d": 1.0}}}
+    assert handle_nomenclature(content) == {"data": {"a": {"d": 1.0}}}
+    file_in = tmpdir.join("template.json")
+    file_in.write(json.dumps(content))
+    file_out = tmpdir.join("library.json")
+    template_handle_nomenclature(str(file_in), str(file_out))
+    assert not file_out.check()
+
+
+# Includes related tests
+
+
+def test_includes(tmpdir):
+    r"""The aliases of the include files are available to the template, which
+    may override them"""
+    clear_includes_cache()
+    tmpdir.mkdir("common")
+    tmpdir.join("common", "threads.json").write(json.dumps(
+        {"M1": {"p": 0.25, "d": 1.0}, "M2": {"p": 0.4, "d": 2.0}}))
+    template = dict(ALIASES_TEMPLATE,
+                    includes=["common/threads.json"],
+                    aliases={"R1": {"radius": 1.0, "thread": "__alias__M1"},
+                             "R2": {"radius": 2.0, "thread": "__alias__M2"},
+                             "M2": {"p": 0.45, "d": 2.0}})
+    template_file = str(tmpdir.join("library_template.json"))
+    with open(template_file, 'w') as f:
+        json.dump(template, f)
+    library_file = str(tmpdir.join("library.json"))
+    autocreate_library(template_file, library_file_name=library_file)
+    with open(library_file) as f:
+        library = json.load(f)
+    assert "includes" not in library
+    assert "aliases" not in library
+    assert library["data"]["p_1"]["p"] == 0.25
+    assert library["data"]["p_2"]["p"] == 0.45
+
+
+def test_includes_read_once(tmpdir):
+    r"""An include file is parsed again only if it was modified"""
+    clear_includes_cache()
+    include_file = tmpdir.join("threads.json")
+    include_file.write(json.dumps({"M1": {"p": 0.25}}))
+    os.utime(str(include_file), (1000000000, 1000000000))
+
+    def included_aliases():
+        return handle_includes({"includes": ["threads.json"]},
+                               str(tmpdir))["aliases"]
+
+    assert included_aliases() == {"M1": {"p": 0.25}}
+    # same modification time and size : the cached aliases are used
+    include_file.write(json.dumps({"M1": {"p": 0.35}}))
+    os.utime(str(include_file), (1000000000, 1000000000))
+    assert included_aliases() == {"M1": {"p": 0.25}}
+    # modification time changed by a millisecond
+    os.utime(str(include_file), ns=(1000000000001000000,
+                                    1000000000001000000))
+    assert included_aliases() == {"M1": {"p": 0.35}}
+    # same modification time, other size
+    include_file.write(json.dumps({"M1": {"p": 0.3}}))
+    os.utime(str(include_file), ns=(1000000000001000000,
+                                    1000000000001000000))
+    assert included_aliases() == {"M1": {"p": 0.3}}
+
+    include_file.write(json.dumps(["M1"]))
+    with pytest.raises(ValueError):
+        included_aliases()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Tests for the library_reader module"""
+
+import io
+import json
+from os.path import join, dirname
+import pytest
+
+from cadracks_party.library_reader import LibraryReader, LibraryDocument
+
+
+def test_reader_sections():
+    json_file = join(dirname(__file__), "./json_files/good_library.json")
+    with open(json_file) as f:
+        json_file_content = json.load(f)
+    library = LibraryReader(json_file)
+    assert library.sections() == list(json_file_content.keys())
+    assert library.metadata == json_file_content["metadata"]
+    assert library.generators == json_file_content["generators"]
+    assert library.rules == json_file_content["rules"]
+    assert "drawings" not in library
+    with pytest.raises(KeyError):
+        _ = library.drawings
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 1 << 16])
+def test_reader_data(chunk_size):
+    json_file = join(dirname(__file__), "./json_files/good_library.json")
+    with open(json_file) as f:
+        json_file_content = json.load(f)
+    library = LibraryReader(json_file, chunk_size=chunk_size)
+    data = list(library.iter_data())
+    assert data == list(json_file_content["data"].items())
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1 << 16])
+def test_reader_tricky_strings(tmpdir, chunk_size):
+    r"""Strings containing escaped quotes, backslashes, structural
+    characters and non-ascii characters"""
+    content = {"metadata": {"name": "lé {[\"\\"},
+               "data": {"a\"}": {"description": "\\\"]},{µ",
+                                 "values": [1, {"x": "}"}, None, True]},
+                        "b": {"description": "", "values": []}},
+               "rules": ["x > 0"]}
+    json_file = str(tmpdir.join("library.json"))
+    with io.open(json_file, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(content, ensure_ascii=False, indent=2))
+    library = LibraryReader(json_file, chunk_size=chunk_size)
+    assert library.metadata == content["metadata"]
+    assert library.rules == content["rules"]
+    assert dict(library.iter_data()) == content["data"]
+
+
+def test_reader_truncated_file(tmpdir):
+    json_file = str(tmpdir.join("library.json"))
+    with open(json_file, 'w') as f:
+        f.write('{"data": {"a": {"x": 1}, "b": {"x"')
+    with pytest.raises(ValueError):
+        LibraryReader(json_file).sections()
+
+
+def test_reader_scans_up_to_the_section(tmpdir):
+    r"""The sections before 'data' and the first parts are read without
+    scanning the rest of the file"""
+    json_file = str(tmpdir.join("library.json"))
+    with open(json_file, 'w') as f:
+        f.write('{"rules": ["x > 0"], "data": {"a": {"x": 1}, "b": {"x"')
+    library = LibraryReader(json_file)
+    assert library.rules == ["x > 0"]
+    data = library.iter_data()
+    assert next(data) == ("a", {"x": 1})
+    with pytest.raises(ValueError):
+        library.sections()
+
+
+def test_document_same_as_reader(tmpdir):
+    r"""A LibraryDocument gives the same content as a LibraryReader, without
+    reading the file again"""
+    json_file = join(dirname(__file__), "./json_files/library_ok_units.json")
+    reader = LibraryReader(json_file)
+    copy = tmpdir.join("library.json")
+    copy.write(open(json_file).read())
+    document = LibraryDocument(str(copy))
+    copy.remove()
+    assert document.sections() == reader.sections()
+    assert document.metadata == reader.metadata
+    assert document.rules == reader.rules
+    assert list(document.iter_data()) == list(reader.iter_data())
+    assert document.reference_fields == reader.reference_fields
+    assert document.units_index == reader.units_index
+    assert document.units_index["d_s_max"] == "mm"
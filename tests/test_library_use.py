@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Tests for the library_use module
+
+Without the CAD kernel, the stand-ins of the benchmarks are used (see
+conftest.py) : the STEP and STL files then hold a description of the calls
+that built the shapes
+
+"""
+
+import os
+import sys
+import copy
+import json
+import subprocess
+from os.path import join, dirname, isdir, abspath
+
+import pytest
+
+from cadracks_party import library_use
+from cadracks_party.library_use import generate, generate_step_catalog
+from cadracks_party.library_archive import archive_index, read_artifact
+from cadracks_party.templating import GeneratorCodes
+from cadracks_party.step_catalog import StepCatalogExporter
+
+from tests.conftest import STUBS_FOLDER
+
+# "named" uses a placeholder in a longer string : it has to be rendered
+LIBRARY = {
+    "metadata": {"name": "test-library",
+                 "units": {"length": ["mm", ["radius", "length", "size"]]}},
+    "generators": {
+        "cylinder": "from ccad.model import cylinder\n"
+                    "\n"
+                    "radius = {{ radius }}\n"
+                    "length = {{ length }}\n"
+                    "\n"
+                    "part = cylinder(radius, length)\n"
+                    "__shape__ = part.shape\n"
+                    "__anchors__ = {\"top\": {\"p\": (0., 0., length),\n"
+                    "                       \"u\": (0., 0., 1.),\n"
+                    "                       \"v\": (1., 0., 0.)}}\n",
+        "named": "from ccad.model import box\n"
+                 "\n"
+                 "name = \"box_{{ size }}\"\n"
+                 "part = box({{ size }}, {{ size }}, 1.)\n"
+                 "__shape__ = part.shape\n"
+                 "__anchors__ = {name: {\"p\": (0., 0., 0.),\n"
+                 "                      \"u\": (0., 0., -1.),\n"
+                 "                      \"v\": (1., 0., 0.)}}\n"},
+    "rules": [],
+    "data": dict(
+        [("c%i" % i, {"generator": "cylinder", "radius": float(i),
+                      "length": 10. * i}) for i in range(1, 6)] +
+        [("b%i" % i, {"generator": "named", "size": float(i)})
+         for i in range(1, 4)]),
+    "drawings": {"drawing": "<svg/>\n"}}
+
+OUTPUT_FOLDERS = ("scripts", "steps", "stls", "svgs")
+
+
+def _library(folder, library=None):
+    r"""Write a library.json in folder and return its path"""
+    if not isdir(folder):
+        os.makedirs(folder)
+    json_file = join(folder, "library.json")
+    with open(json_file, 'w') as f:
+        json.dump(LIBRARY if library is None else library, f, indent=2)
+    return json_file
+
+
+def _outputs(folder):
+    r"""Generated files below folder (key: relative path; value: content)"""
+    outputs = dict()
+    for output_folder in OUTPUT_FOLDERS:
+        if not isdir(join(folder, output_folder)):
+            continue
+        for filename in os.listdir(join(folder, output_folder)):
+            with open(join(folder, output_folder, filename), 'rb') as f:
+                outputs["%s/%s" % (output_folder, filename)] = f.read()
+    return outputs
+
+
+# Parallel generation related tests
+
+
+def test_generate_parallel_same_as_serial(tmpdir):
+    serial = _library(str(tmpdir.join("serial")))
+    parallel = _library(str(tmpdir.join("parallel")))
+    generate(serial, generate_steps=True, generate_stls=True,
+             generate_svgs=True)
+    generate(parallel, generate_steps=True, generate_stls=True,
+             generate_svgs=True, workers=2, parts_per_worker=2)
+    serial_outputs = _outputs(dirname(serial))
+    assert len(serial_outputs) == 3 * len(LIBRARY["data"]) + 1
+    assert _outputs(dirname(parallel)) == serial_outputs
+
+
+def test_party_use_cli(tmpdir):
+    r"""party-use generates the scripts and the requested CAD files"""
+    json_file = _library(str(tmpdir))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [abspath(join(dirname(__file__), ".."))] +
+        [path for path in sys.path if path == STUBS_FOLDER])
+    subprocess.check_call([sys.executable,
+                           join(dirname(__file__), "..", "bin", "party-use"),
+                           "--steps", "--stls", "--jobs", "2",
+                           "--step-catalog", "catalog.stp"],
+                          cwd=dirname(json_file), env=env)
+    outputs = _outputs(dirname(json_file))
+    for part_id in LIBRARY["data"]:
+        assert "scripts/%s.py" % part_id in outputs
+        assert "steps/%s.stp" % part_id in outputs
+        assert "stls/%s.stl" % part_id in outputs
+    assert len(_products(join(dirname(json_file), "catalog.stp"))) == \
+        len(LIBRARY["data"])
+
+
+# STEP catalog related tests
+
+
+def _products(step_filename):
+    r"""(product name, shape description) of the STEP file of the stand-in
+    STEP writer"""
+    with open(step_filename) as f:
+        return [tuple(line.rstrip("\n").split(" ", 1)) for line in f]
+
+
+def test_step_catalog_product_names(tmpdir):
+    json_file = _library(str(tmpdir))
+    step_filename = str(tmpdir.join("catalog.stp"))
+    part_ids = generate_step_catalog(json_file, step_filename)
+    assert part_ids == list(LIBRARY["data"].keys())
+    products = _products(step_filename)
+    assert [name for name, _ in products] == part_ids
+    # one product per part, built from the part data
+    assert len(set(description for _, description in products)) == \
+        len(part_ids)
+
+
+def test_step_catalog_part_ids_subset(tmpdir):
+    json_file = _library(str(tmpdir))
+    step_filename = str(tmpdir.join("catalog.stp"))
+    # the order of the library is kept
+    part_ids = generate_step_catalog(json_file, step_filename,
+                                     part_ids=["b2", "c3", "c1"])
+    assert sorted(part_ids) == ["b2", "c1", "c3"]
+    assert part_ids == [part_id for part_id in LIBRARY["data"]
+                        if part_id in ("b2", "c3", "c1")]
+    assert [name for name, _ in _products(step_filename)] == part_ids
+
+
+def test_step_catalog_unknown_part_id(tmpdir):
+    json_file = _library(str(tmpdir))
+    step_filename = str(tmpdir.join("catalog.stp"))
+    with pytest.raises(KeyError) as excinfo:
+        generate_step_catalog(json_file, step_filename,
+                              part_ids=["c1", "x1", "x2"])
+    assert "x1, x2" in str(excinfo.value)
+    assert not os.path.isfile(step_filename)
+
+
+def test_step_catalog_exporter(tmpdir):
+    from ccad.model import box
+    step_filename = str(tmpdir.join("catalog.stp"))
+    exporter = StepCatalogExporter(step_filename)
+    exporter.add_shape(u"part_1", box(1., 2., 3.).shape)
+    exporter.add_shape(2, box(4., 5., 6.).shape)
+    exporter.write_file()
+    assert exporter.part_ids == [u"part_1", 2]
+    assert [name for name, _ in _products(step_filename)] == ["part_1", "2"]
+
+
+# Shape building related tests
+
+
+@pytest.mark.parametrize("parametric", [False, True])
+def test_generate_builds_each_shape_once(tmpdir, monkeypatch, parametric):
+    r"""The STEP and STL files of a part come from a single execution of
+    its script"""
+    import ccad.model
+    built = list()
+
+    def counted(build):
+        def wrapper(*args):
+            built.append(args)
+            return build(*args)
+        return wrapper
+
+    # the scripts import the functions when they are executed
+    for name in ("cylinder", "box"):
+        monkeypatch.setattr(ccad.model, name,
+                            counted(getattr(ccad.model, name)))
+    json_file = _library(str(tmpdir))
+    generate(json_file, generate_steps=True, generate_stls=True,
+             parametric=parametric)
+    assert len(built) == len(LIBRARY["data"])
+    assert len(_outputs(dirname(json_file))) == 3 * len(LIBRARY["data"])
+
+
+# Incremental generation related tests
+
+
+def test_generate_incremental(tmpdir, monkeypatch):
+    generated = list()
+    generate_part = library_use._generate_part
+
+    def counted(*args):
+        generated.append(args[5])
+        return generate_part(*args)
+
+    monkeypatch.setattr(library_use, "_generate_part", counted)
+    library = copy.deepcopy(LIBRARY)
+    json_file = _library(str(tmpdir), library)
+    folder = dirname(json_file)
+
+    generate(json_file, generate_steps=True, incremental=True)
+    assert sorted(generated) == sorted(library["data"].keys())
+    outputs = _outputs(folder)
+
+    # unchanged parts are skipped
+    del generated[:]
+    generate(json_file, generate_steps=True, incremental=True)
+    assert generated == []
+    assert _outputs(folder) == outputs
+
+    # a part whose data changed is generated again
+    library["data"]["c1"]["radius"] = 1.5
+    _library(str(tmpdir), library)
+    generate(json_file, generate_steps=True, incremental=True)
+    assert generated == ["c1"]
+    edited_outputs = _outputs(folder)
+    for name in ("scripts/c1.py", "steps/c1.stp"):
+        assert edited_outputs[name] != outputs[name]
+    assert dict((name, content) for name, content in edited_outputs.items()
+                if "c1." not in name) == \
+        dict((name, content) for name, content in outputs.items()
+             if "c1." not in name)
+
+    # the files of a deleted part are removed
+    del generated[:]
+    del library["data"]["b3"]
+    _library(str(tmpdir), library)
+    generate(json_file, generate_steps=True, incremental=True)
+    assert generated == []
+    assert sorted(_outputs(folder).keys()) == \
+        sorted(name for name in edited_outputs if "b3." not in name)
+
+    # every part is generated by default
+    generate(json_file, generate_steps=True)
+    assert sorted(generated) == sorted(library["data"].keys())
+
+
+# Template cache related tests
+
+
+def test_generate_bytecode_cache(tmpdir):
+    json_file = _library(str(tmpdir.join("library")))
+    cache_folder = str(tmpdir.join("cache"))
+    generate(json_file, generate_steps=True, generate_stls=True,
+             bytecode_cache_folder=cache_folder, incremental=False)
+    first_outputs = _outputs(dirname(json_file))
+    cached = sorted(os.listdir(cache_folder))
+    assert len(cached) > 0
+    # the second run uses the compiled templates of the first one
+    generate(json_file, generate_steps=True, generate_stls=True,
+             bytecode_cache_folder=cache_folder, incremental=False)
+    assert sorted(os.listdir(cache_folder)) == cached
+    assert _outputs(dirname(json_file)) == first_outputs
+    # same output as without the cache
+    uncached_file = _library(str(tmpdir.join("uncached")))
+    generate(uncached_file, generate_steps=True, generate_stls=True)
+    assert _outputs(dirname(uncached_file)) == first_outputs
+
+
+# Archive related tests
+
+
+def _archive_formats():
+    formats = ["zip"]
+    try:
+        import zstandard  # noqa: F401
+        formats.append("tar.zst")
+    except ImportError:
+        pass
+    return formats
+
+
+@pytest.mark.parametrize("archive_format", _archive_formats())
+def test_generate_archive_same_as_files(tmpdir, archive_format):
+    json_file = _library(str(tmpdir.join("files")))
+    generate(json_file, generate_steps=True, generate_stls=True,
+             generate_svgs=True)
+    outputs = _outputs(dirname(json_file))
+
+    archived_file = _library(str(tmpdir.join("archived")))
+    archive = str(tmpdir.join("library.%s" % archive_format))
+    generate(archived_file, generate_steps=True, generate_stls=True,
+             generate_svgs=True, archive=archive)
+    # nothing is written next to the library
+    assert _outputs(dirname(archived_file)) == {}
+
+    index = archive_index(archive)
+    assert sorted(index["parts"].keys()) == sorted(LIBRARY["data"].keys())
+    archived = dict()
+    for part_id, artifacts in index["parts"].items():
+        assert sorted(artifacts.keys()) == ["script", "step", "stl"]
+        for kind, member_name in artifacts.items():
+            archived[member_name.replace(os.sep, "/")] = \
+                read_artifact(archive, part_id, kind)
+    assert sorted(index["drawings"].values()) == \
+        [join("svgs", "drawing.svg")]
+    assert archived == dict((name, content)
+                            for name, content in outputs.items()
+                            if not name.startswith("svgs/"))
+
+
+# Parametric generation related tests
+
+
+def _script_namespace(py_geometry_file):
+    r"""Namespace of a geometry script after its execution"""
+    namespace = dict()
+    with open(py_geometry_file) as f:
+        exec(compile(f.read(), py_geometry_file, "exec"), namespace)
+    return namespace
+
+
+def test_generate_parametric_same_as_rendered(tmpdir):
+    rendered = _library(str(tmpdir.join("rendered")))
+    parametric = _library(str(tmpdir.join("parametric")))
+    generate(rendered, generate_steps=True, generate_stls=True)
+    generate(parametric, generate_steps=True, generate_stls=True,
+             parametric=True)
+    rendered_outputs = _outputs(dirname(rendered))
+    assert _outputs(dirname(parametric)) == rendered_outputs
+
+    # Same anchors as the rendered scripts, except for the generator that
+    # has to be rendered, which is not compiled
+    codes = GeneratorCodes(LIBRARY["generators"])
+    assert codes.get_code("named") is None
+    for part_id, part_values in LIBRARY["data"].items():
+        if part_values["generator"] != "cylinder":
+            continue
+        namespace = dict(part_values)
+        exec(codes.get_code("cylinder"), namespace)
+        script = _script_namespace(join(dirname(rendered), "scripts",
+                                        "%s.py" % part_id))
+        assert namespace["__anchors__"] == script["__anchors__"]
+
+
+def test_generate_parametric_no_scripts(tmpdir):
+    rendered = _library(str(tmpdir.join("rendered")))
+    parametric = _library(str(tmpdir.join("parametric")))
+    generate(rendered, generate_steps=True, generate_stls=True)
+    generate(parametric, generate_steps=True, generate_stls=True,
+             parametric=True, write_scripts=False)
+    rendered_outputs = _outputs(dirname(rendered))
+    parametric_outputs = _outputs(dirname(parametric))
+    # the scripts of the generator that has to be rendered are still written
+    assert sorted(name for name in parametric_outputs
+                  if name.startswith("scripts/")) == \
+        ["scripts/b1.py", "scripts/b2.py", "scripts/b3.py"]
+    assert parametric_outputs == \
+        dict((name, content) for name, content in rendered_outputs.items()
+             if not name.startswith("scripts/c"))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Tests for the manifest module"""
+
+from os.path import join
+
+from cadracks_party.manifest import Manifest, part_hash
+
+
+def _touch(folder, filename):
+    with open(join(folder, filename), 'w') as f:
+        f.write("")
+
+
+def test_part_hash():
+    h = part_hash(["radius = {{ radius }}"], {"radius": 1.}, {"steps": True})
+    assert h == part_hash(["radius = {{ radius }}"], {"radius": 1.},
+                          {"steps": True})
+    assert h != part_hash(["radius = {{ radius }}"], {"radius": 2.},
+                          {"steps": True})
+    assert h != part_hash(["radius = {{ radius }}"], {"radius": 1.},
+                          {"steps": False})
+
+
+def test_manifest_up_to_date(tmpdir):
+    folder = str(tmpdir)
+    _touch(folder, "part.py")
+    manifest = Manifest(folder)
+    assert manifest.is_up_to_date("part", "h1", ["part.py"]) is False
+    manifest.update("part", "h1", ["part.py"])
+    manifest.save()
+
+    manifest = Manifest(folder)
+    assert manifest.is_up_to_date("part", "h1", ["part.py"]) is True
+    assert manifest.is_up_to_date("part", "h2", ["part.py"]) is False
+    # a generated file is missing
+    assert manifest.is_up_to_date("part", "h1",
+                                  ["part.py", "part.stp"]) is False
+
+
+def test_manifest_remove(tmpdir):
+    folder = str(tmpdir)
+    _touch(folder, "part.py")
+    _touch(folder, "part.stp")
+    manifest = Manifest(folder)
+    manifest.update("part", "h1", ["part.py", "part.stp"])
+
+    # The STEP file is not generated anymore
+    manifest.update("part", "h2", ["part.py"])
+    assert tmpdir.join("part.stp").check() is False
+    assert tmpdir.join("part.py").check() is True
+
+    manifest.remove("part")
+    assert tmpdir.join("part.py").check() is False
+    assert manifest.part_ids() == []
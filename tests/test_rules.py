@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Tests for rules.py"""
+
+from os.path import join, dirname
+import pytest
+
+from cadracks_party.library_checking import check_library_json_rules
+from cadracks_party.rules import compile_rules, iter_broken_rules, \
+    iter_broken_rules_vectorized, unknown_rule_names, RuleMemo, MEMO_MAXSIZE
+from cadracks_party.validation_cache import ValidationCache
+
+RULES = ["radius > 0",
+         "length > radius",
+         "0 < radius < length / 2",
+         "not radius == 3 or length >= 2 * radius ** 2",
+         "material == 'steel'",
+         "length % 4 != 1 and -radius < 0",
+         "abs(radius) > 1"]
+
+PARTS = [("p1", {"radius": 1, "length": 10., "material": "steel"}),
+         ("p2", {"radius": -1., "length": 0, "material": "brass"}),
+         ("p3", {"radius": 3, "length": 5, "material": "steel"}),
+         ("p4", {"radius": True, "length": 5, "material": "steel"}),
+         ("p5", {"length": 9, "material": "steel"}),
+         ("p6", {"radius": 2 ** 60, "length": 2 ** 60 + 1,
+                 "material": "steel"}),
+         ("p7", {"radius": 2., "length": 5., "material": None})]
+
+
+def test_vectorizable_rules():
+    r"""Only the arithmetic and comparison rules are vectorized"""
+    compiled_rules = compile_rules(RULES)
+    assert [compiled_rule.vectorized is not None
+            for compiled_rule in compiled_rules] == \
+        [True, True, True, True, False, True, False]
+    assert compiled_rules[3].names == {"radius", "length"}
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 100])
+def test_vectorized_same_results(block_size):
+    r"""The vectorized evaluation reports the same broken rules, in the same
+    order, as the part by part evaluation"""
+    pytest.importorskip("numpy")
+    expected = list(iter_broken_rules(compile_rules(RULES[:4] + RULES[5:]),
+                                      PARTS))
+    assert len(expected) > 0
+    assert list(iter_broken_rules_vectorized(
+        compile_rules(RULES[:4] + RULES[5:]), PARTS,
+        block_size=block_size)) == expected
+
+
+def test_vectorized_by_blocks():
+    r"""The parts are read one block at a time"""
+    pytest.importorskip("numpy")
+    read = list()
+
+    def parts():
+        for i in range(25):
+            read.append(i)
+            yield "p%i" % i, {"radius": float(i)}
+
+    broken_rules = iter_broken_rules_vectorized(compile_rules(["radius > 0"]),
+                                                parts(), block_size=10)
+    assert next(broken_rules) == ("p0", "radius > 0", False)
+    assert len(read) == 10
+    assert list(broken_rules) == []
+    assert len(read) == 25
+
+
+def test_vectorized_same_exception():
+    r"""An exception raised by a rule is the one of the part by part
+    evaluation"""
+    pytest.importorskip("numpy")
+    parts = [("p1", {"a": 1., "b": 1.}),
+             ("p2", {"a": 1., "b": 0.}),
+             ("p3", {"a": "x", "b": 2.})]
+    rules = ["a > 0", "a / b > 0", "b == 'y'"]
+    with pytest.raises(ZeroDivisionError):
+        list(iter_broken_rules(compile_rules(rules), parts))
+    with pytest.raises(ZeroDivisionError):
+        list(iter_broken_rules_vectorized(compile_rules(rules), parts))
+    with pytest.raises(ZeroDivisionError):
+        list(iter_broken_rules_vectorized(compile_rules(rules), parts,
+                                          block_size=1))
+
+
+@pytest.mark.parametrize("library", ["good_library.json",
+                                     "library_many_errors.json",
+                                     "library_wrong_rules.json",
+                                     "library_negative_weight_s.json"])
+def test_check_library_json_rules_vectorized(library):
+    r"""check_library_json_rules() gives the same errors with and without
+    NumPy"""
+    pytest.importorskip("numpy")
+    json_file = join(dirname(__file__), "json_files", library)
+    assert check_library_json_rules(json_file, vectorized=True) == \
+        check_library_json_rules(json_file, vectorized=False)
+
+
+def test_unknown_rule_names():
+    r"""The names that are neither fields nor builtins are reported"""
+    compiled_rules = compile_rules(RULES + ["out_diam > radius",
+                                            "all(x > 0 for x in [radius])"])
+    assert compiled_rules[-1].names == {"all", "radius"}
+    assert unknown_rule_names(compiled_rules,
+                              ["radius", "length", "material"]) == \
+        {"out_diam > radius": ["out_diam"]}
+
+
+def test_memo():
+    r"""A rule is evaluated once per distinct values of the fields it reads,
+    1, 1. and True being distinct values"""
+    compiled_rules = compile_rules(["radius > 0", "radius == 1.0"])
+    parts = [("p%i" % i, {"radius": 1., "length": float(i)})
+             for i in range(10)] + \
+            [("q1", {"radius": 1}), ("q2", {"radius": True}), ("q3", {})]
+    memo = RuleMemo()
+    expected = list(iter_broken_rules(compile_rules(["radius > 0",
+                                                     "radius == 1.0"]),
+                                      parts))
+    assert list(iter_broken_rules(compiled_rules, parts, memo)) == expected
+    assert [compiled_rule.evaluations
+            for compiled_rule in compiled_rules] == [4, 4]
+
+
+def test_memo_bounded():
+    r"""The memo keeps at most maxsize outcomes, the most recently used
+    ones, whatever the number of distinct values"""
+    compiled_rules = compile_rules(["radius > 0", "length > radius"])
+    memo = RuleMemo()
+    parts = (("p%i" % i, {"radius": float(i), "length": 1.})
+             for i in range(2 * MEMO_MAXSIZE))
+    broken = list(iter_broken_rules(compiled_rules, parts, memo))
+    assert len(broken) == 2 * MEMO_MAXSIZE
+    assert len(memo) == MEMO_MAXSIZE
+
+    # a shared value used by every other part is not evicted
+    compiled_rules = compile_rules(["radius > 0"])
+    memo = RuleMemo(maxsize=3)
+    parts = [("p%i" % i, {"radius": 1. if i % 2 == 0 else i + 0.5})
+             for i in range(100)]
+    assert list(iter_broken_rules(compiled_rules, parts, memo)) == []
+    assert len(memo) == 3
+    assert compiled_rules[0].evaluations == 51
+
+
+def test_memo_cache(tmpdir):
+    r"""The memoized results are stored to the validation cache"""
+    cache = ValidationCache(str(tmpdir.join("cache.json")))
+    parts = [("p1", {"radius": 1.}), ("p2", {"radius": -1.})]
+    expected = list(iter_broken_rules(compile_rules(RULES[:1]), parts,
+                                      RuleMemo(cache)))
+    compiled_rules = compile_rules(RULES[:1])
+    assert list(iter_broken_rules(compiled_rules, parts,
+                                  RuleMemo(cache))) == expected
+    assert compiled_rules[0].evaluations == 0
+    assert cache.hits == 2
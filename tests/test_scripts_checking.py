@@ -6,7 +6,11 @@ r"""Tests for the scripts_checking module"""
 import pytest
 from os.path import join, dirname, isdir
 from cadracks_party.scripts_checking import check_script,\
-    check_all_scripts_from_library_jsons
+    check_all_scripts_from_library_jsons, STATUS_TIMEOUT, STATUS_CRASH, \
+    STATUS_ERROR, STATUS_MISSING, STATUS_FAILED, check_script_static, \
+    check_source_static, check_library_generators_static, \
+    _check_scripts_in_processes
+from cadracks_party.validation_cache import ValidationCache
 
 
 def test_check_all_scripts_lib_ok():
@@ -76,3 +80,127 @@ def test_invalid_script_part_and_anchors_not_defined():
              "scripts/invalid_part_and_anchors_not_defined.py"))
     assert ok is False
     assert len(errors) == 2
+
+
+def test_check_all_scripts_isolation():
+    r"""Scripts that hang, crash or raise are reported, and do not prevent the
+    other scripts from being checked"""
+    ok, all_errors = check_all_scripts_from_library_jsons(
+        join(dirname(__file__), "scripts/sample_lib_isolation"),
+        workers=2,
+        timeout=2.)
+    assert ok is False
+    assert len(all_errors) == 1
+    errors = list(all_errors.values())[0]
+    assert dict((part_id, part_errors["status"])
+                for part_id, part_errors in errors.items()) == \
+        {"hangs": STATUS_TIMEOUT,
+         "crashes": STATUS_CRASH,
+         "raises": STATUS_ERROR,
+         "missing": STATUS_MISSING}
+
+
+def test_check_all_scripts_isolation_one_worker():
+    r"""The process that hangs or crashes is replaced"""
+    ok, all_errors = check_all_scripts_from_library_jsons(
+        join(dirname(__file__), "scripts/sample_lib_isolation"),
+        workers=1,
+        timeout=2.)
+    errors = list(all_errors.values())[0]
+    assert sorted(errors.keys()) == ["crashes", "hangs", "missing", "raises"]
+
+
+def _pid_scripts(folder, count):
+    r"""Scripts that write the id of the process executing them"""
+    jobs = list()
+    for i in range(count):
+        script = folder.join("script_%i.py" % i)
+        script.write("import os\n"
+                     "from ccad.model import cylinder\n"
+                     "with open(__file__ + '.pid', 'w') as f:\n"
+                     "    f.write(str(os.getpid()))\n"
+                     "part = cylinder(10., 100.)\n"
+                     "anchors = {}\n")
+        jobs.append((i, str(script)))
+    return jobs
+
+
+@pytest.mark.parametrize("scripts_per_worker, processes",
+                         [(None, 1), (2, 3), (1, 5)])
+def test_check_scripts_worker_reuse(tmpdir, scripts_per_worker, processes):
+    jobs = _pid_scripts(tmpdir, 5)
+    results = list(_check_scripts_in_processes(
+        jobs, 1, 10., None, scripts_per_worker=scripts_per_worker))
+    assert sorted(results) == [(i, None, []) for i in range(5)]
+    pids = set(tmpdir.join("script_%i.py.pid" % i).read() for i in range(5))
+    assert len(pids) == processes
+
+
+def test_check_all_scripts_cached(tmpdir):
+    r"""Unchanged scripts are not checked again"""
+    cache = ValidationCache(str(tmpdir.join("cache.json")))
+    folder = join(dirname(__file__), "scripts/sample_lib_ok")
+    ok, _ = check_all_scripts_from_library_jsons(folder, cache=cache)
+    assert ok is True
+    assert cache.hits == 0
+    ok, _ = check_all_scripts_from_library_jsons(folder, cache=cache)
+    assert ok is True
+    assert cache.hits == cache.misses
+
+
+# Static checks related tests
+
+
+@pytest.mark.parametrize("script, expected_errors",
+                         [("valid.py", 0),
+                          ("invalid_part_not_defined.py", 1),
+                          ("invalid_part_is_none.py", 1),
+                          ("invalid_anchors_not_defined.py", 1),
+                          ("invalid_anchors_is_none.py", 1),
+                          ("invalid_anchors_not_a_dict.py", 1),
+                          ("invalid_part_and_anchors_not_defined.py", 2)])
+def test_static_same_as_execution(script, expected_errors):
+    r"""The static checks find the errors that executing the scripts finds"""
+    ok, errors = check_script_static(join(dirname(__file__), "scripts",
+                                          script))
+    assert ok is (expected_errors == 0)
+    assert len(errors) == expected_errors
+
+
+def test_static_anchors_and_names():
+    source = """
+from ccad.model import cylinder
+__shape__ = cylinder(radius, 10.).shape
+__anchors__ = {"top": {"p": (0., 0., 10.), "u": (0., 1.)},
+               "bottom": None}
+"""
+    ok, errors = check_source_static(source)
+    assert ok is False
+    assert sorted(errors) == ["'u' of the anchor at line 4 does not have "
+                              "3 coordinates",
+                              "anchor at line 4 has no 'v'",
+                              "anchor at line 5 is not a dict",
+                              "name 'radius' is not defined"]
+    ok, errors = check_source_static("part = 1\nanchors = {", "bad.py")
+    assert ok is False
+    assert errors[0].startswith("SyntaxError")
+
+
+def test_check_all_scripts_static():
+    r"""The static checks do not execute the scripts : the scripts that hang
+    or crash pass"""
+    ok, all_errors = check_all_scripts_from_library_jsons(
+        join(dirname(__file__), "scripts/sample_lib_isolation"), static=True)
+    assert ok is False
+    errors = list(all_errors.values())[0]
+    assert dict((part_id, part_errors["status"])
+                for part_id, part_errors in errors.items()) == \
+        {"raises": STATUS_FAILED,
+         "missing": STATUS_MISSING}
+
+
+def test_generators_static():
+    json_file = join(dirname(__file__), "scripts/sample_lib_ok/library.json")
+    ok, errors = check_library_generators_static(json_file)
+    assert ok is True
+    assert errors == {}
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Tests for the templating module"""
+
+import json
+from os import listdir
+import pytest
+
+from cadracks_party.templating import GeneratorTemplates, GeneratorCodes, \
+    parametric_source, generators_to_json_string, svg_to_json_string, \
+    generator_source, drawing_source
+
+
+GENERATORS = {"cylinder": ["from ccad.model import cylinder",
+                           "",
+                           "radius = {{ radius }}",
+                           "length = {{ length }}",
+                           "",
+                           "part = cylinder(radius, length)"]}
+
+
+def test_generator_templates_render():
+    templates = GeneratorTemplates(GENERATORS)
+    script = templates.render("cylinder", {"radius": 10.0, "length": 20.0})
+    assert "radius = 10.0\n" in script
+    assert "length = 20.0\n" in script
+
+
+def test_generator_templates_compiled_once():
+    templates = GeneratorTemplates(GENERATORS)
+    template = templates.get_template("cylinder")
+    templates.render("cylinder", {"radius": 1.0, "length": 2.0})
+    assert templates.get_template("cylinder") is template
+
+
+def test_generator_templates_unknown_generator():
+    templates = GeneratorTemplates(GENERATORS)
+    with pytest.raises(KeyError):
+        templates.get_template("unknown")
+
+
+def test_generator_templates_bytecode_cache(tmpdir):
+    cache_folder = str(tmpdir.join("cache"))
+    GeneratorTemplates(GENERATORS, bytecode_cache_folder=cache_folder).\
+        render("cylinder", {"radius": 1.0, "length": 2.0})
+    assert len(listdir(cache_folder)) == 1
+    # A new run reuses the bytecode cache
+    script = GeneratorTemplates(GENERATORS,
+                                bytecode_cache_folder=cache_folder).\
+        render("cylinder", {"radius": 3.0, "length": 4.0})
+    assert "radius = 3.0\n" in script
+
+
+def test_generator_templates_no_file_io(tmpdir):
+    r"""Rendering works from the generator code held in memory"""
+    with tmpdir.as_cwd():
+        GeneratorTemplates(GENERATORS).render("cylinder",
+                                              {"radius": 1.0, "length": 2.0})
+        assert len(tmpdir.listdir()) == 0
+
+
+def test_generator_templates_libraries_share_cache(tmpdir):
+    r"""2 libraries using the same generator id with different code"""
+    cache_folder = str(tmpdir.join("cache"))
+    other_generators = {"cylinder": ["part = cylinder({{ radius }}, 1.)"]}
+    script_1 = GeneratorTemplates(GENERATORS,
+                                  bytecode_cache_folder=cache_folder,
+                                  library_id="lib_1").\
+        render("cylinder", {"radius": 1.0, "length": 2.0})
+    script_2 = GeneratorTemplates(other_generators,
+                                  bytecode_cache_folder=cache_folder,
+                                  library_id="lib_2").\
+        render("cylinder", {"radius": 1.0})
+    assert "length = 2.0" in script_1
+    assert "part = cylinder(1.0, 1.)" in script_2
+    assert len(listdir(cache_folder)) == 2
+
+
+def test_parametric_source():
+    source = parametric_source(["radius = {{ radius }}",
+                                "name = '{{ name }}'"])
+    assert "radius = radius\n" in source
+    assert "name = str(name)" in source
+
+
+def test_parametric_source_needs_rendering():
+    assert parametric_source(["name = 'M{{ d }}'"]) is None
+    assert parametric_source(["{% if d > 1 %}", "a = 1", "{% endif %}"]) \
+        is None
+    assert parametric_source(["a = {{ d|round }}"]) is None
+
+
+def test_generator_codes():
+    generators = {"square": ["side = {{ side }}",
+                             "__shape__ = side * side"],
+                  "templated": ["{% if side > 1 %}",
+                                "__shape__ = 1",
+                                "{% endif %}"]}
+    codes = GeneratorCodes(generators)
+    code = codes.get_code("square")
+    assert codes.get_code("square") is code
+    namespace = {"side": 3.}
+    exec(code, namespace)
+    assert namespace["__shape__"] == 9.
+    assert codes.get_code("templated") is None
+    with pytest.raises(KeyError):
+        codes.get_code("unknown")
+
+
+# JSON encoding related tests
+
+
+def test_generators_json_string_round_trip():
+    r"""Quotes, backslashes and non-ascii characters survive the encoding"""
+    lines = ['r"""Generator \'{{ name }}\' \\ é"""\n',
+             "name = '{{ name }}'\n",
+             'part = cylinder({{ radius }}, 1.)\n']
+    content = json.loads("{%s}" % generators_to_json_string({"g": lines}))
+    assert content == {"g": "".join(lines)}
+    assert generator_source(content["g"]) == "".join(lines)
+
+
+def test_svg_json_string_round_trip():
+    svg = '<svg xmlns="http://www.w3.org/2000/svg">\n<text>l\'écrou</text>\n'
+    content = json.loads("{%s}" % svg_to_json_string({"d": svg}))
+    assert drawing_source(content["d"]) == svg
+
+
+def test_old_line_arrays():
+    r"""The generators and drawings of older libraries are lists of lines
+    where the quotes were replaced"""
+    assert generator_source(["'''Doc'''", "name = 'M{{ d }}'"]) == \
+        '"""Doc"""\nname = "M{{ d }}"'
+    assert drawing_source(["<svg a='1'>", "<text>l@simple_quote@a</text>",
+                           "</svg>"]) == \
+        '<svg a="1">\n<text>l\'a</text>\n</svg>\n'
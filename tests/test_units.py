@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Tests for the units module"""
+
+import json
+from os.path import join, dirname
+import pytest
+
+from cadracks_party.units import field_units, conversion_factor, convert_data
+
+
+def test_field_units():
+    json_file = join(dirname(__file__), "./json_files/library_ok_units.json")
+    units = field_units(json_file)
+    assert units["d_s_max"] == "mm"
+    assert "description" not in units
+
+
+def test_conversion_factor():
+    assert conversion_factor("mm", "in") == pytest.approx(1. / 25.4)
+    assert conversion_factor("kN", "N") == 1000.
+    with pytest.raises(ValueError):
+        conversion_factor("mm", "g")
+    with pytest.raises(ValueError):
+        conversion_factor("mm", "furlong")
+
+
+def test_convert_data(tmpdir):
+    r"""Only the numbers of the fields in converted units are converted"""
+    content = {"metadata": {"units": {"length": ["mm", ["radius", "pitch"]],
+                                      "weight": ["g", ["weight"]]}},
+               "data": {"a": {"radius": 25.4, "pitch": "coarse",
+                              "weight": 3, "description": "a"},
+                        "b": {"radius": 254, "pitch": None,
+                              "weight": 4, "description": "b"}}}
+    json_file = tmpdir.join("library.json")
+    json_file.write(json.dumps(content))
+    units, data = convert_data(str(json_file), {"mm": "in"})
+    assert units == {"length": ["in", ["radius", "pitch"]],
+                     "weight": ["g", ["weight"]]}
+    assert list(data.keys()) == ["a", "b"]
+    assert data["a"] == {"radius": pytest.approx(1.), "pitch": "coarse",
+                         "weight": 3, "description": "a"}
+    assert data["b"]["radius"] == pytest.approx(10.)
+    assert data["b"]["pitch"] is None
+    with pytest.raises(ValueError):
+        convert_data(str(json_file), {"mm": "kg"})
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+r"""Tests for the validation_cache module"""
+
+import json
+from os.path import join, dirname
+
+import pytest
+
+from cadracks_party.library_checking import check_all
+from cadracks_party.validation_cache import ValidationCache, validation_key
+
+
+def test_validation_key():
+    k = validation_key("library", {"radius": 1.}, ["radius > 0"])
+    assert k == validation_key("library", {"radius": 1.}, ["radius > 0"])
+    assert k != validation_key("library", {"radius": 2.}, ["radius > 0"])
+    assert k != validation_key("script", {"radius": 1.}, ["radius > 0"])
+
+
+def test_cache_save_and_prune(tmpdir):
+    filename = str(tmpdir.join("cache.json"))
+    cache = ValidationCache(filename)
+    assert cache.get("a") is None
+    cache.set("a", [1])
+    cache.set("b", [2])
+    cache.save()
+
+    cache = ValidationCache(filename)
+    assert cache.get("a") == [1]
+    assert (cache.hits, cache.misses) == (1, 0)
+    cache.prune()
+    cache.save()
+    assert ValidationCache(filename).get("b") is None
+
+
+@pytest.mark.parametrize("library", ["good_library.json",
+                                     "library_many_errors.json",
+                                     "library_missing_field.json",
+                                     "library_duplicate_units.json",
+                                     "library_missing_units_definition.json"])
+def test_check_all_cached(tmpdir, library):
+    r"""check_all() gives the same results with a cache, and only checks the
+    parts that changed"""
+    json_file = join(dirname(__file__), "json_files", library)
+    expected = check_all(json_file)
+    cache = ValidationCache(str(tmpdir.join("cache.json")))
+    assert check_all(json_file, cache=cache) == expected
+    assert cache.hits == 0
+    cache.save()
+
+    cache = ValidationCache(str(tmpdir.join("cache.json")))
+    assert check_all(json_file, cache=cache) == expected
+    assert cache.misses == 0
+    hits = cache.hits
+
+    # change the values of a part : only the checks depending on the changed
+    # values are run again
+    with open(json_file) as f:
+        content = json.load(f)
+    part_id = sorted(content["data"].keys())[-1]
+    content["data"][part_id]["description"] = "changed"
+    changed_file = str(tmpdir.join("library.json"))
+    with open(changed_file, 'w') as f:
+        json.dump(content, f)
+    cache = ValidationCache(str(tmpdir.join("cache.json")))
+    assert check_all(changed_file, cache=cache) == check_all(changed_file)
+    assert cache.misses <= 1
+    assert cache.hits >= hits - 1